@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Microbenchmark for weechat-vimode's motions. Times each motion from the
+start of input lines of increasing length: the cost per motion should stay
+flat, no matter how long the line is.
+
+Usage:
+    python bench.py
+"""
+
+
+import sys
+import timeit
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+sys.modules['weechat'] = Mock()
+
+import vimode
+
+
+LINE_LENGTHS = [100, 1000, 10000, 20000]
+MOTIONS = ["w", "W", "e", "E", "b", "B", "ge", "gE", "iw", "f", "F", "t", "T"]
+# Number of runs for each motion and line length.
+NUMBER = 2000
+
+def make_line(length):
+    """Return a line of words and punctuation of the given length."""
+    words = "Lorem ipsum, dolor sit-amet (consectetur) adipiscing elit! "
+    return (words * (length // len(words) + 1))[:length]
+
+def run_motion(motion, line, cur):
+    """Run `motion` on `line` from `cur`, completing catching motions."""
+    func = vimode.VI_MOTION_ACTIONS[motion].func
+    _, _, _, catching = func(line, cur, 1)
+    if catching:
+        vimode.catching_keys_data['keys'] = "e"
+        vimode.catching_keys_data['amount'] = 0
+        vimode.catching_keys_data['callback']()
+        func(line, cur, 1)
+
+
+# Load the default options.
+for option, value in vimode.vimode_settings.items():
+    vimode.vimode_settings[option] = value[0]
+vimode.load_is_keyword()
+
+print("µs per motion, cursor near the start of the line:")
+print("motion" + "".join("%10s" % length for length in LINE_LENGTHS))
+for motion in MOTIONS:
+    row = "%-6s" % motion
+    for length in LINE_LENGTHS:
+        line = make_line(length)
+        # Backward motions need some text before the cursor.
+        cur = 30
+        seconds = timeit.timeit(lambda: run_motion(motion, line, cur),
+                                number=NUMBER)
+        row += "%10.2f" % (seconds / NUMBER * 1e6)
+    print(row)
@@ -16,20 +16,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-"""Tests for weechat-vimode. Uses a gvim instance as a server to compare the
-behavior of our custom implementation to vim's.
+"""Tests for weechat-vimode.
 
-Note that a full test takes a fair bit of time.
+The data structures are tested with pytest, without WeeChat. Running this
+file instead uses a gvim instance as a server to compare the behavior of our
+motions to vim's.
+
+Note that a full motion test takes a fair bit of time.
 
 Usage:
-    python2 py.test
+    python -m pytest -q
+    python test.py
 """
 
 
-from mock import Mock
 import subprocess
 import sys
 import time
+try:
+    from unittest.mock import Mock, call
+except ImportError:
+    from mock import Mock, call
+
+import pytest
 
 sys.modules['weechat'] = Mock()
 
@@ -67,7 +76,7 @@ def vim_get_cur():
     out = process.communicate()[0].strip()
     return int(out)
 
-def test_motion(motion_func, motion_keys):
+def check_motion(motion_func, motion_keys):
     """Compare a custom function's behavior to the vim server's to test it."""
     count = 1
     for line in TEST_LINES:
@@ -78,7 +87,7 @@ def test_motion(motion_func, motion_keys):
         # Check the behavior of our function for each possible cursor position.
         for cur in range(0, len(line)):
             # Get the cursor position, as returned by our function.
-            got, _, catching = motion_func(line, cur, count)
+            got, _, _, catching = motion_func(line, cur, count)
             # Out of bound positions are corrected anyway, so we don't mind
             # those inaccuracies.
             got = max(1, min(len(line), got + 1))
@@ -86,9 +95,8 @@ def test_motion(motion_func, motion_keys):
             if catching:
                 vimode.catching_keys_data['keys'] = "a"
                 vimode.catching_keys_data['amount'] = 0
-                callback = vimode.catching_keys_data['callback']
-                getattr(vimode, callback)()
-                got, _, _ = motion_func(line, cur, count)
+                vimode.catching_keys_data['callback']()
+                got, _, _, _ = motion_func(line, cur, count)
                 got = max(1, min(len(line), cur + 1 if got == -1 else got + 1))
 
             # Set the cursor's position on the vim server.
@@ -106,22 +114,688 @@ def test_motion(motion_func, motion_keys):
                     cur, count, got, expected))
 
 
-# Start a vim server (we use gvim because it forks directly).
-SERVERS = subprocess.Popen(["gvim", "--serverlist"], stdout=subprocess.PIPE).communicate()[0]
-if not (SERVERS and SERVER_NAME in SERVERS.split()):
-    subprocess.Popen(["gvim", "--servername", SERVER_NAME]).wait()
-    time.sleep(0.5)  # To make sure it's completely ready.
-
-# Test each of weechat-vimode's custom motion implementations.
-for motion in vimode.VI_MOTIONS:
-    # Get the function's name (special characters need to be replaced; for
-    # example, "^"'s function is called "motion_carret" and not "motion_^").
-    if motion in vimode.SPECIAL_CHARS:
-        func = "motion_{}".format(vimode.SPECIAL_CHARS[motion])
-    else:
-        func = "motion_{}".format(motion)
-    # Test it!
-    test_motion(getattr(vimode, func), motion)
-
-# Exit the vim server.
-vim_send("<Esc>ZQ")
+def compare_motions():
+    """Compare all of weechat-vimode's motions to vim's."""
+    # Start a vim server (we use gvim because it forks directly).
+    servers = subprocess.Popen(["gvim", "--serverlist"],
+                               stdout=subprocess.PIPE).communicate()[0]
+    if not (servers and SERVER_NAME in servers.split()):
+        subprocess.Popen(["gvim", "--servername", SERVER_NAME]).wait()
+        time.sleep(0.5)  # To make sure it's completely ready.
+
+    # Test each of weechat-vimode's custom motion implementations.
+    for motion in vimode.VI_MOTIONS:
+        # Get the function from the dispatch table (special characters are
+        # already handled; for example, "^"'s function is `motion_carret()`).
+        func = vimode.VI_MOTION_ACTIONS[motion].func
+        # Test it!
+        check_motion(func, motion)
+
+    # Exit the vim server.
+    vim_send("<Esc>ZQ")
+
+
+# Load the default options.
+for option, value in vimode.vimode_settings.items():
+    vimode.vimode_settings[option] = value[0]
+
+
+# Key maps.
+# ---------
+
+def test_key_trie():
+    trie = vimode.KeyTrie({"gg": 1, "g_": 2})
+    assert len(trie) == 2
+    assert trie["gg"] == 1 and "g" not in trie
+    assert trie.has_longer("g") and not trie.has_longer("gg")
+    assert trie.longest_prefix("ggx") == ("gg", 1)
+    assert trie.longest_prefix("x") == (None, None)
+    del trie["gg"]
+    assert sorted(trie) == ["g_"]
+    del trie["g_"]
+    # Nodes that no longer lead anywhere are pruned.
+    assert trie.root == {} and len(trie) == 0
+
+def test_keymap_layers():
+    changed = []
+    keymap = vimode.Keymap({"gg": "top", "x": "delete"})
+    keymap.on_change = changed.append
+    keymap["x"] = "user x"
+    keymap["gx"] = "user gx"
+    assert keymap["x"] == "user x"
+    assert keymap.lookup("x") == ("user x", False)
+    assert keymap.lookup("x", noremap=True) == ("delete", False)
+    assert keymap.lookup("g") == (None, True)
+    assert keymap.longest_prefix("xyz") == ("x", "user x")
+    del keymap["x"]
+    assert keymap["x"] == "delete"
+    assert sorted(keymap) == ["gg", "gx", "x"]
+    assert changed == ["x", "gx", "x"]
+
+
+# Key parser.
+# -----------
+
+def feed(parser, keys):
+    """Feed each of `keys` to `parser`, return the status of the last one."""
+    for key in keys:
+        status, action, count = parser.feed(key)
+    return status, action, count
+
+def test_key_parser_counts():
+    parser = vimode.KeyParser()
+    assert parser.feed("2")[0] == parser.PENDING
+    status, action, count = feed(parser, "d3w")
+    assert status == parser.DONE
+    assert action is vimode.VI_DISPATCH["dw"]
+    assert count == 6 and parser.done_keys == "2d3w"
+    # "0" is a motion, unless it continues a count.
+    assert feed(parser, "0") == (parser.DONE, vimode.VI_DISPATCH["0"], 0)
+    assert feed(parser, "10j")[2] == 10
+
+def test_key_parser_register():
+    parser = vimode.KeyParser()
+    status, action, _ = feed(parser, '"add')
+    assert status == parser.DONE and action is vimode.VI_DISPATCH["dd"]
+    assert parser.done_register == "a"
+    assert feed(parser, '"!')[0] == parser.NO_MATCH
+    assert feed(parser, "Zq")[0] == parser.NO_MATCH
+
+def test_key_parser_ambiguous():
+    """Keys that start a longer user mapping wait for the next key."""
+    vimode.VI_KEYS["ggx"] = "/buffer 1"
+    try:
+        parser = vimode.KeyParser()
+        assert feed(parser, "gg")[0] == parser.AMBIGUOUS
+        status, action, _ = parser.feed("j")
+        assert status == parser.DONE and action is vimode.VI_DISPATCH["gg"]
+        assert parser.done_keys == "gg" and parser.replay == ["j"]
+        feed(parser, "gg")
+        assert parser.flush()[0] is vimode.VI_DISPATCH["gg"]
+        assert parser.replay == [] and parser.flush() == (None, 0)
+    finally:
+        del vimode.VI_KEYS["ggx"]
+
+
+# Input line edits.
+# -----------------
+
+def mock_weechat(monkeypatch, input_line="", pos=0):
+    """Replace the weechat module with a new mock, holding an input line."""
+    module = Mock()
+    module.buffer_get_string.return_value = input_line
+    module.buffer_get_integer.return_value = pos
+    monkeypatch.setattr(vimode, "weechat", module)
+    return module
+
+def test_edit_transaction_batches(monkeypatch):
+    """Edits are written once, when the outermost callback returns."""
+    module = mock_weechat(monkeypatch, "hello", 5)
+
+    @vimode.edit_transaction
+    def inner(buf):
+        vimode.set_input(buf, "hi")
+        vimode.update_bar_item("mode_indicator")
+
+    @vimode.edit_transaction
+    def callback(buf):
+        vimode.set_input(buf, "hello world")
+        vimode.set_pos(buf, 3)
+        inner(buf)
+        assert not module.buffer_set.called
+        # Pending edits are read back, the cursor capped to the new input.
+        assert vimode.get_input_state(buf) == ("hi", 2)
+        vimode.update_bar_item("mode_indicator")
+
+    callback("edits-batches")
+    assert module.buffer_set.call_args_list == [
+        call("edits-batches", "input", "hi"),
+        call("edits-batches", "input_pos", "2")]
+    module.bar_item_update.assert_called_once_with("mode_indicator")
+
+def test_edit_transaction_unchanged(monkeypatch):
+    """Edits that don't change the input line aren't written."""
+    module = mock_weechat(monkeypatch, "hello", 5)
+
+    @vimode.edit_transaction
+    def callback(buf):
+        vimode.set_input(buf, vimode.get_input(buf) + "!")
+        vimode.set_input(buf, "hello")
+        vimode.set_pos(buf, vimode.get_cur(buf))
+
+    callback("edits-unchanged")
+    assert not module.buffer_set.called
+
+def test_edit_transaction_error(monkeypatch):
+    """The edits made before an error are still written."""
+    module = mock_weechat(monkeypatch)
+
+    @vimode.edit_transaction
+    def callback(buf):
+        vimode.set_input(buf, "x")
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        callback("edits-error")
+    assert vimode.edits.depth == 0 and not vimode.edits.buffers
+    module.buffer_set.assert_called_once_with("edits-error", "input", "x")
+
+
+# Scheduler.
+# ----------
+
+def test_scheduler_order(monkeypatch):
+    """Tasks run by deadline, then in the order they were scheduled."""
+    module = mock_weechat(monkeypatch)
+    now = [1000.0]
+    monkeypatch.setattr(vimode.time, "time", lambda: now[0])
+    scheduler = vimode.Scheduler()
+    ran = []
+    for delay, data in [(20, "c"), (10, "a"), (10, "b"), (30, "d")]:
+        scheduler.schedule(delay, None, lambda data, _: ran.append(data), data)
+    # The timer is armed for the earliest task only.
+    assert module.hook_timer.call_args_list[0][0][0] == 20
+    assert module.hook_timer.call_args_list[-1][0][0] == 10
+    now[0] += 0.02
+    scheduler.run()
+    assert ran == ["a", "b", "c"] and scheduler.pending() == 1
+    assert module.hook_timer.call_args[0][0] == 10
+    now[0] += 0.01
+    scheduler.run()
+    assert ran == ["a", "b", "c", "d"] and scheduler.tasks_run == 4
+
+def test_scheduler_cancel(monkeypatch):
+    """A task replaces the pending one with the same key, or is cancelled."""
+    module = mock_weechat(monkeypatch)
+    now = [1000.0]
+    monkeypatch.setattr(vimode.time, "time", lambda: now[0])
+    scheduler = vimode.Scheduler()
+    ran = []
+    scheduler.schedule(10, "key", lambda data, _: ran.append(data), "old")
+    scheduler.schedule(20, "key", lambda data, _: ran.append(data), "new")
+    scheduler.schedule(30, "other", lambda data, _: ran.append(data), "x")
+    assert scheduler.pending() == 2
+    scheduler.cancel("other")
+    scheduler.cancel("missing")
+    timers = module.hook_timer.call_count
+    now[0] += 0.03
+    scheduler.run()
+    assert ran == ["new"] and scheduler.pending() == 0
+    # Nothing's left to wait for.
+    assert module.hook_timer.call_count == timers
+    assert scheduler.timer is None and not scheduler.queue
+
+
+# Keyword classes.
+# ----------------
+
+def test_keyword_classes_vim_format():
+    classes = vimode.KeywordClasses("@,48-57,_,192-255,^x,@-@")
+    keyword = vimode.CLASS_KEYWORD
+    punctuation = vimode.CLASS_PUNCTUATION
+    for char in "aZ09_éÿ@":
+        assert classes.get_class(char) == keyword, char
+    for char in "x-.!":
+        assert classes.get_class(char) == punctuation, char
+    assert classes.get_class(" ") == vimode.CLASS_BLANK
+    # Letters above 255 are keyword characters, other characters aren't.
+    assert classes.get_class("ж") == keyword
+    assert classes.get_class("—") == punctuation
+
+def test_keyword_classes_wide_ranges():
+    classes = vimode.KeywordClasses("a-z,8212-8213,^8213")
+    assert classes.get_class("—") == vimode.CLASS_KEYWORD
+    assert classes.get_class("―") == vimode.CLASS_PUNCTUATION
+    assert classes.wide == {8212: vimode.CLASS_KEYWORD,
+                            8213: vimode.CLASS_PUNCTUATION}
+
+def test_keyword_classes_regex():
+    classes = vimode.KeywordClasses("a-z-")
+    assert classes.regex is not None
+    assert classes.get_class("-") == vimode.CLASS_KEYWORD
+    assert classes.get_class("A") == vimode.CLASS_PUNCTUATION
+
+
+# Undo tree.
+# ----------
+
+def test_undo_tree_branches():
+    """A change after an undo starts a branch, both stay reachable."""
+    tree = vimode.UndoTree()
+    for text in ["a", "ab", "abc"]:
+        tree.add(text)
+    assert tree.move_to(tree.get_undo_target(2)) == "a"
+    tree.add("ax")
+    assert tree.move_to(tree.get_undo_target(1)) == "a"
+    # Ctrl-R follows the newest branch, g- goes back in time.
+    assert tree.move_to(tree.get_redo_target(1)) == "ax"
+    assert tree.move_to(tree.get_seq_target(-1)) == "abc"
+    assert tree.move_to(tree.states[0]) == ""
+    assert tree.move_to(tree.states[4]) == "ax"
+
+def test_undo_tree_evict():
+    """Dead branches are evicted first, then the oldest changes."""
+    tree = vimode.UndoTree()
+    tree.add("a")
+    tree.add("ab")
+    tree.move_to(tree.root)
+    tree.add("x")
+    size = tree.size
+    # The "a" -> "ab" branch doesn't lead to "x".
+    assert tree.evict() == 2
+    assert tree.size == size - 2
+    assert sorted(tree.states) == [0, 3]
+    # Then the root itself goes.
+    assert tree.evict() == 1
+    assert tree.root is tree.current
+    assert tree.evict() == 0
+    assert tree.text == "x"
+
+
+# Registers.
+# ----------
+
+def reset_registers(monkeypatch):
+    """Start over with empty registers and histories, and an unread viminfo
+    file."""
+    monkeypatch.setattr(vimode, "registers", vimode.OrderedDict())
+    monkeypatch.setattr(vimode, "unnamed_register", "0")
+    monkeypatch.setattr(vimode, "histories",
+                        {':': vimode.History(), '/': vimode.History()})
+    monkeypatch.setattr(vimode, "viminfo", vimode.Viminfo())
+
+@pytest.fixture
+def viminfo_dir(monkeypatch, tmp_path):
+    """Keep the viminfo file in a temporary directory."""
+    module = mock_weechat(monkeypatch)
+    module.string_eval_path_home.side_effect = (
+        lambda path, *args: path.replace("%h", str(tmp_path)))
+    module.config_string_to_boolean.side_effect = lambda value: value == "on"
+    monkeypatch.setattr(vimode, "scheduler", vimode.Scheduler())
+    monkeypatch.setitem(vimode.vimode_settings, 'unnamed_clipboard', "off")
+    monkeypatch.setitem(vimode.vimode_settings, 'viminfo_path',
+                        "%h/vimode/viminfo")
+    reset_registers(monkeypatch)
+    return tmp_path
+
+def test_numbered_registers(viminfo_dir):
+    for number in range(1, 11):
+        vimode.write_register(None, "line %d" % number, deleted=True,
+                              linewise=True)
+    vimode.write_register(None, "word", deleted=True)
+    vimode.write_register(None, "yank")
+    assert [vimode.registers[str(number)] for number in range(1, 10)] == [
+        "line %d" % number for number in range(10, 1, -1)]
+    assert vimode.registers["-"] == "word"
+    assert vimode.registers["0"] == "yank"
+    assert vimode.unnamed_register == "0"
+    # A shift is one record, whatever the number of registers.
+    pending = vimode.viminfo.pending
+    assert len(pending) == 2 * 10 + 2
+    assert pending[-4:-2] == ['["shift"]', '["\\"", "1", "line 10"]']
+
+def test_registers_max_size(viminfo_dir, monkeypatch):
+    monkeypatch.setitem(vimode.vimode_settings, 'registers_max_size', "11")
+    vimode.write_register("a", "12345")
+    vimode.write_register("b", "67890")
+    vimode.write_register("A", "!")
+    # The least recently written registers go first.
+    assert list(vimode.registers.items()) == [("b", "67890"), ("a", "12345!")]
+    vimode.write_register("c", "x")
+    assert list(vimode.registers.items()) == [("a", "12345!"), ("c", "x")]
+
+def test_viminfo_round_trip(viminfo_dir, monkeypatch):
+    for number in range(1, 4):
+        vimode.write_register(None, "line %d" % number, deleted=True,
+                              linewise=True)
+    vimode.write_register("a", "text")
+    vimode.write_register(None, "line 4", deleted=True, linewise=True)
+    saved = list(vimode.registers.items())
+    vimode.viminfo.flush()
+    path = viminfo_dir / "vimode" / "viminfo"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert path.parent.stat().st_mode & 0o777 == 0o700
+
+    reset_registers(monkeypatch)
+    vimode.load_viminfo()
+    assert list(vimode.registers.items()) == saved
+    assert vimode.unnamed_register == "1"
+
+    # The same state, written again without the outdated lines.
+    vimode.viminfo.write(str(path))
+    reset_registers(monkeypatch)
+    vimode.load_viminfo()
+    assert list(vimode.registers.items()) == saved
+    assert vimode.viminfo.lines == len(saved)
+
+
+# Scrollback index.
+# -----------------
+
+def mock_lines(monkeypatch, lines):
+    """Make the weechat mock hold a buffer's `lines` (pointers, oldest
+    first), and count the lines walked."""
+    module = mock_weechat(monkeypatch)
+    hdata = {}
+
+    def link():
+        hdata.clear()
+        for i, line in enumerate(lines):
+            following = lines[i + 1] if i + 1 < len(lines) else ""
+            hdata[("line", line, "next_line")] = following
+        hdata[("lines", "L", "first_line")] = lines[0] if lines else ""
+        hdata[("lines", "L", "last_line")] = lines[-1] if lines else ""
+        hdata[("lines", "L", "lines_count")] = len(lines)
+
+    module.hdata_get.side_effect = lambda name: name
+    module.hdata_pointer.side_effect = (
+        lambda name, pointer, var: hdata.get((name, pointer, var), ""))
+    module.hdata_integer.side_effect = (
+        lambda name, pointer, var: hdata.get((name, pointer, var), 0))
+    link()
+    return module, link
+
+def walked(module):
+    """Return the number of lines walked, and reset it."""
+    count = sum(1 for args in module.hdata_pointer.call_args_list
+                if args[0][0] == "line")
+    module.hdata_pointer.reset_mock()
+    return count
+
+def test_scrollback_index(monkeypatch):
+    lines = ["l%d" % i for i in range(10)]
+    module, link = mock_lines(monkeypatch, lines)
+    index = vimode.ScrollbackIndex("L")
+    index.sync()
+    assert index.count == 10 and walked(module) == 10
+    assert index.get_index("l7") == 7 and index.get_line(7) == "l7"
+    # New lines are walked from the last one known.
+    lines.extend(["l10", "l11"])
+    link()
+    index.sync()
+    assert index.get_index("l11") == 11 and walked(module) == 3
+    # Lines removed from the start shift the indexes.
+    del lines[:4]
+    link()
+    index.sync()
+    assert index.count == 8 and walked(module) == 1
+    assert index.get_index("l4") == 0 and index.get_index("l0") is None
+    assert index.get_line(7) == "l11"
+    # Lines inserted elsewhere are found by indexing them all again.
+    lines.insert(2, "new")
+    link()
+    index.sync()
+    assert index.get_index("new") == 2 and index.get_index("l11") == 8
+
+def test_scrollback_index_compaction(monkeypatch):
+    lines = ["l%d" % i for i in range(2000)]
+    module, link = mock_lines(monkeypatch, lines)
+    index = vimode.ScrollbackIndex("L")
+    index.sync()
+    for step in range(3):
+        del lines[:500]
+        lines.extend("m%d-%d" % (step, i) for i in range(500))
+        link()
+        index.sync()
+        assert index.get_line(0) == lines[0]
+        assert index.get_index(lines[-1]) == 1999
+    assert len(index.pointers) < 3500 and len(index.positions) == 2000
+
+
+# Histories.
+# ----------
+
+def test_history_recall():
+    history = vimode.History()
+    for entry in ["set", "s/a/b/", "nmap", "set", "b2"]:
+        history.add(entry)
+    assert history.recall("s") == ["set", "s/a/b/"]
+    assert history.recall("") == ["b2", "set", "nmap", "s/a/b/"]
+    assert history.recall("x") == []
+
+def test_history_size(monkeypatch):
+    monkeypatch.setitem(vimode.vimode_settings, 'history_size', "2")
+    history = vimode.History()
+    for entry in ["a", "b", "c"]:
+        history.add(entry)
+    assert history.recall("") == ["c", "b"]
+    assert history.index == ["b", "c"]
+
+def press(callback, buf, text, keys):
+    """Press `keys` with `text` in the input line, return the input line."""
+    line = vimode.get_input_line(buf)
+    line.text, line.pos = text, len(text)
+    callback("", "", keys)
+    return line.text
+
+def test_search_history(viminfo_dir, monkeypatch):
+    monkeypatch.setattr(vimode, "current_buf", "search-history")
+    monkeypatch.setattr(vimode, "cmd_history_recall", None)
+    search = vimode.cb_key_combo_search
+    for text in ["foo", "bar", "food"]:
+        press(search, "search-history", text, "\x01m")
+    assert vimode.get_history("/").recall("fo") == ["food", "foo"]
+    assert vimode.get_history(":").recall("") == []
+    # Up/Down recall the entries starting with the typed text.
+    text = press(search, "search-history", "fo", "\x01[[A")
+    assert text == "food"
+    text = press(search, "search-history", text, "\x01[[A")
+    assert text == "foo"
+    assert press(search, "search-history", text, "\x01[[A") == "foo"
+    text = press(search, "search-history", text, "\x01[[B")
+    assert press(search, "search-history", text, "\x01[[B") == "fo"
+
+    vimode.viminfo.flush()
+    reset_registers(monkeypatch)
+    assert vimode.get_history("/").recall("") == ["food", "bar", "foo"]
+
+def test_command_history(viminfo_dir, monkeypatch):
+    monkeypatch.setattr(vimode, "current_buf", "command-history")
+    monkeypatch.setattr(vimode, "cmd_history_recall", None)
+    state = vimode.get_buffer_state("command-history")
+    for text in [":set", "x1", ""]:
+        state.mode = "COMMAND"
+        state.cmd_backup = ("", 0)
+        press(vimode.cb_key_combo_default, "command-history", text, "\x01m")
+    # Only commands starting with a history's character are recorded.
+    assert vimode.get_history(":").recall("") == [":set"]
+    assert vimode.get_history("/").recall("") == []
+
+
+# Substitutions.
+# ---------------
+
+def test_convert_replacement():
+    assert vimode.convert_replacement("[&]") == "[\\g<0>]"
+    assert vimode.convert_replacement("\\1\\&") == "\\g<1>&"
+    assert vimode.convert_replacement("\\\\\\/") == "\\\\/"
+
+def test_parse_substitute():
+    substitution = vimode.parse_substitute("s/(o)/<\\1>/g")
+    assert substitution.count == 0
+    assert substitution.apply("foo") == "f<o><o>"
+    assert vimode.parse_substitute("s/O/0/i").apply("foO") == "f0O"
+    assert vimode.parse_substitute("s/o/0/ 1").count == 1
+    # An empty or invalid pattern.
+    assert vimode.parse_substitute("s//x/") is None
+    assert vimode.parse_substitute("s/(/x/") is None
+
+
+# Ex commands.
+# ------------
+
+def test_parse_ex_command():
+    ex = vimode.parse_ex_command("%s/a/b/g")
+    assert ex.range == ("1", "$") and ex.name == "s" and ex.args == "/a/b/g"
+    ex = vimode.parse_ex_command(".,$-2d")
+    assert ex.range == (".", "$-2") and ex.name == "d"
+    ex = vimode.parse_ex_command("22")
+    assert ex.range == ("22", None) and ex.name is None
+    ex = vimode.parse_ex_command("b2")
+    assert ex.range is None and ex.name == "b" and ex.count == "2"
+    assert vimode.parse_ex_command("w!").bang
+
+def test_resolve_address():
+    assert vimode.resolve_address(None, 5, 10) == 5
+    assert vimode.resolve_address("$-3", 5, 10) == 7
+    assert vimode.resolve_address(".+2", 5, 10) == 7
+    assert vimode.resolve_address("3+", 5, 10) == 4
+    assert vimode.resolve_address("-", 5, 10) == 4
+
+
+# Options.
+# --------
+
+@pytest.fixture
+def config(monkeypatch):
+    """Make the weechat mock hold the script options, calling `cb_config()`
+    when they change, as WeeChat does. Return {option: value}."""
+    module = mock_weechat(monkeypatch)
+    module.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED = 2
+    module.WEECHAT_CONFIG_OPTION_SET_OK_SAME_VALUE = 1
+    options = {option: value if not isinstance(value, dict) else ""
+               for option, value in vimode.vimode_settings.items()}
+
+    def config_set_plugin(option, value):
+        if options[option] == value:
+            return module.WEECHAT_CONFIG_OPTION_SET_OK_SAME_VALUE
+        options[option] = value
+        vimode.cb_config("", "plugins.var.python.vimode." + option, value)
+        return module.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
+
+    module.config_set_plugin.side_effect = config_set_plugin
+    monkeypatch.setattr(vimode, "scheduler", vimode.Scheduler())
+    monkeypatch.setattr(vimode, "own_option_writes", {})
+    for option in vimode.vimode_settings:
+        monkeypatch.setitem(vimode.vimode_settings, option,
+                            vimode.vimode_settings[option])
+    return options
+
+@pytest.fixture
+def reloads(monkeypatch):
+    """Record the options whose derived state is rebuilt."""
+    reloaded = []
+    monkeypatch.setattr(vimode, "reload_option",
+                        lambda option, old_value: reloaded.append(option))
+    return reloaded
+
+def test_option_changes_written_once(config, reloads):
+    vimode.apply_option_changes([('mode_indicator_prefix', None, "<"),
+                                 ('mode_indicator_prefix', None, "["),
+                                 ('timeoutlen', None, "1000")])
+    assert reloads == ['mode_indicator_prefix']
+    vimode.cb_write_options("", 0)
+    assert vimode.weechat.config_set_plugin.call_args_list == [
+        call('mode_indicator_prefix', "[")]
+    # Our own write isn't applied again.
+    assert reloads == ['mode_indicator_prefix']
+    assert config['mode_indicator_prefix'] == "["
+    assert not vimode.own_option_writes
+    # Changes made by the user are.
+    vimode.cb_config("", "plugins.var.python.vimode.timeoutlen", "500")
+    assert reloads == ['mode_indicator_prefix', 'timeoutlen']
+    assert vimode.vimode_settings['timeoutlen'] == "500"
+
+def test_unchanged_option_write(config, reloads):
+    """Writing an option's current value doesn't hide the user's changes."""
+    vimode.write_option('timeoutlen')
+    vimode.cb_write_options("", 0)
+    assert not vimode.own_option_writes
+    for value in ["500", "1000"]:
+        vimode.cb_config("", "plugins.var.python.vimode.timeoutlen", value)
+    assert reloads == ['timeoutlen', 'timeoutlen']
+    assert vimode.vimode_settings['timeoutlen'] == "1000"
+
+def test_mapping_changes(config, monkeypatch):
+    monkeypatch.setitem(vimode.vimode_settings, 'user_mappings', {})
+    monkeypatch.setitem(vimode.vimode_settings, 'user_mappings_noremap', {})
+    try:
+        vimode.apply_option_changes([('user_mappings', "Q", "dw"),
+                                     ('user_mappings_noremap', "Q", "x")])
+        assert vimode.VI_KEYS["Q"].rhs == "x"
+        assert vimode.VI_KEYS["Q"].noremap
+        vimode.cb_write_options("", 0)
+        # The new mapping replaced the recursive one.
+        assert config['user_mappings_noremap'] == '{"Q": "x"}'
+        assert vimode.vimode_settings['user_mappings'] == {}
+        assert not vimode.own_option_writes
+    finally:
+        vimode.cmd_nunmap("Q")
+    assert "Q" not in vimode.VI_KEYS
+
+
+# Vimrc.
+# ------
+
+def test_compile_vimrc(monkeypatch):
+    module = mock_weechat(monkeypatch)
+    changes, errors = vimode.compile_vimrc("vimrc", [
+        '" comment', "", "nmap Q dw", ":nnoremap <C-x> /buffer 1<CR>",
+        "imap jk <Esc>", "set timeoutlen=500", "set nosearch_vim",
+        "set user_mappings={}", "imap jj x", "map Q x"])
+    assert changes == [('user_mappings', "Q", "dw"),
+                       ('user_mappings_noremap', "\x01x", "/buffer 1<CR>"),
+                       ('imap_esc', None, "jk"),
+                       ('timeoutlen', None, "500"),
+                       ('search_vim', None, "off")]
+    assert errors == 3
+    assert "vimrc:8: unsupported line" in module.prnt.call_args_list[0][0][1]
+
+@pytest.fixture
+def vimrc(config, monkeypatch, tmp_path):
+    """Keep the vimrc file and its cache in a temporary directory, and count
+    the compilations. Return the path of the file."""
+    vimode.weechat.string_eval_path_home.side_effect = (
+        lambda path, *args: path.replace("%h", str(tmp_path)))
+    monkeypatch.setattr(vimode, "vimrc_mappings", {})
+    compile_vimrc = vimode.compile_vimrc
+    compiled = []
+
+    def counting(path, lines):
+        compiled.append(path)
+        return compile_vimrc(path, lines)
+
+    monkeypatch.setattr(vimode, "compile_vimrc", counting)
+    path = tmp_path / "vimrc"
+    yield path, compiled
+    # Unmap what the file mapped.
+    path.write_text(u"")
+    vimode.source_vimrc(str(path))
+
+def test_vimrc_cache(vimrc, tmp_path):
+    path, compiled = vimrc
+    path.write_text(u"nmap Q dw\nset timeoutlen=500\n")
+    vimode.source_vimrc(str(path))
+    vimode.source_vimrc(str(path))
+    assert len(compiled) == 1
+    assert vimode.VI_KEYS["Q"].rhs == "dw"
+    assert vimode.vimode_settings['timeoutlen'] == "500"
+    cache = tmp_path / "vimode" / "vimrc_cache"
+    assert cache.stat().st_mode & 0o777 == 0o600
+    assert cache.parent.stat().st_mode & 0o777 == 0o700
+    assert [p.name for p in cache.parent.iterdir()] == ["vimrc_cache"]
+    # The file changed.
+    path.write_text(u"nmap Q dd\nset timeoutlen=500\n\n")
+    vimode.source_vimrc(str(path))
+    assert len(compiled) == 2 and vimode.VI_KEYS["Q"].rhs == "dd"
+    # Files with errors aren't cached.
+    path.write_text(u"nmap Q dd\nbogus\n")
+    vimode.source_vimrc(str(path))
+    vimode.source_vimrc(str(path))
+    assert len(compiled) == 4
+
+def test_vimrc_mappings(vimrc, config):
+    path, _ = vimrc
+    path.write_text(u"nmap Q dw\nnmap W dd\n")
+    vimode.source_vimrc(str(path))
+    assert vimode.VI_KEYS["W"].rhs == "dd"
+    # The mappings aren't saved to the options.
+    vimode.cb_write_options("", 0)
+    assert config['user_mappings'] == ""
+    path.write_text(u"nmap Q dw\n")
+    vimode.source_vimrc(str(path))
+    assert "W" not in vimode.VI_KEYS and vimode.VI_KEYS["Q"].rhs == "dw"
+
+
+if __name__ == "__main__":
+    compare_motions()
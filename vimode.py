@@ -22,18 +22,19 @@
 
 
 from abc import ABCMeta, abstractproperty
-from contextlib import contextmanager
-import csv
+import base64
+import bisect
+from collections import OrderedDict
 import enum
+import errno
+import fcntl
 import functools
+import heapq
 import json
+import math
 import os
 import re
 import subprocess
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 import sys
 import time
 
@@ -64,19 +65,16 @@ FAQ_ESC = GITHUB_BASE + "FAQ.md#esc-key-not-being-detected-instantly"
 
 # Holds the text of the tab-completions for the command-line mode.
 cmd_compl_text = ""
-# Holds the original text of the command-line mode, used for completion.
-cmd_text_orig = None
-# Index of current suggestion, used for completion.
-cmd_compl_pos = 0
-# Used for command-line mode history.
-cmd_history = []
-cmd_history_index = 0
-# Used to store the content of the input line when going into COMMAND mode.
-input_line_backup = {}
-# Mode we're in. One of INSERT, NORMAL, REPLACE, COMMAND or SEARCH.
-# SEARCH is only used if search_vim is enabled.
-mode = "INSERT"
-# Holds normal commands (e.g. "dd").
+# Tab completion of the command line in progress, None if there's none. See
+# `Completion`.
+cmd_completion = None
+# Entries of the history being recalled with Up/Down: [typed text, entries
+# starting with it (most recent first), index of the entry shown], or None.
+# See `History.recall()`.
+cmd_history_recall = None
+# Holds normal commands (e.g. "dd"), as shown in the vi_buffer bar item.
+# In Normal mode, these are the keys pending in the current buffer's
+# `KeyParser`.
 vi_buffer = ""
 # See `cb_key_combo_default()`.
 esc_pressed = 0
@@ -86,22 +84,59 @@ last_signal_time = 0
 catching_keys_data = {'amount': 0}
 # Used for ; and , to store the last f/F/t/T motion.
 last_search_motion = {'motion': None, 'data': None}
-# Used for undo history.
-undo_history = {}
-undo_history_index = {}
-# Holds mode colors (loaded from vimode_settings).
-mode_colors = {}
+# See `get_line_index()`.
+line_index = None
+# Loaded on runtime (uses the is_keyword config option).
+keyword_classes = None
+# Total size of the undo trees, see `UndoTree.size`.
+undo_size = 0
+# Rendered mode indicators, keyed by mode (see `load_mode_indicators()`).
+mode_indicators = {}
 
 # Script options.
 vimode_settings = {
     'no_warn': ("off", ("don't warn about problematic keybindings and "
                         "tmux/screen")),
     'copy_clipboard_cmd': ("xclip -selection c",
-                           ("command used to copy to clipboard; must read "
-                            "input from stdin")),
+                           ("command used to copy to clipboard, run with "
+                            "the shell; must read input from stdin")),
     'paste_clipboard_cmd': ("xclip -selection c -o",
-                            ("command used to paste clipboard; must output "
-                             "content to stdout")),
+                            ("command used to paste clipboard, run with "
+                             "the shell; must output content to stdout")),
+    'unnamed_clipboard': ("yank", ("\"on\" makes the clipboard (the \"+ "
+                                   "register) the unnamed register, like "
+                                   "vim's clipboard=unnamedplus: yanks and "
+                                   "deletes without a register are copied "
+                                   "to the clipboard, and p/P without a "
+                                   "register paste from it; \"yank\" only "
+                                   "copies yanks to the clipboard; \"off\" "
+                                   "never does")),
+    'clipboard_cache_time': ("10", ("time in seconds during which text "
+                                    "copied to the clipboard is pasted from "
+                                    "memory, instead of running "
+                                    "paste_clipboard_cmd (0: always run it)")),
+    'registers_max_size': ("65536", ("maximum size of all registers, in "
+                                     "characters (0: no limit); the least "
+                                     "recently written ones are forgotten "
+                                     "first")),
+    'history_size': ("200", ("number of entries kept in the command-line "
+                             "and search histories (0: no limit)")),
+    'viminfo_path': ("%h/vimode/viminfo", ("file keeping the command-line "
+                                           "and search histories and the "
+                                           "registers (except \"+) across "
+                                           "restarts, \"%h\" being WeeChat's "
+                                           "home (empty: don't keep them)")),
+    'vimrc_path': ("%h/vimode/vimrc", ("file of nmap/nnoremap/imap/set lines "
+                                       "applied at startup (see :source), "
+                                       "\"%h\" being WeeChat's home (empty: "
+                                       "none)")),
+    'clipboard': ("process", ("how to reach the clipboard: \"process\" runs "
+                              "copy_clipboard_cmd/paste_clipboard_cmd for "
+                              "each yank/paste, \"helper\" runs them from a "
+                              "helper process started once, \"osc52\" "
+                              "copies through the terminal's OSC 52 escape "
+                              "sequence (pasting still uses "
+                              "paste_clipboard_cmd)")),
     'imap_esc': ("", ("use alternate mapping to enter Normal mode while in "
                       "Insert mode; having it set to 'jk' is similar to "
                       "`:imap jk <Esc>` in vim")),
@@ -109,6 +144,10 @@ vimode_settings = {
                                   "Normal mode")),
     'imap_esc_timeout': ("1000", ("time in ms to wait for the imap_esc "
                                   "sequence to complete")),
+    'timeoutlen': ("1000", ("time in ms to wait for a mapped key sequence to "
+                            "complete when it's also the start of a longer "
+                            "one (e.g. `:nmap g ...` next to the default "
+                            "`gg`)")),
     'search_vim': ("off", ("allow n/N usage after searching (requires an extra"
                            " <Enter> to return to normal mode)")),
     'user_mappings': ("", ("see the `:nmap` command in the README for more "
@@ -147,7 +186,27 @@ vimode_settings = {
                                         "in Search mode")),
     'line_number_prefix': ("", "prefix for line numbers"),
     'line_number_suffix': (" ", "suffix for line numbers"),
-    'is_keyword': ("a-zA-Z0-9_À-ÿ", "characters recognized as part of a word")
+    'line_numbers_mode': ("screen", ("what the line numbers count: \"screen\""
+                                     " (rows of the window), \"absolute\" "
+                                     "(lines of the buffer) or \"relative\" "
+                                     "(lines above the bottom of the window); "
+                                     "with \"absolute\" and \"relative\", "
+                                     "{N}G and :N go to line N of the "
+                                     "buffer")),
+    'undo_max_size': ("65536", ("maximum size of the undo history of a "
+                                "buffer, in characters (0: no limit); the "
+                                "oldest changes are forgotten first")),
+    'undo_max_size_total': ("1048576", ("maximum size of the undo history of "
+                                        "all buffers, in characters (0: no "
+                                        "limit)")),
+    'max_buffer_states': ("0", ("maximum number of buffers the script keeps "
+                                "state for (mode, undo history, etc.); the "
+                                "least recently used ones are forgotten "
+                                "first (0: no limit)")),
+    'is_keyword': ("a-zA-Z0-9_À-ÿ",
+                   ("characters recognized as part of a word, either in vim's "
+                    "'iskeyword' format (e.g. \"@,48-57,_,192-255\") or as a "
+                    "regex character class (e.g. \"a-zA-Z0-9_À-ÿ\")"))
 }
 
 
@@ -157,11 +216,28 @@ vimode_settings = {
 WHITESPACE = re.compile(r"\s")
 REGEX_MOTION_UPPERCASE_W = re.compile(r"(?<=\s)\S")
 REGEX_MOTION_UPPERCASE_E = re.compile(r"\S(?!\S)")
-REGEX_MOTION_UPPERCASE_B = REGEX_MOTION_UPPERCASE_E
-REGEX_MOTION_G_UPPERCASE_E = REGEX_MOTION_UPPERCASE_W
+# Backward motions, see `LineIndex`.
+REGEX_MOTION_UPPERCASE_B = re.compile(r"(?<!\S)\S")
+REGEX_MOTION_G_UPPERCASE_E = re.compile(r"\S(?=\s)")
 REGEX_MOTION_CARRET = re.compile(r"\S")
 REGEX_INT = r"[0-9]"
-keyword_regexes = {}  # Loaded on runtime (uses the is_keyword config option).
+# :s/pattern/replacement/flags count, see `parse_substitute()`.
+REGEX_SUBSTITUTE = re.compile(r"s/((?:[^\\/]|\\.)*)"
+                              r"(?:/((?:[^\\/]|\\.)*)"
+                              r"(?:/([giI]*)\s*(\d*))?)?$", re.DOTALL)
+# Escaped characters and "&" in :s replacements, see `convert_replacement()`.
+REGEX_SUBSTITUTE_REPL = re.compile(r"\\(.)|&", re.DOTALL)
+# Registers that can be given with "x, see `write_register()`.
+REGISTER_NAMES = ('"0123456789abcdefghijklmnopqrstuvwxyz'
+                  'ABCDEFGHIJKLMNOPQRSTUVWXYZ-+*_')
+# A part of the is_keyword option in vim's 'iskeyword' format, e.g. "48-57",
+# "_" or "^a-z" (see `KeywordClasses`).
+REGEX_IS_KEYWORD_PART = re.compile(r"^(\^)?(@-@|@|\d+|.)(?:-(\d+|.))?$")
+
+# Character classes (see `KeywordClasses`).
+CLASS_BLANK, CLASS_PUNCTUATION, CLASS_KEYWORD = range(3)
+# Where word motions stop (see `LineIndex.get_word_stops()`).
+STOPS_WORD_START, STOPS_WORD_END, STOPS_IW_START, STOPS_IW_END = range(4)
 REGEX_MAP_KEYS_1 = {
     re.compile("<([^>]*-)Left>", re.IGNORECASE): '<\\1\x01[[D>',
     re.compile("<([^>]*-)Right>", re.IGNORECASE): '<\\1\x01[[C>',
@@ -179,6 +255,13 @@ REGEX_MAP_KEYS_2 = {
     re.compile(r"<M-([^>]*)>", re.IGNORECASE): '\x01[\\1'
 }
 
+# Regexes used to parse user mappings (see `UMParser`).
+REGEX_UM_CR = re.compile("<cr>", re.IGNORECASE)
+REGEX_UM_COUNT = re.compile("[1-9][0-9]*")
+REGEX_UM_COUNT_TAG = re.compile(r"#{(\d+)}")
+REGEX_UM_INSERT_END = re.compile("<(cr|esc)>", re.IGNORECASE)
+REGEX_UM_COMMAND = re.compile("^[:/](.*?)<(CR|cr)>")
+
 # Regex used to detect problematic keybindings.
 # For example: meta-wmeta-s is bound by default to ``/window swap``.
 #    If the user pressed Esc-w, WeeChat will detect it as meta-w and will not
@@ -209,7 +292,10 @@ def add_mapping(args, which):
     """
     args = args.lstrip()
     if not args:
-        mappings = vimode_settings[which.value]
+        mappings = dict(vimode_settings[which.value])
+        for lhs, (option, rhs, _) in vimrc_mappings.items():
+            if option == which.value:
+                mappings[lhs] = rhs
         if mappings:
             cmd = ':nnoremap' if which == Mapping.NON_RECURSIVE else ':nmap'
             title = "----- Vimode User Mappings ({}) -----".format(cmd)
@@ -241,23 +327,32 @@ def add_mapping(args, which):
     elif " " not in args:
         weechat.prnt("", "nmap syntax -> :nmap {lhs} {rhs}")
     else:
-        key, mapping = args.split(" ", 1)
-        # First pass of replacements. We perform two passes as a simple way to
-        # avoid incorrect replacements due to dictionaries not being
-        # insertion-ordered prior to Python 3.7.
-        for regex, repl in REGEX_MAP_KEYS_1.items():
+        key, mapping = parse_mapping(args)
+        apply_option_changes([(which.value, key, mapping)])
+
+def parse_mapping(args):
+    """Split the `{lhs} {rhs}` args of `:nmap` and translate their vim-like
+    key codes (see `add_mapping()`).
+
+    Returns:
+        tuple: (lhs, rhs)
+    """
+    key, mapping = args.split(" ", 1)
+    # First pass of replacements. We perform two passes as a simple way to
+    # avoid incorrect replacements due to dictionaries not being
+    # insertion-ordered prior to Python 3.7.
+    for regex, repl in REGEX_MAP_KEYS_1.items():
+        key = regex.sub(repl, key)
+        mapping = regex.sub(repl, mapping)
+    # Second pass of replacements.
+    for regex, repl in REGEX_MAP_KEYS_2.items():
+        if '\\U' in repl:  # Hack, but works well for our simple case.
+            repl = repl.replace('\\U', '\\')
+            key = regex.sub(lambda pat: pat.expand(repl).lower(), key)
+        else:
             key = regex.sub(repl, key)
-            mapping = regex.sub(repl, mapping)
-        # Second pass of replacements.
-        for regex, repl in REGEX_MAP_KEYS_2.items():
-            if '\\U' in repl:  # Hack, but works well for our simple case.
-                repl = repl.replace('\\U', '\\')
-                key = regex.sub(lambda pat: pat.expand(repl).lower(), key)
-            else:
-                key = regex.sub(repl, key)
-            mapping = regex.sub(repl, mapping)
-        vimode_settings[which.value][key] = mapping
-        weechat.config_set_plugin(which.value, json.dumps(vimode_settings[which.value]))
+        mapping = regex.sub(repl, mapping)
+    return key, mapping
 
 def cmd_nmap(args):
     """Add a user-defined key mapping."""
@@ -267,6 +362,18 @@ def cmd_nnoremap(args):
     """Add a user-defined key mapping, without following user mappings."""
     add_mapping(args, Mapping.NON_RECURSIVE)
 
+def cmd_source(args):
+    """Apply the mappings and options set by a vimrc file.
+
+    See Also:
+        `source_vimrc()`.
+    """
+    path = args.strip() or vimode_settings['vimrc_path']
+    if not path:
+        weechat.prnt("", "source syntax -> :source {file}")
+    else:
+        source_vimrc(path)
+
 def cmd_nunmap(args):
     """Remove a user-defined key mapping.
 
@@ -286,22 +393,18 @@ def cmd_nunmap(args):
                 key = regex.sub(lambda pat: pat.expand(repl).upper(), key)
             else:
                 key = regex.sub(repl, key)
-        found = False
+        # Until the file is sourced again.
+        found = vimrc_mappings.pop(key, None) is not None
         for setting in ['user_mappings', 'user_mappings_noremap']:
             mappings = vimode_settings[setting]
             if key in mappings:
                 found = True
                 del mappings[key]
-                del VI_KEYS[key]
-
-                # restore default keys
-                if key in VI_DEFAULT_KEYS:
-                    VI_KEYS[key] = VI_DEFAULT_KEYS[key]
-
-                weechat.config_set_plugin(setting, json.dumps(mappings))
-                vimode_settings[setting] = mappings
+                write_option(setting)
         if not found:
             weechat.prnt("", "nunmap: No such mapping")
+        else:
+            update_user_mapping(key)
 
 # See Also: `cb_exec_cmd()`.
 VI_COMMAND_GROUPS = {('h', 'help'): "/help",
@@ -317,18 +420,37 @@ VI_COMMAND_GROUPS = {('h', 'help'): "/help",
                      ('vs', 'vsplit'): "/window splitv",
                      ('nm', 'nmap'): cmd_nmap,
                      ('nn', 'nnoremap'): cmd_nnoremap,
-                     ('nun', 'nunmap'): cmd_nunmap}
+                     ('nun', 'nunmap'): cmd_nunmap,
+                     ('so', 'source'): cmd_source}
 
 VI_COMMANDS = dict()
 for T, v in VI_COMMAND_GROUPS.items():
     VI_COMMANDS.update(dict.fromkeys(T, v))
 
+# Addresses in ex ranges: a line number, "." (the current line) or "$" (the
+# last line), followed by offsets (e.g. "+3" or "-"). See `resolve_address()`.
+EX_ADDRESS = r"(?:\d+|[.$])(?:[+-]\d*)*|(?:[+-]\d*)+"
+REGEX_EX_OFFSET = re.compile(r"[+-]\d*")
+# Ex commands: [range][name][!][count] [args], see `parse_ex_command()`. The
+# names of our vi commands come first, longest first, so that e.g. "b2" is
+# "b" with a count of 2 while "bar" is a WeeChat command.
+REGEX_EX_COMMAND = re.compile(
+    r"\s*(?P<range>%|(?P<start>{address})?(?:,(?P<end>{address}))?)"
+    r"\s*(?P<name>s(?=/)|!|(?:{names})(?![A-Za-z])|[A-Za-z][\w.-]*)?"
+    r"(?P<bang>!)?(?P<count>\d+)?\s*(?P<args>.*)$".format(
+        address=EX_ADDRESS,
+        names="|".join(re.escape(name) for name in sorted(VI_COMMANDS,
+                                                          key=len,
+                                                          reverse=True))),
+    re.DOTALL)
+
 
 # Vi operators.
 # -------------
 
 # Each operator must have a corresponding function, called "operator_X" where
-# X is the operator. For example: `operator_c()`.
+# X is the operator. For example: `operator_c()`. The functions are looked up
+# once, when the dispatch table is built (see `register_operator()`).
 VI_OPERATORS = ["c", "d", "y"]
 
 
@@ -336,18 +458,458 @@ VI_OPERATORS = ["c", "d", "y"]
 # -----------
 
 # Vi motions. Each motion must have a corresponding function, called
-# "motion_X" where X is the motion (e.g. `motion_w()`).
+# "motion_X" where X is the motion (e.g. `motion_w()`). The functions are
+# looked up once, when the dispatch table is built (see `register_motion()`).
 # See Also: `SPECIAL_CHARS`.
 VI_MOTIONS = ["w", "e", "b", "^", "$", "h", "l", "W", "E", "B", "f", "F", "t",
               "T", "ge", "gE", "0", "iw"]
 
 # Special characters for motions. The corresponding function's name is
-# converted before calling. For example, "^" will call `motion_carret` instead
+# converted when registering. For example, "^" will use `motion_carret` instead
 # of `motion_^` (which isn't allowed because of illegal characters).
 SPECIAL_CHARS = {'^': "carret",
                  '$': "dollar"}
 
 
+# Buffer states.
+# ==============
+
+# Everything the script knows about a buffer is held in its `BufferState`.
+# States are forgotten when their buffer is closed, since WeeChat reuses the
+# pointers of closed buffers, and the least recently used ones can be capped
+# with the max_buffer_states option.
+
+class BufferState(object):
+    """What the script keeps about a buffer.
+
+    Attributes:
+        mode (str): one of INSERT, NORMAL, REPLACE, COMMAND or SEARCH. SEARCH
+            is only used if search_vim is enabled.
+        input_line (InputLine): mirror of the input line.
+        undo (UndoTree): undo history of the input line.
+        cmd_backup (tuple): (input_line, cur) saved when going into COMMAND
+            mode, restored when leaving it.
+        key_parser (KeyParser): keys pending in Normal mode.
+    """
+    __slots__ = ("mode", "input_line", "undo", "cmd_backup", "key_parser")
+
+    def __init__(self):
+        self.mode = "INSERT"
+        self.input_line = InputLine()
+        self.undo = UndoTree()
+        self.cmd_backup = None
+        self.key_parser = KeyParser()
+
+    def get_size(self):
+        """Return an estimate of the memory used by the state, in bytes."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.input_line)
+        if self.input_line.text is not None:
+            size += sys.getsizeof(self.input_line.text)
+        if self.cmd_backup is not None:
+            size += sys.getsizeof(self.cmd_backup[0])
+        size += sys.getsizeof(self.key_parser) + self.undo.get_size()
+        return size
+
+# {buf: BufferState}, least recently used first.
+buffer_states = OrderedDict()
+
+def get_buffer_state(buf):
+    """Return the `BufferState` of `buf`, created if needed.
+
+    If there are more states than the max_buffer_states option allows, the
+    least recently used ones are forgotten.
+    """
+    state = buffer_states.pop(buf, None)
+    if state is None:
+        state = BufferState()
+        max_states = get_limit_option('max_buffer_states')
+        while max_states and len(buffer_states) >= max_states:
+            forget_buffer_state(buffer_states.popitem(last=False)[1])
+    buffer_states[buf] = state
+    return state
+
+def drop_buffer_state(buf):
+    """Forget the state of `buf` (e.g. once it's closed)."""
+    state = buffer_states.pop(buf, None)
+    if state is not None:
+        forget_buffer_state(state)
+
+def forget_buffer_state(state):
+    """Release what a forgotten `state` accounted for."""
+    global undo_size
+    undo_size -= state.undo.size
+
+def get_mode():
+    """Return the mode of the current buffer."""
+    return get_buffer_state(get_current_buffer()).mode
+
+def get_key_parser():
+    """Return the `KeyParser` of the current buffer."""
+    return get_buffer_state(get_current_buffer()).key_parser
+
+def get_limit_option(option):
+    """Return the value of a size/count limit option, 0 (no limit) if it's
+    invalid."""
+    try:
+        return max(int(vimode_settings[option]), 0)
+    except ValueError:
+        return 0
+
+
+# Input line edits.
+# =================
+
+# The script keeps a mirror of each buffer's input line (see `InputLine`),
+# kept up to date with WeeChat's input signals, so that key handlers read
+# local state instead of copying the input out of WeeChat on every key.
+# Edits to the input line are collected while a WeeChat callback runs, and
+# written back once it returns. However many operators, keys and mode changes
+# take part in a key event, WeeChat then gets at most one buffer_set for the
+# input's content and one for the cursor's position, and none if they didn't
+# actually change.
+
+class InputLine(object):
+    """Mirror of a buffer's input line, as WeeChat holds it.
+
+    Attributes are None while they're unknown, i.e. not read yet or changed
+    by something else than the script (see `cb_input_changed()`). They're read
+    from WeeChat again when needed.
+    """
+    __slots__ = ("text", "pos")
+
+    def __init__(self):
+        self.text = None
+        self.pos = None
+
+class EditTransaction(object):
+    """Input line edits pending until the end of the current callback.
+
+    Attributes:
+        depth (int): nesting level of `edit_transaction()` callbacks. Edits
+            are only collected when it's positive.
+        buffers (dict): {buf: [input_line, cur]}, None for the values that
+            weren't edited.
+    """
+    __slots__ = ("depth", "buffers")
+
+    def __init__(self):
+        self.depth = 0
+        self.buffers = {}
+
+    def entry(self, buf):
+        """Return the edits for `buf`."""
+        entry = self.buffers.get(buf)
+        if entry is None:
+            entry = self.buffers[buf] = [None, None]
+        return entry
+
+edits = EditTransaction()
+# Pointer to the current buffer, None if unknown. See `get_current_buffer()`.
+current_buf = None
+# Bar items to refresh once the current callback returns.
+dirty_bar_items = set()
+# True while the script writes to the input line, so that the signals sent by
+# WeeChat in return are ignored.
+writing_input = False
+
+def get_current_buffer():
+    """Return the pointer to the current buffer."""
+    global current_buf
+    if current_buf is None:
+        current_buf = weechat.current_buffer()
+    return current_buf
+
+def get_input_line(buf):
+    """Return the `InputLine` mirror for `buf`."""
+    return get_buffer_state(buf).input_line
+
+def get_input(buf):
+    """Return the content of the input line, pending edits included."""
+    if edits.depth:
+        entry = edits.buffers.get(buf)
+        if entry is not None and entry[0] is not None:
+            return entry[0]
+    line = get_input_line(buf)
+    if line.text is None:
+        line.text = weechat.buffer_get_string(buf, "input")
+    return line.text
+
+def get_cur(buf):
+    """Return the cursor's position, pending edits included."""
+    input_line = None
+    if edits.depth:
+        entry = edits.buffers.get(buf)
+        if entry is not None:
+            if entry[1] is not None:
+                return entry[1]
+            input_line = entry[0]
+    line = get_input_line(buf)
+    if line.pos is None:
+        line.pos = weechat.buffer_get_integer(buf, "input_pos")
+    # WeeChat moves the cursor back if it's past the end of a new input.
+    if input_line is not None:
+        return min(line.pos, len(input_line))
+    return line.pos
+
+def get_input_state(buf):
+    """Return the (input line, cursor position) of `buf`, pending edits
+    included: the same as `get_input()` and `get_cur()`, with one lookup."""
+    if edits.depth:
+        entry = edits.buffers.get(buf)
+        if entry is not None and None not in entry:
+            return entry[0], entry[1]
+    return get_input(buf), get_cur(buf)
+
+def set_input(buf, input_line):
+    """Set the content of the input line."""
+    if not edits.depth:
+        write_input(buf, input_line, None)
+        return
+    entry = edits.entry(buf)
+    entry[0] = input_line
+    if entry[1] is not None:
+        entry[1] = min(entry[1], len(input_line))
+
+def set_pos(buf, pos):
+    """Set the cursor's position. See `set_cur()`."""
+    # Like WeeChat, ignore negative positions.
+    if pos < 0:
+        return
+    if not edits.depth:
+        write_input(buf, None, pos)
+        return
+    entry = edits.entry(buf)
+    if entry[0] is not None:
+        pos = min(pos, len(entry[0]))
+    entry[1] = pos
+
+def write_input(buf, input_line, cur):
+    """Write the input line and/or cursor to WeeChat, if they changed.
+
+    Args:
+        input_line (str): the new input line, or None to keep it.
+        cur (int): the new cursor position, or None to keep it.
+    """
+    global writing_input
+    line = get_input_line(buf)
+    writing_input = True
+    try:
+        if input_line is not None and input_line != line.text:
+            weechat.buffer_set(buf, "input", input_line)
+            line.text = input_line
+            if line.pos is not None:
+                line.pos = min(line.pos, len(input_line))
+        if cur is not None and cur != line.pos:
+            weechat.buffer_set(buf, "input_pos", str(cur))
+            # WeeChat caps the position to the input's length.
+            if line.text is not None:
+                line.pos = min(cur, len(line.text))
+            else:
+                line.pos = None
+    finally:
+        writing_input = False
+
+def flush_edits():
+    """Write the pending edits to WeeChat."""
+    buffers = edits.buffers
+    if not buffers:
+        return
+    edits.buffers = {}
+    for buf, (input_line, cur) in buffers.items():
+        write_input(buf, input_line, cur)
+
+def update_bar_item(name):
+    """Refresh one of our bar items, at most once per callback.
+
+    Inside an `edit_transaction()` callback, the item is only marked as dirty
+    and refreshed once the callback returns.
+    """
+    if edits.depth:
+        dirty_bar_items.add(name)
+    else:
+        weechat.bar_item_update(name)
+
+def flush_bar_items():
+    """Refresh the bar items marked as dirty."""
+    while dirty_bar_items:
+        weechat.bar_item_update(dirty_bar_items.pop())
+
+def run_command(buf, command):
+    """Run a WeeChat command, once the pending edits are written.
+
+    Commands such as ``/input delete_line`` act on WeeChat's copy of the input
+    line, so it has to be up to date first (and is read again afterwards).
+    """
+    flush_edits()
+    weechat.command(buf, command)
+
+def edit_transaction(func):
+    """Decorator for WeeChat callbacks, batching their input line edits and
+    bar item refreshes.
+
+    Nested calls are part of the outermost transaction.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        edits.depth += 1
+        calls = api_stats['calls']
+        try:
+            return func(*args)
+        finally:
+            edits.depth -= 1
+            if not edits.depth:
+                flush_edits()
+                flush_bar_items()
+                if api_counter is not None:
+                    record_api_calls(func.__name__, calls)
+    return wrapper
+
+# Debugging.
+# ----------
+
+# API calls made by callbacks, enabled with ``/vimode stats on``.
+# See `cb_vimode_cmd()`.
+api_stats = {'calls': 0, 'events': 0, 'total': 0, 'max': 0, 'last': 0,
+             'last_event': ""}
+api_counter = None
+
+class APICounter(object):
+    """Proxy for the weechat module, counting calls to its functions.
+
+    While counting is enabled, the global `weechat` name is bound to an
+    instance of this class instead of the module itself.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        value = getattr(self.module, name)
+        if callable(value):
+            func = value
+
+            def value(*args):
+                api_stats['calls'] += 1
+                return func(*args)
+        # Cache the attribute, so that `__getattr__` is only used once.
+        setattr(self, name, value)
+        return value
+
+def record_api_calls(event, calls_before):
+    """Record the API calls made by an `edit_transaction()` callback."""
+    calls = api_stats['calls'] - calls_before
+    api_stats['events'] += 1
+    api_stats['total'] += calls
+    api_stats['last'] = calls
+    api_stats['last_event'] = event
+    api_stats['max'] = max(api_stats['max'], calls)
+
+
+# Deferred tasks.
+# ===============
+
+# Callbacks that need to run a bit later (e.g. to check whether Esc was
+# pressed on its own) are queued in `scheduler` rather than getting a WeeChat
+# timer each. A single timer is armed for the earliest task.
+
+class Scheduler(object):
+    """Priority queue of deferred callbacks, run from a single WeeChat timer.
+
+    Tasks are [deadline, sequence, key, func, data] lists, where `func` is
+    None once the task is cancelled (it's then skipped when popped).
+
+    Attributes:
+        tasks_run (int): number of tasks run so far, see ``/vimode stats``.
+    """
+    __slots__ = ("queue", "keys", "timer", "deadline", "sequence",
+                 "tasks_run")
+
+    def __init__(self):
+        self.queue = []
+        # {key: task}, for de-duplication and cancellation.
+        self.keys = {}
+        self.timer = None
+        self.deadline = None
+        self.sequence = 0
+        self.tasks_run = 0
+
+    def schedule(self, delay, key, func, data=""):
+        """Call `func(data, 0)` in `delay` ms.
+
+        The callback's signature is the same as a WeeChat timer callback's.
+
+        Args:
+            delay (int): delay in ms.
+            key (str): a pending task with the same key is cancelled, so that
+                only the latest one runs. None if the task can't be replaced.
+            func (callable): the function to call.
+            data (str, optional): passed to `func`. Defaults to "".
+        """
+        if key is not None:
+            self.cancel(key)
+        self.sequence += 1
+        task = [time.time() + delay / 1000.0, self.sequence, key, func, data]
+        heapq.heappush(self.queue, task)
+        if key is not None:
+            self.keys[key] = task
+        self.arm()
+
+    def cancel(self, key):
+        """Cancel the pending task with the given key, if any."""
+        task = self.keys.pop(key, None)
+        if task is not None:
+            task[3] = None
+
+    def pending(self):
+        """Return the number of pending tasks."""
+        return sum(1 for task in self.queue if task[3] is not None)
+
+    def arm(self):
+        """Make sure the timer fires in time for the earliest task."""
+        queue = self.queue
+        while queue and queue[0][3] is None:
+            heapq.heappop(queue)
+        if not queue:
+            if self.timer is not None:
+                weechat.unhook(self.timer)
+                self.timer = None
+            return
+        deadline = queue[0][0]
+        if self.timer is not None:
+            if self.deadline <= deadline:
+                return
+            weechat.unhook(self.timer)
+        delay = max(1, int(math.ceil((deadline - time.time()) * 1000)))
+        self.deadline = deadline
+        self.timer = weechat.hook_timer(delay, 0, 1, "cb_run_scheduled_tasks",
+                                        "")
+
+    def run(self):
+        """Run the tasks that are due, then re-arm the timer."""
+        self.timer = None
+        queue = self.queue
+        # Allow for the timer's precision (WeeChat timers have a 1ms
+        # granularity).
+        now = time.time() + 0.001
+        while queue and queue[0][0] <= now:
+            _, _, key, func, data = heapq.heappop(queue)
+            if func is None:
+                continue
+            if key is not None:
+                del self.keys[key]
+            self.tasks_run += 1
+            func(data, 0)
+        self.arm()
+
+scheduler = Scheduler()
+
+@edit_transaction
+def cb_run_scheduled_tasks(data, remaining_calls):
+    """Run the due tasks, see `Scheduler`."""
+    scheduler.run()
+    return weechat.WEECHAT_RC_OK
+
+
 # Methods for vi operators, motions and key bindings.
 # ===================================================
 
@@ -368,7 +930,7 @@ def operator_base(buf, input_line, pos1, pos2, overwrite):
 
     Notes:
         Should be called "operator_X", where X is the operator, and defined in
-        `VI_OPERATORS`.
+        `VI_OPERATORS`, or registered with `register_operator()`.
         Must perform actions (e.g. modifying the input line) on its own,
         using the WeeChat API.
 
@@ -401,7 +963,7 @@ def motion_base(input_line, cur, count):
 
     Notes:
         Should be called "motion_X", where X is the motion, and defined in
-        `VI_MOTIONS`.
+        `VI_MOTIONS`, or registered with `register_motion()`.
         Must not modify the input line directly.
 
     See Also:
@@ -452,10 +1014,10 @@ def operator_d(buf, input_line, pos1, pos2, overwrite=False):
     end = max(pos1, pos2)
     if overwrite:
         end += 1
-    input_line = list(input_line)
-    del input_line[start:end]
-    input_line = "".join(input_line)
-    weechat.buffer_set(buf, "input", input_line)
+    if start < end:
+        write_register(get_register(), input_line[start:end], deleted=True)
+    input_line = input_line[:start] + input_line[end:]
+    set_input(buf, input_line)
     set_cur(buf, input_line, pos2)
 
 def operator_c(buf, input_line, pos1, pos2, overwrite=False):
@@ -479,12 +1041,7 @@ def operator_y(buf, input_line, pos1, pos2, _):
     """
     start = min(pos1, pos2)
     end = max(pos1, pos2)
-    cmd = vimode_settings['copy_clipboard_cmd']
-    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-    if sys.version_info > (3,):
-        proc.communicate(input=input_line[start:end].encode())
-    else:
-        proc.communicate(input=input_line[start:end])
+    write_register(get_register(), input_line[start:end])
 
 
 # Motions:
@@ -504,10 +1061,10 @@ def motion_w(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, keyword_regexes['w'], cur, True, count)
+    pos = get_line_index(input_line).next(STOPS_WORD_START, cur, count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, False, False
+    return cur, pos, False, False
 
 def motion_W(input_line, cur, count):
     """Go `count` WORDS forward and return position.
@@ -515,10 +1072,10 @@ def motion_W(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, REGEX_MOTION_UPPERCASE_W, cur, True, count)
+    pos = get_line_index(input_line).next(REGEX_MOTION_UPPERCASE_W, cur, count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, False, False
+    return cur, pos, False, False
 
 def motion_e(input_line, cur, count):
     """Go to the end of `count` words and return position.
@@ -526,10 +1083,10 @@ def motion_e(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, keyword_regexes['e'], cur, True, count)
+    pos = get_line_index(input_line).next(STOPS_WORD_END, cur, count)
     if pos == -1:
         return cur, len(input_line), True, False
-    return cur, cur + pos, True, False
+    return cur, pos, True, False
 
 def motion_E(input_line, cur, count):
     """Go to the end of `count` WORDS and return cusor position.
@@ -537,10 +1094,10 @@ def motion_E(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos = get_pos(input_line, REGEX_MOTION_UPPERCASE_E, cur, True, count)
+    pos = get_line_index(input_line).next(REGEX_MOTION_UPPERCASE_E, cur, count)
     if pos == -1:
         return cur, len(input_line), False, False
-    return cur, cur + pos, True, False
+    return cur, pos, True, False
 
 def motion_b(input_line, cur, count):
     """Go `count` words backwards and return position.
@@ -548,9 +1105,7 @@ def motion_b(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    # "b" is just "e" on inverted data (e.g. "olleH" instead of "Hello").
-    pos_inv = motion_e(input_line[::-1], len(input_line) - cur - 1, count)[1]
-    pos = len(input_line) - pos_inv - 1
+    pos = get_line_index(input_line).previous(STOPS_WORD_START, cur, count)
     return cur, max(0, pos), True, False
 
 def motion_B(input_line, cur, count):
@@ -559,12 +1114,10 @@ def motion_B(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    new_cur = len(input_line) - cur
-    pos = get_pos(input_line[::-1], REGEX_MOTION_UPPERCASE_B, new_cur,
-                  count=count)
+    pos = get_line_index(input_line).previous(REGEX_MOTION_UPPERCASE_B, cur,
+                                              count)
     if pos == -1:
         return cur, 0, False, False
-    pos = len(input_line) - (pos + new_cur + 1)
     return cur, pos, True, False
 
 def motion_ge(input_line, cur, count):
@@ -573,9 +1126,7 @@ def motion_ge(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    # "ge is just "w" on inverted data (e.g. "olleH" instead of "Hello").
-    pos_inv = motion_w(input_line[::-1], len(input_line) - cur - 1, count)[1]
-    pos = len(input_line) - pos_inv - 1
+    pos = get_line_index(input_line).previous(STOPS_WORD_END, cur, count)
     return cur, pos, True, False
 
 def motion_gE(input_line, cur, count):
@@ -584,12 +1135,10 @@ def motion_gE(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    new_cur = len(input_line) - cur - 1
-    pos = get_pos(input_line[::-1], REGEX_MOTION_G_UPPERCASE_E, new_cur,
-                  True, count)
+    pos = get_line_index(input_line).previous(REGEX_MOTION_G_UPPERCASE_E, cur,
+                                              count)
     if pos == -1:
         return cur, 0, False, False
-    pos = len(input_line) - (pos + new_cur + 1)
     return cur, pos, True, False
 
 def motion_h(input_line, cur, count):
@@ -632,11 +1181,13 @@ def motion_iw(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    pos_inv = get_pos(input_line[::-1], keyword_regexes['iw'],
-                      len(input_line) - cur - 1, False, 1)
-    start_pos = cur - pos_inv
-    end_pos = start_pos + get_pos(input_line, keyword_regexes['iw'],
-                                  start_pos, False, count)
+    index = get_line_index(input_line)
+    start_pos = index.previous(STOPS_IW_START, cur + 1)
+    if start_pos == -1:
+        start_pos = cur + 1
+    end_pos = index.next(STOPS_IW_END, start_pos - 1, count)
+    if end_pos == -1:
+        end_pos = start_pos - 1
     return start_pos, end_pos, True, False
 
 def motion_f(input_line, cur, count):
@@ -645,7 +1196,7 @@ def motion_f(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    return start_catching_keys(1, "cb_motion_f", input_line, cur, count)
+    return start_catching_keys(1, cb_motion_f, input_line, cur, count)
 
 def cb_motion_f(update_last=True):
     """Callback for `motion_f()`.
@@ -661,13 +1212,12 @@ def cb_motion_f(update_last=True):
     """
     global last_search_motion
     pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'], re.escape(pattern),
-                  catching_keys_data['cur'], True,
-                  catching_keys_data['count'])
-    catching_keys_data['new_cur'] = max(0, pos) + catching_keys_data['cur']
+    cur = catching_keys_data['cur']
+    pos = get_line_index(catching_keys_data['input_line']).next(
+        pattern, cur, catching_keys_data['count'])
+    catching_keys_data['new_cur'] = cur if pos == -1 else pos
     if update_last:
         last_search_motion = {'motion': "f", 'data': pattern}
-    cb_key_combo_default(None, None, "")
 
 def motion_F(input_line, cur, count):
     """Go to `count`'th occurence of char to the right and return position.
@@ -675,7 +1225,7 @@ def motion_F(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    return start_catching_keys(1, "cb_motion_F", input_line, cur, count)
+    return start_catching_keys(1, cb_motion_F, input_line, cur, count)
 
 def cb_motion_F(update_last=True):
     """Callback for `motion_F()`.
@@ -691,16 +1241,12 @@ def cb_motion_F(update_last=True):
     """
     global last_search_motion
     pattern = catching_keys_data['keys']
-    cur = len(catching_keys_data['input_line']) - catching_keys_data['cur']
-    pos = get_pos(catching_keys_data['input_line'][::-1],
-                  re.escape(pattern),
-                  cur,
-                  False,
-                  catching_keys_data['count'])
-    catching_keys_data['new_cur'] = catching_keys_data['cur'] - max(0, pos + 1)
+    cur = catching_keys_data['cur']
+    pos = get_line_index(catching_keys_data['input_line']).previous(
+        pattern, cur - len(pattern) + 1, catching_keys_data['count'])
+    catching_keys_data['new_cur'] = cur if pos == -1 else pos
     if update_last:
         last_search_motion = {'motion': "F", 'data': pattern}
-    cb_key_combo_default(None, None, "")
 
 def motion_t(input_line, cur, count):
     """Go to `count`'th occurence of char and return position.
@@ -710,7 +1256,7 @@ def motion_t(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    return start_catching_keys(1, "cb_motion_t", input_line, cur, count)
+    return start_catching_keys(1, cb_motion_t, input_line, cur, count)
 
 def cb_motion_t(update_last=True):
     """Callback for `motion_t()`.
@@ -726,17 +1272,12 @@ def cb_motion_t(update_last=True):
     """
     global last_search_motion
     pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'], re.escape(pattern),
-                  catching_keys_data['cur'] + 1,
-                  True, catching_keys_data['count'])
-    pos += 1
-    if pos > 0:
-        catching_keys_data['new_cur'] = pos + catching_keys_data['cur'] - 1
-    else:
-        catching_keys_data['new_cur'] = catching_keys_data['cur']
+    cur = catching_keys_data['cur']
+    pos = get_line_index(catching_keys_data['input_line']).next(
+        pattern, cur + 1, catching_keys_data['count'])
+    catching_keys_data['new_cur'] = cur if pos == -1 else pos - 1
     if update_last:
         last_search_motion = {'motion': "t", 'data': pattern}
-    cb_key_combo_default(None, None, "")
 
 def motion_T(input_line, cur, count):
     """Go to `count`'th occurence of char to the left and return position.
@@ -747,7 +1288,7 @@ def motion_T(input_line, cur, count):
     See Also:
         `motion_base()`.
     """
-    return start_catching_keys(1, "cb_motion_T", input_line, cur, count)
+    return start_catching_keys(1, cb_motion_T, input_line, cur, count)
 
 def cb_motion_T(update_last=True):
     """Callback for `motion_T()`.
@@ -763,30 +1304,61 @@ def cb_motion_T(update_last=True):
     """
     global last_search_motion
     pattern = catching_keys_data['keys']
-    pos = get_pos(catching_keys_data['input_line'][::-1], re.escape(pattern),
-                  (len(catching_keys_data['input_line']) -
-                   (catching_keys_data['cur'] + 1)) + 1,
-                  True, catching_keys_data['count'])
-    pos += 1
-    if pos > 0:
-        catching_keys_data['new_cur'] = catching_keys_data['cur'] - pos + 1
-    else:
-        catching_keys_data['new_cur'] = catching_keys_data['cur']
+    cur = catching_keys_data['cur']
+    pos = get_line_index(catching_keys_data['input_line']).previous(
+        pattern, cur - len(pattern), catching_keys_data['count'])
+    catching_keys_data['new_cur'] = cur if pos == -1 else pos + len(pattern)
     if update_last:
         last_search_motion = {'motion': "T", 'data': pattern}
-    cb_key_combo_default(None, None, "")
 
 
 # Keys:
 # -----
 
+def key_x(buf, input_line, cur, count):
+    """Delete `count` characters under and after the cursor.
+
+    See Also:
+        `key_base()`.
+    """
+    delete_text(buf, input_line, cur, cur + max(count, 1))
+    set_cur(buf, get_input(buf), cur)
+
+def key_X(buf, input_line, cur, count):
+    """Delete `count` characters before the cursor.
+
+    See Also:
+        `key_base()`.
+    """
+    start = max(cur - max(count, 1), 0)
+    delete_text(buf, input_line, start, cur)
+    set_cur(buf, get_input(buf), start, False)
+
+def key_dd(buf, input_line, cur, count):
+    """Delete line.
+
+    See Also:
+        `key_base()`.
+    """
+    delete_text(buf, input_line, 0, len(input_line), True)
+    set_cur(buf, "", 0, False)
+
+def key_D(buf, input_line, cur, count):
+    """Delete from cursor to end of line.
+
+    See Also:
+        `key_base()`.
+    """
+    delete_text(buf, input_line, cur, len(input_line))
+    set_cur(buf, input_line[:cur], cur, False)
+
 def key_cc(buf, input_line, cur, count):
     """Delete line and start Insert mode.
 
     See Also:
         `key_base()`.
     """
-    weechat.command("", "/input delete_line")
+    key_dd(buf, input_line, cur, count)
     set_mode("INSERT")
 
 def key_C(buf, input_line, cur, count):
@@ -795,7 +1367,7 @@ def key_C(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    weechat.command("", "/input delete_end_of_line")
+    key_D(buf, input_line, cur, count)
     set_mode("INSERT")
 
 def key_yy(buf, input_line, cur, count):
@@ -804,35 +1376,33 @@ def key_yy(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    cmd = vimode_settings['copy_clipboard_cmd']
-    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
-    if sys.version_info > (3,):
-        proc.communicate(input=input_line.encode())
-    else:
-        proc.communicate(input=input_line)
+    write_register(get_register(), input_line, linewise=True)
 
 def key_p(buf, input_line, cur, count):
-    """Paste text.
+    """Put the text from a register after the cursor `count` times.
+
+    See Also:
+        `key_base()`.
+    """
+    put_register(buf, get_register(), count, False)
+
+def key_P(buf, input_line, cur, count):
+    """Put the text from a register before the cursor `count` times.
 
     See Also:
         `key_base()`.
     """
-    cmd = vimode_settings['paste_clipboard_cmd']
-    weechat.hook_process(cmd, 10 * 1000, "cb_key_p", weechat.current_buffer())
+    put_register(buf, get_register(), count, True)
 
+@edit_transaction
 def cb_key_p(data, command, return_code, output, err):
-    """Callback for fetching clipboard text and pasting it."""
-    buf = ""
-    this_buffer = data
-    if output != "":
-        buf += output.strip()
+    """Callback for fetching clipboard text and pasting it.
+
+    `data` is "<buf> <count> <before>", see `put_register()`.
+    """
     if return_code == 0:
-        my_input = weechat.buffer_get_string(this_buffer, "input")
-        pos = weechat.buffer_get_integer(this_buffer, "input_pos") + 1
-        my_input = my_input[:pos] + buf + my_input[pos:]
-        pos += len(buf)
-        weechat.buffer_set(this_buffer, "input", my_input)
-        weechat.buffer_set(this_buffer, "input_pos", str(pos))
+        buf, count, before = data.split(" ")
+        paste_clipboard_text(buf, output, int(count), before == "1")
     return weechat.WEECHAT_RC_OK
 
 def key_i(buf, input_line, cur, count):
@@ -877,12 +1447,14 @@ def key_G(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    if count > 0:
+    if count > 0 and get_line_numbers_mode() != "screen":
+        go_to_line(count)
+    elif count > 0:
         # This is necessary to prevent weird scroll jumps.
-        weechat.command("", "/window scroll_top")
-        weechat.command("", "/window scroll %s" % (count - 1))
+        run_command("", "/window scroll_top")
+        run_command("", "/window scroll %s" % (count - 1))
     else:
-        weechat.command("", "/window scroll_bottom")
+        run_command("", "/window scroll_bottom")
 
 def key_r(buf, input_line, cur, count):
     """Replace `count` characters under the cursor.
@@ -890,7 +1462,7 @@ def key_r(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    start_catching_keys(1, "cb_key_r", input_line, cur, count, buf)
+    start_catching_keys(1, cb_key_r, input_line, cur, count, buf)
 
 def cb_key_r():
     """Callback for `key_r()`.
@@ -907,7 +1479,7 @@ def cb_key_r():
             input_line[cur] = catching_keys_data['keys']
             cur += 1
         input_line = "".join(input_line)
-        weechat.buffer_set(catching_keys_data['buf'], "input", input_line)
+        set_input(catching_keys_data['buf'], input_line)
         set_cur(catching_keys_data['buf'], input_line, cur - 1)
     catching_keys_data = {'amount': 0}
 
@@ -932,7 +1504,7 @@ def key_tilda(buf, input_line, cur, count):
         count -= 1
         cur += 1
     input_line = "".join(input_line)
-    weechat.buffer_set(buf, "input", input_line)
+    set_input(buf, input_line)
     set_cur(buf, input_line, cur)
 
 def key_alt_j(buf, input_line, cur, count):
@@ -946,7 +1518,7 @@ def key_alt_j(buf, input_line, cur, count):
     If Esc isn't the last pressed key, \x01j<num> is directly received in
     key_combo_default.
     """
-    start_catching_keys(2, "cb_key_alt_j", input_line, cur, count)
+    start_catching_keys(2, cb_key_alt_j, input_line, cur, count)
 
 def cb_key_alt_j():
     """Callback for `key_alt_j()`.
@@ -955,7 +1527,7 @@ def cb_key_alt_j():
         `start_catching_keys()`.
     """
     global catching_keys_data
-    weechat.command("", "/buffer " + catching_keys_data['keys'])
+    run_command("", "/buffer " + catching_keys_data['keys'])
     catching_keys_data = {'amount': 0}
 
 def key_semicolon(buf, input_line, cur, count, swap=False):
@@ -968,7 +1540,7 @@ def key_semicolon(buf, input_line, cur, count, swap=False):
     See Also:
         `key_base()`.
     """
-    global catching_keys_data, vi_buffer
+    global catching_keys_data
     catching_keys_data = ({'amount': 0,
                            'input_line': input_line,
                            'cur': cur,
@@ -983,9 +1555,10 @@ def key_semicolon(buf, input_line, cur, count, swap=False):
         motion = last_search_motion['motion'].swapcase()
     else:
         motion = last_search_motion['motion']
-    func = "cb_motion_%s" % motion
-    vi_buffer = motion
-    globals()[func](False)
+    motion = VI_MOTION_ACTIONS[motion]
+    # The callback sets the new cursor position, which the motion then uses.
+    motion.callback(False)
+    do_motion(motion, buf, input_line, cur, count)
 
 def key_comma(buf, input_line, cur, count):
     """Repeat last f, t, F, T in opposite direction `count` times.
@@ -1001,16 +1574,8 @@ def key_u(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    buf = weechat.current_buffer()
-    if buf not in undo_history:
-        return
-    for _ in range(max(count, 1)):
-        if undo_history_index[buf] > -len(undo_history[buf]):
-            undo_history_index[buf] -= 1
-            input_line = undo_history[buf][undo_history_index[buf]]
-            weechat.buffer_set(buf, "input", input_line)
-        else:
-            break
+    tree = add_undo_history(buf, input_line)
+    undo_to(buf, tree, tree.get_undo_target(count))
 
 def key_ctrl_r(buf, input_line, cur, count):
     """Redo change `count` times.
@@ -1018,28 +1583,231 @@ def key_ctrl_r(buf, input_line, cur, count):
     See Also:
         `key_base()`.
     """
-    if buf not in undo_history:
-        return
-    for _ in range(max(count, 1)):
-        if undo_history_index[buf] < -1:
-            undo_history_index[buf] += 1
-            input_line = undo_history[buf][undo_history_index[buf]]
-            weechat.buffer_set(buf, "input", input_line)
-        else:
-            break
+    tree = add_undo_history(buf, input_line)
+    undo_to(buf, tree, tree.get_redo_target(count))
+
+def key_g_minus(buf, input_line, cur, count):
+    """Go to older text state `count` times, across undo branches.
+
+    See Also:
+        `key_base()`.
+    """
+    tree = add_undo_history(buf, input_line)
+    undo_to(buf, tree, tree.get_seq_target(-max(count, 1)))
+
+def key_g_plus(buf, input_line, cur, count):
+    """Go to newer text state `count` times, across undo branches.
+
+    See Also:
+        `key_base()`.
+    """
+    tree = add_undo_history(buf, input_line)
+    undo_to(buf, tree, tree.get_seq_target(max(count, 1)))
 
 
 # Vi key bindings.
 # ================
 
+# Key maps.
+# ---------
+
+class KeyTrie(object):
+    """Prefix tree mapping key sequences to values.
+
+    Each node is a dict of child nodes keyed by character. The value of a
+    complete key sequence is stored in its node under the `VALUE` key, which
+    can't clash with a character. Looking up a sequence costs O(len(keys)),
+    no matter how many sequences are stored.
+    """
+    VALUE = None
+
+    def __init__(self, items=()):
+        self.root = {}
+        self.size = 0
+        for keys, value in dict(items).items():
+            self[keys] = value
+
+    def node(self, keys):
+        """Return the node for `keys`, or None if no sequence starts with
+        it."""
+        node = self.root
+        for char in keys:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def has_longer(self, keys):
+        """Return True if sequences longer than `keys` start with `keys`."""
+        node = self.node(keys)
+        return node is not None and len(node) > (self.VALUE in node)
+
+    def longest_prefix(self, text):
+        """Return the longest stored sequence `text` starts with.
+
+        Returns:
+            tuple: (keys, value), or (None, None) if there's no match.
+        """
+        node = self.root
+        match = (None, None)
+        for index, char in enumerate(text):
+            node = node.get(char)
+            if node is None:
+                break
+            if self.VALUE in node:
+                match = (text[:index + 1], node[self.VALUE])
+        return match
+
+    def __getitem__(self, keys):
+        node = self.node(keys)
+        if node is None or self.VALUE not in node:
+            raise KeyError(keys)
+        return node[self.VALUE]
+
+    def __setitem__(self, keys, value):
+        node = self.root
+        for char in keys:
+            node = node.setdefault(char, {})
+        if self.VALUE not in node:
+            self.size += 1
+        node[self.VALUE] = value
+
+    def __delitem__(self, keys):
+        path = [self.root]
+        for char in keys:
+            node = path[-1].get(char)
+            if node is None:
+                raise KeyError(keys)
+            path.append(node)
+        if self.VALUE not in path[-1]:
+            raise KeyError(keys)
+        del path[-1][self.VALUE]
+        self.size -= 1
+        # Prune the nodes that no longer lead anywhere.
+        for index in range(len(keys), 0, -1):
+            if path[index]:
+                break
+            del path[index - 1][keys[index - 1]]
+
+    def __contains__(self, keys):
+        node = self.node(keys)
+        return node is not None and self.VALUE in node
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for keys, _ in self.items():
+            yield keys
+
+    def items(self):
+        """Yield (keys, value) for every stored sequence."""
+        stack = [("", self.root)]
+        while stack:
+            keys, node = stack.pop()
+            for char, child in node.items():
+                if char is self.VALUE:
+                    yield keys, child
+                else:
+                    stack.append((keys + char, child))
+
+
+class Keymap(object):
+    """Layered key map: immutable default keys with a user mappings overlay.
+
+    Lookups check the user layer first, so a user mapping shadows the default
+    key with the same sequence; deleting it brings the default back without
+    having to restore anything.
+
+    See Also:
+        `KeyTrie`.
+    """
+
+    def __init__(self, defaults):
+        self.defaults = KeyTrie(defaults)
+        self.user = KeyTrie()
+        # Called with the keys whenever a user mapping is added or removed.
+        self.on_change = None
+
+    def lookup(self, keys, noremap=False):
+        """Check how `keys` matches the key map.
+
+        Args:
+            keys (str): the pressed keys, without any count.
+            noremap (bool, optional): if True, user mappings are ignored.
+                Defaults to False.
+
+        Returns:
+            tuple: (value, partial). `value` is the command bound to `keys`
+                (None if `keys` isn't a complete sequence) and `partial` is
+                True if longer sequences start with `keys`.
+        """
+        value = None
+        partial = False
+        layers = (self.defaults,) if noremap else (self.defaults, self.user)
+        for layer in layers:
+            node = layer.node(keys)
+            if node is None:
+                continue
+            if KeyTrie.VALUE in node:
+                value = node[KeyTrie.VALUE]
+            partial = partial or len(node) > (KeyTrie.VALUE in node)
+        return value, partial
+
+    def longest_prefix(self, text, noremap=False):
+        """Return the longest (keys, value) sequence `text` starts with.
+
+        User mappings win over default keys of the same length.
+
+        See Also:
+            `KeyTrie.longest_prefix()`.
+        """
+        keys, value = self.defaults.longest_prefix(text)
+        if not noremap:
+            user_keys, user_value = self.user.longest_prefix(text)
+            if user_keys is not None and len(user_keys) >= len(keys or ""):
+                keys, value = user_keys, user_value
+        return keys, value
+
+    def __getitem__(self, keys):
+        if keys in self.user:
+            return self.user[keys]
+        return self.defaults[keys]
+
+    def __setitem__(self, keys, value):
+        self.user[keys] = value
+        if self.on_change is not None:
+            self.on_change(keys)
+
+    def __delitem__(self, keys):
+        del self.user[keys]
+        if self.on_change is not None:
+            self.on_change(keys)
+
+    def __contains__(self, keys):
+        return keys in self.user or keys in self.defaults
+
+    def __iter__(self):
+        for keys in self.user:
+            yield keys
+        for keys in self.defaults:
+            if keys not in self.user:
+                yield keys
+
+    def items(self):
+        """Yield (keys, value) for every key, user mappings first."""
+        for keys in self:
+            yield keys, self[keys]
+
+
 # String values will be executed as normal WeeChat commands.
 # For functions, see `key_base()` for reference.
 VI_DEFAULT_KEYS = {'G': key_G,
                    'gg': "/window scroll_top",
-                   'x': "/input delete_next_char",
-                   'X': "/input delete_previous_char",
-                   'dd': "/input delete_line",
-                   'D': "/input delete_end_of_line",
+                   'x': key_x,
+                   'X': key_X,
+                   'dd': key_dd,
+                   'D': key_D,
                    'cc': key_cc,
                    'S': key_cc,
                    'C': key_C,
@@ -1049,6 +1817,7 @@ VI_DEFAULT_KEYS = {'G': key_G,
                    'I': key_I,
                    'yy': key_yy,
                    'p': key_p,
+                   'P': key_P,
                    'gt': "/buffer -1",
                    'K': "/buffer -1",
                    'H': "/buffer -1",
@@ -1105,236 +1874,305 @@ VI_DEFAULT_KEYS = {'G': key_G,
                    ';': key_semicolon,
                    ',': key_comma,
                    'u': key_u,
-                   '\x01r': key_ctrl_r}
+                   '\x01r': key_ctrl_r,
+                   'g-': key_g_minus,
+                   'g+': key_g_plus}
 
 # Add alt-j<number> bindings.
 for i in range(10, 99):
     VI_DEFAULT_KEYS['\x01[j%s' % i] = "/buffer %s" % i
 
-# VI_DEFAULT_KEYS are kept in a separate data structure to ensure
-# that they can not be permenantly deleted by the `:nunmap` command.
-VI_KEYS = VI_DEFAULT_KEYS.copy()
+# VI_DEFAULT_KEYS are kept in a separate layer of the key map to ensure that
+# they can not be permenantly deleted by the `:nunmap` command.
+VI_KEYS = Keymap(VI_DEFAULT_KEYS)
+
+# Prefix tree of the motions, used to match them as keys are typed.
+VI_MOTIONS_TRIE = KeyTrie((motion, motion) for motion in VI_MOTIONS)
 
 class UMParser:
     """User Mapping Parser
 
-    Handles parsing for UserMapping class.
+    Handles parsing for UserMapping class. A mapping's rhs is parsed once into
+    a program: a list of (action, count, switches) steps, where each action
+    is a callable action(buf, input_line, cur, count), and `switches` tells
+    whether it may switch buffers (see `step_switches_buffers()`).
     """
     __metaclass__ = ABCMeta
 
-    @abstractproperty
-    def count(self):
-        """Required Attribute"""
-
     @abstractproperty
     def noremap(self):
         """Required Attribute"""
 
     def parse(self, vi_keys):
-        """Vi_Keys parser that generates callable actions.
+        """Vi_Keys parser that compiles a program of actions.
 
-        Yields:
-            Callable object: action(buf, input_line, cur, count)
+        The mode each action switches to is tracked while parsing, so that
+        text following an INSERT mode action (e.g. "i") is captured.
+        Parsing errors are collected in `self.bad_seq_list`, and the user
+        mappings the program depends on in `self.deps`.
+
+        Returns:
+            list: (action, count, switches) steps.
         """
+        self.count = 0
+        self.insert = False
+        self.bad_sequence = ""
+        self.bad_seq_list = []
         old_style_cmd_conditions = [
             vi_keys[0] == '/',
-            re.search('<cr>', vi_keys.lower()) is None,
+            REGEX_UM_CR.search(vi_keys) is None,
         ]
 
         # >>> OLD-STYLE USER MAPPING
         if all(old_style_cmd_conditions):
-            yield functools.partial(do_command, vi_keys)
+            return [(functools.partial(do_command, vi_keys), 0, True)]
         # >>> NEW-STYLE USER MAPPING
-        else:
-            for action in self.new_style(vi_keys):
-                yield action
+        steps = []
+        for action, new_mode in self.new_style(vi_keys):
+            if self.bad_sequence:
+                self.bad_seq_list.append(self.bad_sequence)
+                self.bad_sequence = ""
+            steps.append((action, self.count,
+                          step_switches_buffers(action)))
+            if new_mode is not None:
+                self.insert = new_mode == 'INSERT'
+            # Reset count unless last key triggers
+            # INSERT mode ('i', 'a', 'I', 'A', ...).
+            if not self.insert:
+                self.count = 0
+        if self.bad_sequence:
+            self.bad_seq_list.append(self.bad_sequence)
+            self.bad_sequence = ""
+        return steps
 
     def new_style(self, vi_keys):
         """Parse New-Style User Mapping
 
         Yields:
-            Callable object: action(buf, input_line, cur, count)
+            2-tuple: (Callable_Action, Mode_It_Switches_To_Or_None)
         """
         index = 0
         while index < len(vi_keys):
             # >>> COUNT
-            match = re.match('^[1-9][0-9]*', vi_keys[index:])
+            match = REGEX_UM_COUNT.match(vi_keys, index)
             if match:
-                end = match.end() + index
-                self.count += int(vi_keys[index:end])
-                index += match.end()
+                self.count += int(match.group())
+                index = match.end()
 
             # >>> ACTION SPECIFIER
-            action, i = self.action_spec(vi_keys[index:])
+            action, i, new_mode = self.action_spec(vi_keys[index:])
             index += i
             if action is None:
                 continue
             else:
-                yield action
+                yield action, new_mode
 
     def action_spec(self, vi_keys):
         """Parse Action Specifier
 
         Returns:
-            2-tuple: (Callable_Action, Index_Where_Parsing_Stoped)
+            3-tuple: (Callable_Action, Index_Where_Parsing_Stoped,
+                      Mode_It_Switches_To_Or_None)
         """
         # >>> INSERT MODE SEQUENCE
-        if mode == 'INSERT':
-            match = re.search('<(cr|esc)>', vi_keys.lower())
+        if self.insert:
+            match = REGEX_UM_INSERT_END.search(vi_keys)
             enter = False
 
             if match:
-                set_mode('NORMAL')
                 index = match.end()
-                if match.group() == '<cr>':
+                if match.group().lower() == '<cr>':
                     enter = True
             else:
-                index = start = len(vi_keys)
+                index = len(vi_keys)
 
             start = match.start() if match else len(vi_keys)
-            return self.imode_capture(vi_keys[:start], enter=enter), index
+            action = self.imode_capture(vi_keys[:start], match is not None,
+                                        enter)
+            return action, index, 'NORMAL' if match else None
 
         # >>> VI_KEY
-        key_map = VI_DEFAULT_KEYS if self.noremap else VI_KEYS
-        for keys, command in key_map.items():
-            if vi_keys.startswith(keys):
-                if isinstance(command, str):
-                    return functools.partial(do_command, command), len(keys)
-                else:
-                    return command, len(keys)
+        keys, command = VI_KEYS.longest_prefix(vi_keys, self.noremap)
+        if keys is not None:
+            if isinstance(command, str):
+                return functools.partial(do_command, command), len(keys), None
+            elif isinstance(command, UserMapping):
+                self.deps.add(keys)
+                return command, len(keys), command.compile_mode()
+            else:
+                return (command, len(keys),
+                        get_key_metadata(command).get('mode'))
 
         # >>> VI_MOTION
-        for motion in VI_MOTIONS:
-            if vi_keys.startswith(motion):
-                return functools.partial(do_motion, motion), len(motion)
+        motion, _ = VI_MOTIONS_TRIE.longest_prefix(vi_keys)
+        if motion is not None:
+            action = functools.partial(do_motion, VI_MOTION_ACTIONS[motion])
+            return action, len(motion), None
 
         # >>> VI_OPERATOR
         if len(vi_keys) > 1 and vi_keys[0] in VI_OPERATORS:
-            for motion in VI_MOTIONS:
-                if vi_keys[1:].startswith(motion):
-                    action = functools.partial(do_operator,
-                                               vi_keys[:len(motion) + 1])
-                    return action, len(motion) + 1
+            motion, _ = VI_MOTIONS_TRIE.longest_prefix(vi_keys[1:])
+            if motion is not None:
+                operator = VI_OPERATOR_ACTIONS[vi_keys[0]]
+                motion = VI_MOTION_ACTIONS[motion]
+                action = functools.partial(do_operator, operator, motion)
+                # Catching motions (e.g. "cf") don't run the operator yet.
+                new_mode = None if motion.catching else operator.mode
+                return action, len(motion.keys) + 1, new_mode
 
         # >>> WEECHAT COMMAND
-        match = re.search('^[:/](.*?)<(CR|cr)>', vi_keys)
+        match = REGEX_UM_COMMAND.search(vi_keys)
         if match:
-            end = match.end()
-            group = match.groups()[0]
-            cmd_list = group.split(None, 1)
-            cmd = cmd_list[0]
-            args = cmd_list[1] if len(cmd_list) == 2 else ''
-
-            if re.match('b[1-9][0-9]*', cmd):
-                args = '{} {}'.format(cmd[1:], args)
-                cmd = cmd[0]
-
-            if cmd in VI_COMMANDS:
-                if isinstance(VI_COMMANDS[cmd], str):
-                    full_cmd = '{} {}'.format(VI_COMMANDS[cmd], args)
-                    action = functools.partial(do_command, full_cmd)
-                else:
-                    action = self.vi_cmd_action(cmd, args)
-            else:
-                action = functools.partial(do_command,
-                                           '/{}'.format(vi_keys[1:end - 4]))
-            return action, end
+            ex = parse_ex_command(match.group(1))
+            return functools.partial(do_ex_command, ex), match.end(), None
 
         # >>> PARSING ERROR
         if vi_keys[0] in (':', '/'):
             self.bad_sequence += vi_keys
-            return None, len(vi_keys)
+            return None, len(vi_keys), None
         else:
             self.bad_sequence += vi_keys[0]
-            return None, 1
-
-    def vi_cmd_action(self, cmd, args):
-        """Factory for VI_COMMAND Action"""
-        def action(buf, input_line, cur, count):
-            VI_COMMANDS[cmd](args)
-        return action
+            return None, 1, None
 
-    def imode_capture(self, new_input, enter=False):
+    def imode_capture(self, new_input, leave=False, enter=False):
         """Factory for Action that Captures Input and Sends it to Command-Line
 
         This is expected when the mappings previous actions have set
-        INSERT mode.
+        INSERT mode. If `leave` is True, the capture ended with <Esc> or <CR>
+        and the action returns to NORMAL mode first.
         """
         def action(buf, input_line, cur, count):
+            """Insert the captured text, see `imode_capture()`."""
+            if leave:
+                set_mode('NORMAL')
             for _ in range(max(int(count), 1)):
                 p = int(cur)
                 final_input = '{}{}{}'.format(input_line[:p],
                                               new_input,
                                               input_line[p:])
-                weechat.buffer_set(buf, "input", final_input)
-                new_pos = str(len(new_input) + p)
-                weechat.buffer_set(buf, "input_pos", new_pos)
+                set_input(buf, final_input)
+                set_cur(buf, final_input, len(new_input) + p, False)
 
-                input_line = weechat.buffer_get_string(buf, "input")
-                cur = weechat.buffer_get_integer(buf, "input_pos")
+                input_line = get_input(buf)
+                cur = get_cur(buf)
                 if enter:
                     do_command('/input return', buf, input_line, cur, 0)
+        # Sending the input may run a command.
+        action.switches_buffers = enter
         return action
 
+def step_switches_buffers(action):
+    """Return True if a step of a user mapping may switch buffers.
+
+    Motions, operators and text inserted without sending it stay in the
+    buffer; commands, keys and other mappings may not.
+    """
+    if isinstance(action, functools.partial):
+        return action.func not in (do_motion, do_operator)
+    return getattr(action, "switches_buffers", True)
+
+# User mappings whose program is compiled, and mappings to compile (see
+# `compile_user_mappings()`). They may hold mappings that were replaced or
+# removed since.
+compiled_mappings = set()
+uncompiled_mappings = set()
+
 class UserMapping(UMParser):
-    """Wraps User Mapping Defined by :nmap Command"""
-    count = 0
-    locked = False
+    """Wraps User Mapping Defined by :nmap Command
+
+    The rhs is compiled into a program of actions once (see
+    `UMParser.parse()`), and the program is reused until a mapping it
+    depends on changes (see `invalidate_user_mappings()`).
+    """
     noremap = False
+    # Mappings currently being compiled, used to detect recursion cycles.
+    compiling = []
+    # Maximum number of programs cached per mapping for different counts.
+    max_programs = 16
 
     def __init__(self, lhs, rhs, noremap=False):
         self.lhs = lhs
         self.rhs = rhs
         self.noremap = noremap
+        self.has_count_tag = REGEX_UM_COUNT_TAG.search(rhs) is not None
+        self.invalidate()
 
     def __call__(self, buf, input_line, cur, count):
-        if self.locked:
+        steps, count = self.program(count)
+        for _ in range(count):
+            for action, action_count, switches in steps:
+                action(buf, input_line, cur, action_count)
+                # The edits are read back from the pending transaction (see
+                # `get_input_state()`), no WeeChat call is made.
+                if switches:
+                    buf = get_current_buffer()
+                input_line, cur = get_input_state(buf)
+
+    def invalidate(self):
+        """Drop the compiled programs; they're compiled again when needed."""
+        self.steps = None
+        self.programs = {}
+        self.deps = set()
+        self.mode = None
+        self.cycle = False
+        compiled_mappings.discard(self)
+        uncompiled_mappings.add(self)
+
+    def compile(self):
+        """Compile the rhs once, reporting parsing errors and cycles.
+
+        A mapping that (directly or not) ends up calling itself is reported
+        and compiled to an empty program.
+        """
+        if self.steps is not None:
+            return
+        UserMapping.compiling.append(self)
+        try:
+            steps = self.parse(self.process_count(0)[0])
+            self.mode = 'INSERT' if self.insert else None
+        finally:
+            UserMapping.compiling.pop()
+        if self.cycle:
             error_fmt = ("Somthing's not right. The following user mapping "
                          "is recursing on itself: (\"{}\", \"{}\").")
             print_warning(error_fmt.format(self.lhs, self.rhs))
-            return
-
-        rhs, count = self.process_count(count)
-        self.bad_sequence = ""
-        with self.lock():
-            for _ in range(count):
-                bad_seq_list = []
-                for action in self.parse(rhs):
-                    if self.bad_sequence:
-                        bad_seq_list.append(self.bad_sequence)
-
-                    action(buf, input_line, cur, self.count)
-
-                    # Reset count unless last key triggers
-                    # INSERT mode ('i', 'a', 'I', 'A', ...).
-                    if mode != 'INSERT':
-                        self.count = 0
-
-                    self.bad_sequence = ""
-
-                    buf = weechat.current_buffer()
-                    input_line = weechat.buffer_get_string(buf, "input")
-                    cur = weechat.buffer_get_integer(buf, "input_pos")
+            steps = []
+        else:
+            self.report_errors(self.bad_seq_list)
+        self.steps = steps
+        uncompiled_mappings.discard(self)
+        compiled_mappings.add(self)
 
-                self.count = 0
-                if self.bad_sequence:
-                    bad_seq_list.append(self.bad_sequence)
-                    self.bad_sequence = ""
+    def compile_mode(self):
+        """Compile the mapping if needed and return the mode it ends in.
 
-                self.report_errors(bad_seq_list)
+        Called while compiling another mapping that uses this one.
+        """
+        compiling = UserMapping.compiling
+        if self in compiling:
+            for mapping in compiling[compiling.index(self):]:
+                mapping.cycle = True
+            return None
+        self.compile()
+        return self.mode
 
-    @contextmanager
-    def lock(self):
-        """ Access Lock
+    def program(self, count):
+        """Return the program for an external `count`.
 
-        Protects against infinite recursion which could be triggered by
-        defining a mapping in terms of itself, for example.
+        Returns:
+            2-tuple: (steps, times_to_run_them)
         """
-        try:
-            self.locked = True
-            yield
-        finally:
-            self.locked = False
+        self.compile()
+        if not self.has_count_tag or self.cycle:
+            return self.steps, max(count, 1)
+        rhs, count = self.process_count(count)
+        steps = self.programs.get(rhs)
+        if steps is None:
+            steps = self.parse(rhs)
+            if len(self.programs) >= self.max_programs:
+                self.programs.clear()
+            self.programs[rhs] = steps
+        return steps, count
 
     def process_count(self, count):
         """Checks for a special count tag of the form #{N} where N is some integer.
@@ -1342,11 +2180,11 @@ class UserMapping(UMParser):
         If a count tag is found, consume the count by substituting it in place
         of the tag.
         """
-        if re.search(r'#{\d+}', self.rhs) is not None:
+        if self.has_count_tag:
             if count:
-                rhs = re.sub(r'#{\d+}', str(count), self.rhs)
+                rhs = REGEX_UM_COUNT_TAG.sub(str(count), self.rhs)
             else:
-                rhs = re.sub(r'#{(\d+)}', r'\1', self.rhs)
+                rhs = REGEX_UM_COUNT_TAG.sub(r'\1', self.rhs)
             new_count = 1
         else:
             rhs = self.rhs
@@ -1361,10 +2199,238 @@ class UserMapping(UMParser):
                 '("{}", "{}").'.format(bad_seq, self.lhs, self.rhs)
             print_warning(error_msg)
 
+def invalidate_user_mappings(keys):
+    """Drop the compiled programs that depend on the mapping of `keys`.
+
+    A program depends on `keys` if it calls that user mapping, or if `keys`
+    appears in its rhs (adding or removing the mapping changes how the rhs is
+    parsed). Programs depending on an invalidated mapping are dropped too.
+
+    Only the compiled mappings are looked at, so that mappings added in a
+    batch (see `apply_option_changes()`) don't look at each other.
+    """
+    stale = [keys]
+    while stale:
+        keys = stale.pop()
+        for mapping in list(compiled_mappings):
+            if not is_mapped(mapping):
+                compiled_mappings.discard(mapping)
+            elif (not mapping.noremap and
+                  (keys in mapping.deps or keys in mapping.rhs)):
+                mapping.invalidate()
+                stale.append(mapping.lhs)
+
+def is_mapped(mapping):
+    """Return True if the `UserMapping` is still in use."""
+    return (mapping.lhs in VI_KEYS.user and
+            VI_KEYS.user[mapping.lhs] is mapping)
+
 
 # Key handling.
 # =============
 
+class KeyParser(object):
+    """Incremental parser for Normal mode key sequences.
+
+    Keys follow vi's grammar: ["x] [count] {key}, or ["x] [count] [operator
+    [count]] {motion}, possibly followed by the characters caught by keys
+    such as "f" or "r" (see `start_catching_keys()`). Each pressed key moves
+    the parser forward along the `KeyTrie` nodes it has reached so far, so
+    handling a key costs O(len(key)) and previously typed keys are never
+    parsed again.
+
+    Attributes:
+        keys (str): the pending keys as typed, counts included. This is what
+            the vi_buffer bar item shows.
+        done_keys (str): the keys bound to the last action returned.
+        register (str): the register given with "x for the pending keys,
+            "" while waiting for its name, None if none.
+        done_register (str): the register given for the last action
+            returned, see `get_register()`.
+        replay (list): keys to feed again after running the action returned
+            by `feed()`, see `KeyParser.AMBIGUOUS`.
+        serial (int): incremented on every key, used to expire timers.
+    """
+    # More keys are needed.
+    PENDING = 0
+    # The keys match nothing; the parser was reset.
+    NO_MATCH = 1
+    # The keys are bound, but a longer user mapping starts with them: wait
+    # for more keys. If the next keys don't continue the mapping, the bound
+    # keys are returned as DONE and the extra keys must be replayed.
+    AMBIGUOUS = 2
+    # The keys are bound to an action.
+    DONE = 3
+    # All the keys for a catching action (e.g. "f") were caught.
+    CAUGHT = 4
+
+    __slots__ = ("keys", "done_keys", "typed", "register", "done_register",
+                 "count", "seq", "operator", "motion_count", "motion_seq",
+                 "user_node", "default_node", "motion_node", "op_node",
+                 "match", "catching", "replay", "serial")
+
+    def __init__(self):
+        self.serial = 0
+        self.replay = []
+        self.done_keys = ""
+        self.done_register = None
+        self.reset()
+
+    def reset(self):
+        """Forget about the pending keys."""
+        self.keys = ""
+        self.typed = []
+        self.register = None
+        self.count = ""
+        self.seq = ""
+        self.operator = None
+        self.motion_count = ""
+        self.motion_seq = ""
+        self.user_node = VI_KEYS.user.root
+        self.default_node = VI_KEYS.defaults.root
+        self.motion_node = VI_MOTIONS_TRIE.root
+        self.op_node = None
+        # (action, count, number of typed keys) for ambiguous keys.
+        self.match = None
+        # (action, count) of the action catching keys.
+        self.catching = None
+
+    def start_catching(self, action, count):
+        """Send the next keys to `catching_keys_data`, then resume `action`."""
+        self.catching = (action, count)
+        # Keep showing the keys until the caught ones are pressed.
+        self.keys = self.done_keys
+
+    def feed(self, keys):
+        """Move the parser forward with the newly pressed `keys`.
+
+        Returns:
+            tuple: (status, action, count). `action` is the `Action` to run
+                (see `VI_DISPATCH`) for DONE, or the catching action for
+                CAUGHT; it's None otherwise.
+        """
+        self.serial += 1
+        self.replay = []
+        self.keys += keys
+        if self.catching is not None:
+            catching_keys_data['keys'] += keys
+            catching_keys_data['amount'] -= 1
+            if catching_keys_data['amount'] > 0:
+                return self.PENDING, None, 0
+            action, count = self.catching
+            self.reset()
+            return self.CAUGHT, action, count
+        match = self.match
+        self.typed.append(keys)
+        # A register ("x) can be given before the keys.
+        if self.register == "":
+            if keys not in REGISTER_NAMES:
+                self.reset()
+                return self.NO_MATCH, None, 0
+            self.register = keys
+            return self.PENDING, None, 0
+        if keys == '"' and not self.seq and self.register is None:
+            self.register = ""
+            return self.PENDING, None, 0
+        if len(keys) == 1 and keys.isdigit() and self._feed_count(keys):
+            return self.PENDING, None, 0
+        # The operator path: an operator, an optional count, then a motion.
+        if self.op_node is not None:
+            self.motion_seq += keys
+            self.op_node = self._step(self.op_node, keys)
+        elif not self.seq and keys in VI_OPERATOR_ACTIONS:
+            self.operator = VI_OPERATOR_ACTIONS[keys]
+            self.op_node = VI_MOTIONS_TRIE.root
+        self.seq += keys
+        self.user_node = self._step(self.user_node, keys)
+        self.default_node = self._step(self.default_node, keys)
+        self.motion_node = self._step(self.motion_node, keys)
+
+        action = None
+        count = int(self.count or 0)
+        partial = False
+        for node in (self.user_node, self.default_node, self.motion_node):
+            if node is None:
+                continue
+            if action is None and KeyTrie.VALUE in node:
+                action = VI_DISPATCH.get(self.seq)
+            partial = partial or len(node) > (KeyTrie.VALUE in node)
+        if self.op_node is not None:
+            if action is None and KeyTrie.VALUE in self.op_node:
+                action = VI_DISPATCH.get(self.operator.key + self.motion_seq)
+                # Multiply the operator count by the motion count, similar
+                # to vim's behavior.
+                if self.motion_count:
+                    count = max(count, 1) * int(self.motion_count)
+            partial = partial or (len(self.op_node) >
+                                  (KeyTrie.VALUE in self.op_node))
+
+        if action is not None:
+            # Only sequences involving user mappings are ambiguous, so that
+            # default keys such as alt-j (also the start of alt-j<num>) still
+            # run instantly.
+            if partial and self.user_node is not None:
+                self.match = (action, count, len(self.typed))
+                return self.AMBIGUOUS, None, 0
+            self.done_keys = self.keys
+            self.done_register = self.register
+            self.reset()
+            return self.DONE, action, count
+        if partial:
+            return self.PENDING, None, 0
+        typed = self.typed
+        register = self.register
+        self.reset()
+        # The previous keys were bound but ambiguous: run them now, then
+        # handle the keys pressed after them on their own.
+        if match is not None:
+            self.done_register = register
+            self.done_keys = "".join(typed[:match[2]])
+            self.replay = typed[match[2]:]
+            return self.DONE, match[0], match[1]
+        return self.NO_MATCH, None, 0
+
+    def flush(self):
+        """Stop waiting after ambiguous keys, see `KeyParser.AMBIGUOUS`.
+
+        Returns:
+            tuple: (action, count) bound to the ambiguous keys, or (None, 0)
+                if there are none. `replay` holds the keys typed after them.
+        """
+        if self.match is None:
+            return None, 0
+        action, count, index = self.match
+        typed = self.typed
+        self.done_register = self.register
+        self.reset()
+        self.done_keys = "".join(typed[:index])
+        self.replay = typed[index:]
+        return action, count
+
+    def _feed_count(self, digit):
+        """Add `digit` to the current count, if a count is expected here."""
+        # "0" is a motion, unless it continues a count.
+        if not self.seq:
+            if self.count or digit != "0":
+                self.count += digit
+                return True
+        elif (self.op_node is not None and not self.motion_seq and
+              (self.motion_count or digit != "0")):
+            self.motion_count += digit
+            # Only the operator path can match after a motion count.
+            self.user_node = self.default_node = self.motion_node = None
+            return True
+        return False
+
+    @staticmethod
+    def _step(node, keys):
+        """Return the child of `node` reached with `keys`, if any."""
+        for char in keys:
+            if node is None:
+                break
+            node = node.get(char)
+        return node
+
 def normalize_keys(signal_data):
     """Translate upper case ctrl sequences to lower case ones"""
     return re.sub("\x01[A-Z]", lambda match: match.group(0).lower(), signal_data)
@@ -1381,10 +2447,11 @@ def cb_key_pressed(data, signal, signal_data):
     last_signal_time = time.time()
     if keys == "\x01[":
         # In 50ms, check if any other keys were pressed. If not, it's Esc!
-        weechat.hook_timer(50, 0, 1, "cb_check_esc",
+        scheduler.schedule(50, "esc", cb_check_esc,
                            "{:f}".format(last_signal_time))
     return weechat.WEECHAT_RC_OK
 
+@edit_transaction
 def cb_check_esc(data, remaining_calls):
     """Check if the Esc key was pressed and change the mode accordingly."""
     global esc_pressed, vi_buffer, catching_keys_data
@@ -1392,15 +2459,18 @@ def cb_check_esc(data, remaining_calls):
     # works for py2 and not for py3.
     if abs(last_signal_time - float(data)) <= 0.000001:
         esc_pressed += 1
+        mode = get_mode()
         if mode == "SEARCH" or mode == "COMMAND":
-            weechat.command("", "/input search_stop_here")
+            run_command("", "/input search_stop_here")
         set_mode("NORMAL")
         # Cancel any current partial commands.
         vi_buffer = ""
         catching_keys_data = {'amount': 0}
-        weechat.bar_item_update("vi_buffer")
+        get_key_parser().reset()
+        update_bar_item("vi_buffer")
     return weechat.WEECHAT_RC_OK
 
+@edit_transaction
 def cb_key_combo_default(data, signal, signal_data):
     """Eat and handle key events when in Normal mode, if needed.
 
@@ -1409,8 +2479,8 @@ def cb_key_combo_default(data, signal, signal_data):
 
     Esc is handled a bit differently to avoid delays, see `cb_key_pressed()`.
     """
-    global esc_pressed, vi_buffer, cmd_compl_text, cmd_text_orig, \
-        cmd_compl_pos, cmd_history_index
+    global esc_pressed, vi_buffer, cmd_compl_text, cmd_completion, \
+        cmd_history_recall
 
     # If Esc was pressed, strip the Esc part from the pressed keys.
     # Example: user presses Esc followed by i. This is detected as "\x01[i",
@@ -1440,10 +2510,11 @@ def cb_key_combo_default(data, signal, signal_data):
 
     # Clear the undo history for this buffer on <Return>.
     if keys == "\x01m":
-        buf = weechat.current_buffer()
+        buf = get_current_buffer()
         clear_undo_history(buf)
 
     # Detect imap_esc presses if any.
+    mode = get_mode()
     if mode == "INSERT":
         imap_esc = vimode_settings['imap_esc']
         if not imap_esc:
@@ -1451,26 +2522,26 @@ def cb_key_combo_default(data, signal, signal_data):
         if (imap_esc.startswith(vi_buffer) and
                 imap_esc[len(vi_buffer):len(vi_buffer) + 1] == keys):
             vi_buffer += keys
-            weechat.bar_item_update("vi_buffer")
-            weechat.hook_timer(int(vimode_settings['imap_esc_timeout']), 0, 1,
-                               "cb_check_imap_esc", vi_buffer)
+            update_bar_item("vi_buffer")
+            scheduler.schedule(int(vimode_settings['imap_esc_timeout']),
+                               "imap_esc", cb_check_imap_esc, vi_buffer)
         elif (vi_buffer and imap_esc.startswith(vi_buffer) and
               imap_esc[len(vi_buffer):len(vi_buffer) + 1] != keys):
             vi_buffer = ""
-            weechat.bar_item_update("vi_buffer")
+            update_bar_item("vi_buffer")
         # imap_esc sequence detected -- remove the sequence keys from the
         # Weechat input bar and enter Normal mode.
         if imap_esc == vi_buffer:
-            buf = weechat.current_buffer()
-            input_line = weechat.buffer_get_string(buf, "input")
-            cur = weechat.buffer_get_integer(buf, "input_pos")
+            buf = get_current_buffer()
+            input_line = get_input(buf)
+            cur = get_cur(buf)
             input_line = (input_line[:cur - len(imap_esc) + 1] +
                           input_line[cur:])
-            weechat.buffer_set(buf, "input", input_line)
+            set_input(buf, input_line)
             set_cur(buf, input_line, cur - len(imap_esc) + 1, False)
             set_mode("NORMAL")
             vi_buffer = ""
-            weechat.bar_item_update("vi_buffer")
+            update_bar_item("vi_buffer")
             return weechat.WEECHAT_RC_OK_EAT
         return weechat.WEECHAT_RC_OK
 
@@ -1479,186 +2550,209 @@ def cb_key_combo_default(data, signal, signal_data):
     # pass normally (e.g. backspace, arrow keys, etc).
     if mode == "REPLACE":
         if len(keys) == 1:
-            weechat.command("", "/input delete_next_char")
+            run_command("", "/input delete_next_char")
         elif keys == "\x01?":
-            weechat.command("", "/input move_previous_char")
+            run_command("", "/input move_previous_char")
             return weechat.WEECHAT_RC_OK_EAT
         return weechat.WEECHAT_RC_OK
 
     # We're in command-line mode.
     if mode == "COMMAND":
-        buf = weechat.current_buffer()
-        cmd_text = weechat.buffer_get_string(buf, "input")
-        weechat.hook_timer(1, 0, 1, "cb_check_cmd_mode", "")
+        compl_text = cmd_compl_text
+        buf = get_current_buffer()
+        cmd_text = get_input(buf)
+        scheduler.schedule(1, "cmd_mode", cb_check_cmd_mode)
         # Return key.
         if keys == "\x01m":
-            weechat.hook_timer(1, 0, 1, "cb_exec_cmd", cmd_text)
-            if len(cmd_text) > 1 and (not cmd_history or
-                                      cmd_history[-1] != cmd_text):
-                cmd_history.append(cmd_text)
-            cmd_history_index = 0
+            scheduler.schedule(1, None, cb_exec_cmd, cmd_text)
+            if len(cmd_text) > 1 and cmd_text[:1] in histories:
+                add_history(cmd_text[0], cmd_text)
+            cmd_history_recall = None
             set_mode("NORMAL")
-            buf = weechat.current_buffer()
-            input_line = input_line_backup[buf]['input_line']
-            weechat.buffer_set(buf, "input", input_line)
-            set_cur(buf, input_line, input_line_backup[buf]['cur'], False)
-        # Up arrow.
-        elif keys == "\x01[[A":
-            if cmd_history_index > -len(cmd_history):
-                cmd_history_index -= 1
-                cmd_text = cmd_history[cmd_history_index]
-            weechat.buffer_set(buf, "input", cmd_text)
-            set_cur(buf, cmd_text, len(cmd_text), False)
-        # Down arrow.
-        elif keys == "\x01[[B":
-            if cmd_history_index < -1:
-                cmd_history_index += 1
-                cmd_text = cmd_history[cmd_history_index]
-            else:
-                cmd_history_index = 0
-                cmd_text = ":"
-            weechat.buffer_set(buf, "input", cmd_text)
-            set_cur(buf, cmd_text, len(cmd_text), False)
+            buf = get_current_buffer()
+            input_line, cur = get_buffer_state(buf).cmd_backup
+            set_input(buf, input_line)
+            set_cur(buf, input_line, cur, False)
+        # Up/Down arrows: recall the entries starting with the typed text.
+        elif keys in ("\x01[[A", "\x01[[B") and cmd_text[:1] in histories:
+            recall_history(buf, cmd_text[0], cmd_text, keys == "\x01[[A")
         # Tab key. No completion when searching ("/").
-        elif keys == "\x01i" and cmd_text[0] == ":":
-            if cmd_text_orig is None:
-                input_ = list(cmd_text)
-                del input_[0]
-                cmd_text_orig = "".join(input_)
-            cmd_compl_list = []
-            for cmd in VI_COMMANDS.keys():
-                if cmd.startswith(cmd_text_orig):
-                    cmd_compl_list.append(cmd)
-            if cmd_compl_list:
-                curr_suggestion = cmd_compl_list[cmd_compl_pos]
-                cmd_text = ":%s" % curr_suggestion
-                cmd_compl_list[cmd_compl_pos] = weechat.string_eval_expression(
-                    "${color:bold}%s${color:-bold}" % curr_suggestion,
-                    {}, {}, {})
-                cmd_compl_text = ", ".join(cmd_compl_list)
-                cmd_compl_pos = (cmd_compl_pos + 1) % len(cmd_compl_list)
-                weechat.buffer_set(buf, "input", cmd_text)
+        elif keys == "\x01i" and cmd_text[:1] == ":":
+            if cmd_completion is None:
+                cmd_completion = complete_command_line(cmd_text[1:])
+            if cmd_completion.matches:
+                suggestion, cmd_compl_text = cmd_completion.next()
+                cmd_text = ":%s" % suggestion
+                set_input(buf, cmd_text)
                 set_cur(buf, cmd_text, len(cmd_text), False)
         # Input.
         else:
             cmd_compl_text = ""
-            cmd_text_orig = None
-            cmd_compl_pos = 0
-        weechat.bar_item_update("cmd_completion")
+            cmd_completion = None
+            cmd_history_recall = None
         if keys in ["\x01m", "\x01[[A", "\x01[[B"]:
             cmd_compl_text = ""
+        if cmd_compl_text != compl_text:
+            update_bar_item("cmd_completion")
+        if keys in ["\x01m", "\x01[[A", "\x01[[B"]:
             return weechat.WEECHAT_RC_OK_EAT
         else:
             return weechat.WEECHAT_RC_OK
     # Enter command mode.
     elif keys in [vimode_settings['user_command_mapping'], "/"]:
         if keys == "/":
-            weechat.command("", "/input search_text_here")
+            run_command("", "/input search_text_here")
             if not weechat.config_string_to_boolean(
                     vimode_settings['search_vim']):
                 return weechat.WEECHAT_RC_OK
         else:
-            buf = weechat.current_buffer()
-            cur = weechat.buffer_get_integer(buf, "input_pos")
-            input_line = weechat.buffer_get_string(buf, "input")
-            input_line_backup[buf] = {'input_line': input_line, 'cur': cur}
+            buf = get_current_buffer()
+            cur = get_cur(buf)
+            input_line = get_input(buf)
+            get_buffer_state(buf).cmd_backup = (input_line, cur)
             input_line = ":"
-            weechat.buffer_set(buf, "input", input_line)
+            set_input(buf, input_line)
             set_cur(buf, input_line, 1, False)
         set_mode("COMMAND")
         cmd_compl_text = ""
-        cmd_text_orig = None
-        cmd_compl_pos = 0
+        cmd_completion = None
+        cmd_history_recall = None
         return weechat.WEECHAT_RC_OK_EAT
 
-    # Add key to the buffer.
-    vi_buffer += keys
-    weechat.bar_item_update("vi_buffer")
-    if not vi_buffer:
+    if not keys:
         return weechat.WEECHAT_RC_OK
+    feed_keys([keys])
+    return weechat.WEECHAT_RC_OK_EAT
 
-    # Check if the keys have a (partial or full) match. If so, also get the
-    # keys without the count. (These are the actual keys we should handle.)
-    # After that, `vi_buffer` is only used for display purposes — only
-    # `vi_keys` is checked for all the handling.
-    # If no matches are found, the keys buffer is cleared.
-    matched, vi_keys, count = get_keys_and_count(vi_buffer)
-    if not matched and not catching_keys_data['amount']:
-        vi_buffer = ""
-        return weechat.WEECHAT_RC_OK_EAT
-    # Check if it's a command (user defined key mapped to a :cmd).
-    if vi_keys.startswith(":"):
-        weechat.hook_timer(1, 0, 1, "cb_exec_cmd", "{} {}".format(vi_keys,
-                                                                  count))
-        vi_buffer = ""
-        return weechat.WEECHAT_RC_OK_EAT
-    # It's a WeeChat command (user defined key mapped to a /cmd).
-    if vi_keys.startswith("/"):
-        weechat.command("", vi_keys)
-        vi_buffer = ""
-        return weechat.WEECHAT_RC_OK_EAT
+def add_history(kind, entry):
+    """Add `entry` to the ":" or "/" history, and to the viminfo file."""
+    get_history(kind).add(entry)
+    viminfo.append([kind, entry])
 
-    buf = weechat.current_buffer()
-    input_line = weechat.buffer_get_string(buf, "input")
-    cur = weechat.buffer_get_integer(buf, "input_pos")
-
-    # Check if we should catch keys, but don't do anything yet (in case the
-    # user remapped this combo, and we shouldn't be calling the callback).
-    catching_keys = False
-    if catching_keys_data['amount']:
-        catching_keys = True
-        catching_keys_data['keys'] += keys
-        catching_keys_data['amount'] -= 1
-
-    # It's a default mapping. If the corresponding value is a string, we assume
-    # it's a WeeChat command. Otherwise, it's a method we'll call.
-    if vi_keys in VI_KEYS:
-        if vi_keys not in ['u', '\x01r']:
-            add_undo_history(buf, input_line)
-        if isinstance(VI_KEYS[vi_keys], str):
-            do_command(VI_KEYS[vi_keys], buf, input_line, cur, count)
-        else:
-            VI_KEYS[vi_keys](buf, input_line, cur, count)
-    # It's a motion (e.g. "w") — call `motion_X()` where X is the motion, then
-    # set the cursor's position to what that function returned.
-    elif vi_keys in VI_MOTIONS:
-        do_motion(vi_keys, buf, input_line, cur, count)
-    # It's an operator + motion (e.g. "dw") — call `motion_X()` (where X is
-    # the motion), then we call `operator_Y()` (where Y is the operator)
-    # with the position `motion_X()` returned. `operator_Y()` should then
-    # handle changing the input line.
-    elif (len(vi_keys) > 1 and
-          vi_keys[0] in VI_OPERATORS and
-          vi_keys[1:] in VI_MOTIONS):
-        do_operator(vi_keys, buf, input_line, cur, count)
-    # Done catching keys, execute the callback.
-    elif catching_keys and catching_keys_data['amount'] == 0:
-        catching_keys_data['amount'] = -1
-        vi_buffer = vi_buffer[:-len(keys)]
-        globals()[catching_keys_data['callback']]()
-        vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
+def recall_history(buf, kind, text, older):
+    """Replace the input line by the next entry of the ":" or "/" history
+    starting with the typed `text` (see `cmd_history_recall`).
+
+    Args:
+        older (bool): recall an older entry (Up) instead of a newer one
+            (Down), back to `text` itself.
+    """
+    global cmd_history_recall
+    if cmd_history_recall is None:
+        cmd_history_recall = [text, get_history(kind).recall(text), -1]
+    typed, entries, index = cmd_history_recall
+    if older:
+        index = min(index + 1, len(entries) - 1)
     else:
-        return weechat.WEECHAT_RC_OK_EAT
+        index = max(index - 1, -1)
+    cmd_history_recall[2] = index
+    text = entries[index] if index >= 0 else typed
+    set_input(buf, text)
+    set_cur(buf, text, len(text), False)
 
-    # We've already handled the key combo, so clear the keys buffer.
-    if catching_keys_data['amount'] <= 0:
-        catching_keys_data['amount'] = 0
-        vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
-    return weechat.WEECHAT_RC_OK_EAT
+def feed_keys(keys):
+    """Feed pressed keys to the current buffer's `KeyParser`, and run the
+    actions they complete.
 
-def cb_check_imap_esc(data, remaining_calls):
-    """Clear the imap_esc sequence after some time if nothing was pressed."""
-    global vi_buffer
-    if vi_buffer == data:
+    It's a key (e.g. "x"), a motion (e.g. "w") or an operator + motion (e.g.
+    "dw"). See `VI_DISPATCH` for how each of these is handled.
+
+    Args:
+        keys (list): the keys to handle, one item per key press.
+    """
+    global vi_buffer
+    key_parser = get_key_parser()
+    keys = list(keys)
+    while keys:
+        status, action, count = key_parser.feed(keys.pop(0))
+        if status == KeyParser.DONE:
+            run_action(action, count)
+        elif status == KeyParser.CAUGHT:
+            finish_catching_keys(action, count)
+        keys[:0] = key_parser.replay
+    # Some bound keys are held (see `KeyParser.AMBIGUOUS`), as a longer
+    # sequence starting with them is mapped as well: wait `timeoutlen` ms
+    # after the last key for more keys, like vim does.
+    if key_parser.match is not None:
+        scheduler.schedule(int(vimode_settings['timeoutlen']),
+                           "key_timeout", cb_check_key_timeout,
+                           "{} {}".format(get_current_buffer(),
+                                          key_parser.serial))
+    if vi_buffer != key_parser.keys:
+        vi_buffer = key_parser.keys
+        update_bar_item("vi_buffer")
+
+def run_action(action, count):
+    """Run `action` on the current buffer's input line.
+
+    If the action starts catching keys (e.g. "f"), the `KeyParser` is told to
+    catch them, and the action is resumed once they've all been pressed.
+    """
+    buf = get_current_buffer()
+    input_line = get_input(buf)
+    cur = get_cur(buf)
+    if action.kind == "key":
+        add_undo_history(buf, input_line)
+    action(buf, input_line, cur, count)
+    if catching_keys_data['amount'] > 0:
+        get_key_parser().start_catching(action, count)
+    else:
+        catching_keys_data['amount'] = 0
+
+def finish_catching_keys(action, count):
+    """Call the catching callback, then resume `action` if it's a motion.
+
+    See Also:
+        `start_catching_keys()`.
+    """
+    catching_keys_data['amount'] = -1
+    catching_keys_data['callback']()
+    # Motions (e.g. "df") need to run again, now that the callback has set
+    # the new cursor position.
+    if "new_cur" in catching_keys_data:
+        run_action(action, count)
+    if catching_keys_data['amount'] <= 0:
+        catching_keys_data['amount'] = 0
+
+@edit_transaction
+def cb_check_key_timeout(data, remaining_calls):
+    """Run ambiguous keys if nothing else was pressed after `timeoutlen`."""
+    key_parser = get_key_parser()
+    if data == "{} {}".format(get_current_buffer(), key_parser.serial):
+        action, count = key_parser.flush()
+        if action is not None:
+            run_action(action, count)
+            feed_keys(key_parser.replay)
+    return weechat.WEECHAT_RC_OK
+
+def cb_check_imap_esc(data, remaining_calls):
+    """Clear the imap_esc sequence after some time if nothing was pressed."""
+    global vi_buffer
+    if vi_buffer == data:
         vi_buffer = ""
-        weechat.bar_item_update("vi_buffer")
+        update_bar_item("vi_buffer")
     return weechat.WEECHAT_RC_OK
 
+@edit_transaction
 def cb_key_combo_search(data, signal, signal_data):
-    """Handle keys while search mode is active (if search_vim is enabled)."""
+    """Handle keys while search mode is active.
+
+    While the search text is typed, Return adds it to the "/" history and
+    Up/Down recall the entries starting with it, as in Command mode. The
+    other keys are only handled if search_vim is enabled.
+    """
+    global cmd_history_recall
     keys = normalize_keys(signal_data)
+    mode = get_mode()
+    if mode != "SEARCH":
+        buf = get_current_buffer()
+        text = get_input(buf)
+        if keys in ("\x01[[A", "\x01[[B"):
+            recall_history(buf, "/", text, keys == "\x01[[A")
+            return weechat.WEECHAT_RC_OK_EAT
+        if keys == "\x01m" and text:
+            add_history("/", text)
+        cmd_history_recall = None
     if not weechat.config_string_to_boolean(vimode_settings['search_vim']):
         return weechat.WEECHAT_RC_OK
     if mode == "COMMAND":
@@ -1670,14 +2764,14 @@ def cb_key_combo_search(data, signal, signal_data):
             set_mode("NORMAL")
         else:
             if keys == "n":
-                weechat.command("", "/input search_next")
+                run_command("", "/input search_next")
             elif keys == "N":
-                weechat.command("", "/input search_previous")
+                run_command("", "/input search_previous")
             # Start a new search.
             elif keys == "/":
-                weechat.command("", "/input search_stop_here")
+                run_command("", "/input search_stop_here")
                 set_mode("NORMAL")
-                weechat.command("", "/input search_text_here")
+                run_command("", "/input search_text_here")
             return weechat.WEECHAT_RC_OK_EAT
     return weechat.WEECHAT_RC_OK
 
@@ -1695,21 +2789,44 @@ def cb_cmd_completion(data, item, window):
     """Return the text of the command line."""
     return cmd_compl_text
 
-def cb_mode_indicator(data, item, window):
-    """Return the current mode (INSERT/NORMAL/REPLACE/...)."""
-    return "{}{}{}{}{}".format(
-        weechat.color(mode_colors[mode]),
-        vimode_settings['mode_indicator_prefix'], mode,
-        vimode_settings['mode_indicator_suffix'], weechat.color("reset"))
+def cb_mode_indicator(data, item, window, buf, extra_info):
+    """Return the mode (INSERT/NORMAL/REPLACE/...) of the buffer displayed.
+
+    Buffers the script knows nothing about yet are in Insert mode.
+    """
+    state = buffer_states.get(buf)
+    return mode_indicators[state.mode if state is not None else "INSERT"]
+
+# Rendered line numbers, keyed by (height, prefix, suffix). Cleared when the
+# line_number_* options change.
+line_numbers_cache = {}
+# {window: chat height the line numbers were last rendered for}.
+line_numbers_heights = {}
+# {window: content} of the line numbers numbering the buffer's lines (see the
+# line_numbers_mode option). A window's content is rendered again once it's
+# removed, see `invalidate_line_numbers()`.
+line_numbers_windows = {}
 
 def cb_line_numbers(data, item, window):
     """Fill the line numbers bar item."""
+    mode = get_line_numbers_mode()
+    if mode != "screen":
+        content = line_numbers_windows.get(window)
+        if content is None:
+            content = render_line_numbers(window, mode == "relative")
+        if content is not None:
+            line_numbers_windows[window] = content
+            return content
     bar_height = weechat.window_get_integer(window, "win_chat_height")
-    content = ""
-    for i in range(1, bar_height + 1):
-        content += "{}{:2}{}\n".format(vimode_settings['line_number_prefix'],
-                                       i,
-                                       vimode_settings['line_number_suffix'])
+    line_numbers_heights[window] = bar_height
+    prefix = vimode_settings['line_number_prefix']
+    suffix = vimode_settings['line_number_suffix']
+    key = (bar_height, prefix, suffix)
+    content = line_numbers_cache.get(key)
+    if content is None:
+        content = "".join("{}{:2}{}\n".format(prefix, i, suffix)
+                          for i in range(1, bar_height + 1))
+        line_numbers_cache[key] = content
     return content
 
 # Callbacks for the line numbers bar.
@@ -1718,146 +2835,497 @@ def cb_line_numbers(data, item, window):
 def cb_update_line_numbers(data, signal, signal_data):
     """Call `cb_timer_update_line_numbers()` when switching buffers.
 
-    A timer is required because the bar item is refreshed before the new buffer
+    A delay is required because the bar item is refreshed before the new buffer
     is actually displayed, so ``win_chat_height`` would refer to the old
-    buffer. Using a timer refreshes the item after the new buffer is displayed.
+    buffer. Using a delay refreshes the item after the new buffer is displayed.
     """
-    weechat.hook_timer(10, 0, 1, "cb_timer_update_line_numbers", "")
+    forget_line_numbers_buffers()
+    invalidate_line_numbers()
+    scheduler.schedule(10, "line_numbers", cb_timer_update_line_numbers)
+    return weechat.WEECHAT_RC_OK
+
+def cb_windows_changed(data, signal, signal_data):
+    """Windows were resized or opened, or buffers merged or unmerged: refresh
+    all the line numbers."""
+    line_numbers_heights.clear()
+    window_rows.clear()
+    forget_line_numbers_buffers()
+    invalidate_line_numbers()
+    scheduler.schedule(10, "line_numbers", cb_timer_update_line_numbers)
+    return weechat.WEECHAT_RC_OK
+
+def cb_window_scrolled(data, signal, signal_data):
+    """Refresh the line numbers, unless they're the rows of the window."""
+    if get_line_numbers_mode() != "screen":
+        invalidate_line_numbers([signal_data])
+        scheduler.schedule(10, "line_numbers", cb_timer_update_line_numbers)
+    return weechat.WEECHAT_RC_OK
+
+def cb_line_numbers_print(data, buf, date, tags, displayed, highlight,
+                          prefix, message):
+    """Refresh the line numbers of the windows displaying a printed line.
+
+    Prints in the buffers no window displays are ignored, without any API
+    call (see `get_line_numbers_buffers()`).
+    """
+    windows = get_line_numbers_buffers().get(buf)
+    if windows:
+        invalidate_line_numbers(windows)
+        scheduler.schedule(10, "line_numbers", cb_timer_update_line_numbers)
+    return weechat.WEECHAT_RC_OK
+
+def cb_filters_changed(data, signal, signal_data):
+    """Filters changed the lines displayed: read the rows of the windows
+    again."""
+    if get_line_numbers_mode() != "screen":
+        window_rows.clear()
+        invalidate_line_numbers()
+        scheduler.schedule(10, "line_numbers", cb_timer_update_line_numbers)
     return weechat.WEECHAT_RC_OK
 
+def cb_window_closed(data, signal, signal_data):
+    """Forget a closed window (WeeChat reuses the pointers)."""
+    line_numbers_heights.pop(signal_data, None)
+    line_numbers_windows.pop(signal_data, None)
+    window_rows.pop(signal_data, None)
+    forget_line_numbers_buffers()
+    return weechat.WEECHAT_RC_OK
+
+def invalidate_line_numbers(windows=None):
+    """Render the line numbers of `windows` (all of them if None) again, the
+    next time the bar item is refreshed."""
+    if windows is None:
+        line_numbers_windows.clear()
+    for window in windows or ():
+        line_numbers_windows.pop(window, None)
+
 def cb_timer_update_line_numbers(data, remaining_calls):
-    """Update the line numbers bar item."""
-    weechat.bar_item_update("line_numbers")
+    """Update the line numbers bar item, if the chat's height changed (or
+    lines are numbered from the buffer's scrollback)."""
+    window = weechat.current_window()
+    height = weechat.window_get_integer(window, "win_chat_height")
+    # Windows whose buffer's line numbers didn't change use their previous
+    # content (see `line_numbers_windows`).
+    if (get_line_numbers_mode() != "screen" or
+            line_numbers_heights.get(window) != height):
+        update_bar_item("line_numbers")
+    return weechat.WEECHAT_RC_OK
+
+
+# Callbacks keeping the input line mirrors up to date (see `InputLine`).
+# -----------------------------------------------------------------------
+
+def cb_input_changed(data, signal, signal_data):
+    """Forget what we know of an input line changed outside of the script."""
+    if not writing_input:
+        state = buffer_states.get(signal_data)
+        if state is not None:
+            if signal == "input_text_changed":
+                state.input_line.text = None
+            state.input_line.pos = None
+    return weechat.WEECHAT_RC_OK
+
+def cb_buffer_switch(data, signal, signal_data):
+    """Forget the current buffer, it's read again when needed.
+
+    The mode and pending keys shown in the bar items are the new buffer's.
+    """
+    global current_buf, vi_buffer
+    current_buf = None
+    keys = get_key_parser().keys
+    if vi_buffer != keys:
+        vi_buffer = keys
+        update_bar_item("vi_buffer")
+    update_bar_item("mode_indicator")
+    return weechat.WEECHAT_RC_OK
+
+def cb_buffer_closed(data, signal, signal_data):
+    """Forget the state of a closed buffer."""
+    global current_buf
+    drop_buffer_state(signal_data)
+    scrollback_indexes.pop(signal_data, None)
+    forget_line_numbers_buffers()
+    current_buf = None
+    return weechat.WEECHAT_RC_OK
+
+def cb_unload():
+    """Write the pending changes to the options and viminfo file."""
+    cb_write_options("", 0)
+    viminfo.flush()
     return weechat.WEECHAT_RC_OK
 
 
 # Config.
 # -------
 
+# Options written by the script, see `write_option()`.
+pending_option_writes = set()
+# {option: value} for the writes `cb_config()` must ignore.
+own_option_writes = {}
+
 def cb_config(data, option, value):
-    """Script option changed, update our copy."""
+    """Script option changed, update our copy.
+
+    Only the derived state that depends on the option is rebuilt, see
+    `CONFIG_RELOADERS`.
+    """
     option_name = option.split(".")[-1]
+    if own_option_writes.get(option_name) == value:
+        # Written by `cb_write_options()`, the change is already applied.
+        del own_option_writes[option_name]
+        return weechat.WEECHAT_RC_OK
+    old_value = vimode_settings.get(option_name)
     if option_name in vimode_settings:
         vimode_settings[option_name] = value
-    if option_name.startswith('user_mappings'):
-        load_user_mappings()
-    if "_color" in option_name:
-        load_mode_colors()
-    if option_name == 'is_keyword':
-        load_is_keyword_regexes()
+    if old_value != value:
+        reload_option(option_name, old_value)
     return weechat.WEECHAT_RC_OK
 
-def load_mode_colors():
-    mode_colors.update({
-        'NORMAL': "{},{}".format(
-            vimode_settings['mode_indicator_normal_color'],
-            vimode_settings['mode_indicator_normal_color_bg']),
-        'INSERT': "{},{}".format(
-            vimode_settings['mode_indicator_insert_color'],
-            vimode_settings['mode_indicator_insert_color_bg']),
-        'REPLACE': "{},{}".format(
-            vimode_settings['mode_indicator_replace_color'],
-            vimode_settings['mode_indicator_replace_color_bg']),
-        'COMMAND': "{},{}".format(
-            vimode_settings['mode_indicator_cmd_color'],
-            vimode_settings['mode_indicator_cmd_color_bg']),
-        'SEARCH': "{},{}".format(
-            vimode_settings['mode_indicator_search_color'],
-            vimode_settings['mode_indicator_search_color_bg'])
-    })
+def reload_option(option, old_value):
+    """Rebuild the state derived from an option, see `CONFIG_RELOADERS`."""
+    for prefixes, reload_func in CONFIG_RELOADERS:
+        if option.startswith(prefixes):
+            reload_func(option, old_value)
+
+def apply_option_changes(changes):
+    """Apply a batch of option changes, as one transaction.
+
+    Each option's derived state is rebuilt once, and it's written once (see
+    `write_option()`), however many changes it gets.
+
+    Args:
+        changes (list): (option, lhs, value) changes, `lhs` being the keys
+            mapped to `value` for the user_mappings* options, and None for
+            the others.
+    """
+    old_values = {}
+    for option, lhs, value in changes:
+        if lhs is None:
+            if vimode_settings[option] != value:
+                old_values.setdefault(option, vimode_settings[option])
+                vimode_settings[option] = value
+        else:
+            # A new mapping replaces the one of the other option, and the
+            # vimrc's one until the file is sourced again.
+            other = ('user_mappings' if option.endswith('noremap') else
+                     'user_mappings_noremap')
+            replaced = vimrc_mappings.pop(lhs, None) is not None
+            if lhs in vimode_settings[other]:
+                del vimode_settings[other][lhs]
+                old_values.setdefault(other, None)
+                replaced = True
+            if vimode_settings[option].get(lhs) != value:
+                vimode_settings[option][lhs] = value
+                old_values.setdefault(option, None)
+            elif not replaced:
+                continue
+            update_user_mapping(lhs)
+    compile_user_mappings()
+    for option, old_value in old_values.items():
+        # The mappings were already applied.
+        if not option.startswith('user_mappings'):
+            reload_option(option, old_value)
+        write_option(option)
+
+def write_option(option):
+    """Write our copy of a script option to WeeChat's config.
+
+    Writes are batched: all the changes made while handling a key or a
+    command are written at once, serializing each option only once.
+    """
+    pending_option_writes.add(option)
+    scheduler.schedule(0, "write_options", cb_write_options)
+
+def cb_write_options(data, remaining_calls):
+    """Write the pending script options, see `write_option()`."""
+    while pending_option_writes:
+        option = pending_option_writes.pop()
+        value = vimode_settings[option]
+        if isinstance(value, dict):
+            value = json.dumps(value)
+        own_option_writes[option] = value
+        if (weechat.config_set_plugin(option, value) !=
+                weechat.WEECHAT_CONFIG_OPTION_SET_OK_CHANGED):
+            # `cb_config()` isn't called for unchanged values.
+            own_option_writes.pop(option, None)
+    return weechat.WEECHAT_RC_OK
+
+def reload_user_mappings(option, old_value):
+    """Apply the changes made to a user_mappings* option."""
+    if not isinstance(old_value, dict):
+        old_value = {}
+    apply_user_mappings(option, old_value)
+    compile_user_mappings()
+
+def reload_mode_indicators(option, old_value):
+    """Render the mode indicators again."""
+    load_mode_indicators()
+    update_bar_item("mode_indicator")
+
+def reload_is_keyword(option, old_value):
+    """Compile the is_keyword option again."""
+    load_is_keyword()
+
+def reload_clipboard(option, old_value):
+    """Stop the clipboard helper, it's started again with the new options."""
+    clipboard_helper.stop()
+
+def reload_line_numbers(option, old_value):
+    """Render the line numbers again."""
+    line_numbers_cache.clear()
+    invalidate_line_numbers()
+    hook_line_numbers_print()
+    update_bar_item("line_numbers")
+
+# (option name prefix(es), function(option, old_value)) to rebuild the state
+# derived from an option when it changes.
+CONFIG_RELOADERS = (
+    ("user_mappings", reload_user_mappings),
+    ("mode_indicator", reload_mode_indicators),
+    ("is_keyword", reload_is_keyword),
+    (("clipboard", "copy_clipboard", "paste_clipboard"), reload_clipboard),
+    ("line_number", reload_line_numbers),
+)
+
+def load_mode_indicators():
+    """Render the mode indicator of each mode, see `cb_mode_indicator()`."""
+    for mode, option in (("NORMAL", "normal"), ("INSERT", "insert"),
+                         ("REPLACE", "replace"), ("COMMAND", "cmd"),
+                         ("SEARCH", "search")):
+        color = "{},{}".format(
+            vimode_settings['mode_indicator_%s_color' % option],
+            vimode_settings['mode_indicator_%s_color_bg' % option])
+        mode_indicators[mode] = "{}{}{}{}{}".format(
+            weechat.color(color), vimode_settings['mode_indicator_prefix'],
+            mode, vimode_settings['mode_indicator_suffix'],
+            weechat.color("reset"))
 
 def load_user_mappings():
     """Load user-defined mappings."""
-    for key in ['user_mappings', 'user_mappings_noremap']:
-        noremap = key.endswith('noremap')
-        mappings = {}
-        if vimode_settings[key]:
-            if isinstance(vimode_settings[key], dict):
-                continue
-            mappings.update(json.loads(vimode_settings[key]))
-        vimode_settings[key] = mappings
-        for k, v in mappings.items():
-            key = normalize_keys(k)
-            VI_KEYS[key] = UserMapping(key, v, noremap=noremap)
-
-def load_is_keyword_regexes():
-    is_keyword = vimode_settings['is_keyword']
-    vimode_settings['is_keyword'] = re.compile(is_keyword)
-    keyword_regexes['w'] = re.compile(
-        r"(?<=[^{0}])[{0}]|(?<![^{0}\s])[^{0}\s]".format(is_keyword))
-    keyword_regexes['e'] = re.compile(
-        r"[{0}](?=[^{0}])|[^{0}\s](?![^{0}\s])".format(is_keyword))
-    keyword_regexes['iw'] = re.compile(
-        r"[{0}](?=[^{0}])|[^{0}\s](?![^{0}\s])|\s(?!\s)|.$".format(is_keyword))
+    for option in ('user_mappings', 'user_mappings_noremap'):
+        if not isinstance(vimode_settings[option], dict):
+            apply_user_mappings(option, {})
+    compile_user_mappings()
+
+def apply_user_mappings(option, old_mappings):
+    """Apply a user_mappings* option's new (JSON) value, as a diff.
+
+    Only the mappings added, changed or removed since `old_mappings` are
+    touched; our copy of the option is replaced by the decoded mappings.
+    """
+    mappings = {}
+    if vimode_settings[option]:
+        try:
+            mappings.update(json.loads(vimode_settings[option]))
+        except ValueError:
+            print_warning("Invalid {} option, ignoring the change."
+                          .format(option))
+            mappings = old_mappings
+    vimode_settings[option] = mappings
+    for lhs in old_mappings:
+        if lhs not in mappings:
+            update_user_mapping(lhs)
+    for lhs, rhs in mappings.items():
+        if old_mappings.get(lhs) != rhs:
+            update_user_mapping(lhs)
+
+def update_user_mapping(lhs):
+    """Map `lhs` as the vimrc files, or else the user_mappings* options, say
+    (compiled by `compile_user_mappings()`).
+
+    Without any mapping left, the default key (if any) is restored.
+    """
+    keys = normalize_keys(lhs)
+    if lhs in vimrc_mappings:
+        option, rhs = vimrc_mappings[lhs][:2]
+    else:
+        # Loaded last, the non-recursive mappings used to win.
+        for option in ['user_mappings_noremap', 'user_mappings']:
+            if lhs in vimode_settings[option]:
+                rhs = vimode_settings[option][lhs]
+                break
+        else:
+            if (keys in VI_KEYS.user and
+                    isinstance(VI_KEYS.user[keys], UserMapping)):
+                del VI_KEYS[keys]
+            return
+    noremap = option.endswith('noremap')
+    mapping = VI_KEYS.user[keys] if keys in VI_KEYS.user else None
+    if (not isinstance(mapping, UserMapping) or mapping.rhs != rhs or
+            mapping.noremap != noremap):
+        VI_KEYS[keys] = UserMapping(keys, rhs, noremap=noremap)
+
+def compile_user_mappings():
+    """Compile the new or invalidated mappings.
+
+    Mappings are compiled now (rather than on first use), so that parsing
+    errors and recursion cycles are reported right away.
+    """
+    while uncompiled_mappings:
+        mapping = uncompiled_mappings.pop()
+        if is_mapped(mapping):
+            mapping.compile()
+
+def load_is_keyword():
+    """Compile the is_keyword option (see `KeywordClasses`)."""
+    global keyword_classes, line_index
+    try:
+        keyword_classes = KeywordClasses(vimode_settings['is_keyword'])
+    except re.error:
+        print_warning("Invalid is_keyword option: \"{}\", using the default."
+                      .format(vimode_settings['is_keyword']))
+        keyword_classes = KeywordClasses("@,48-57,_,192-255")
+    # Word stops depend on the classes.
+    line_index = None
 
 # Command-line execution.
 # -----------------------
 
-def cb_exec_cmd(data, remaining_calls):
-    """Translate and execute our custom commands to WeeChat command."""
-    # Process the entered command.
-    data = list(data)
-    del data[0]
-    data = "".join(data)
-    # s/foo/bar command.
-    if data.startswith("s/"):
-        cmd = data
-        parsed_cmd = next(csv.reader(StringIO(cmd), delimiter="/",
-                                     escapechar="\\"))
-        pattern = re.escape(parsed_cmd[1])
-        repl = parsed_cmd[2]
-        repl = re.sub(r"([^\\])&", r"\1" + pattern, repl)
-        flag = None
-        if len(parsed_cmd) == 4:
-            flag = parsed_cmd[3]
-        count = 1
-        if flag == "g":
-            count = 0
-        buf = weechat.current_buffer()
-        input_line = weechat.buffer_get_string(buf, "input")
-        input_line = re.sub(pattern, repl, input_line, count)
-        weechat.buffer_set(buf, "input", input_line)
+class ExCommand(object):
+    """An ex command, parsed by `parse_ex_command()`.
+
+    Attributes:
+        text (str): the command, as typed (without its ":").
+        range (tuple): the (start, end) addresses, each None if it's omitted.
+            None if there's no range.
+        name (str): the command's name, None if there's none (e.g. ":22").
+        bang (bool): whether the name is followed by "!".
+        count (str): digits following the name (e.g. "2" in ":b2"), "" if
+            there are none.
+        args (str): the arguments.
+    """
+    __slots__ = ("text", "range", "name", "bang", "count", "args")
+
+    def __init__(self, text, range_, name, bang, count, args):
+        self.text = text
+        self.range = range_
+        self.name = name
+        self.bang = bang
+        self.count = count
+        self.args = args
+
+def parse_ex_command(text):
+    """Parse an ex command (without its ":"), in one pass of
+    `REGEX_EX_COMMAND`.
+
+    Returns:
+        ExCommand: the parsed command.
+    """
+    match = REGEX_EX_COMMAND.match(text)
+    range_ = None
+    if match.group("range") == "%":
+        range_ = ("1", "$")
+    elif match.group("range"):
+        range_ = (match.group("start"), match.group("end"))
+    return ExCommand(text, range_, match.group("name"),
+                     match.group("bang") is not None,
+                     match.group("count") or "", match.group("args"))
+
+def resolve_address(address, current, last):
+    """Return the line number of an address of a range.
+
+    Args:
+        address (str): e.g. "22", "." or "$-3", None to get `current`.
+        current (int): the current line.
+        last (int): the last line.
+    """
+    if address is None:
+        return current
+    if address[0] == "$":
+        line = last
+    elif address[0].isdigit():
+        line = int(REGEX_EX_OFFSET.split(address, 1)[0])
+    else:
+        line = current
+    for offset in REGEX_EX_OFFSET.findall(address):
+        line += int(offset) if len(offset) > 1 else int(offset + "1")
+    return line
+
+def get_current_lines():
+    """Return the current and last lines of the current window, for ranges.
+
+    The current line is the one at the bottom of the window. As with the
+    line_numbers_mode option, lines are rows of the window in "screen" mode,
+    and lines of the buffer otherwise.
+
+    Returns:
+        tuple: (current line, last line).
+    """
+    window = weechat.current_window()
+    if get_line_numbers_mode() == "screen":
+        height = weechat.window_get_integer(window, "win_chat_height")
+        return height, height
+    rows = get_window_lines(window) or []
+    indexes = [row[1] for row in rows if row is not None]
+    if not indexes:
+        return 1, 1
+    buf = weechat.window_get_pointer(window, "buffer")
+    return indexes[-1] + 1, get_scrollback_index(buf).count
+
+def cursor_to_line(number):
+    """Start cursor mode (``/cursor``) on line `number`: a row of the window,
+    or a line of the buffer, depending on the line_numbers_mode option."""
+    hdata_window = weechat.hdata_get("window")
+    window = weechat.current_window()
+    if get_line_numbers_mode() != "screen":
+        row = go_to_line(max(number, 1))
+    else:
+        height = weechat.hdata_integer(hdata_window, window,
+                                       "win_chat_height")
+        row = min(max(number, 1), height) - 1
+    x = weechat.hdata_integer(hdata_window, window, "win_chat_x")
+    y = weechat.hdata_integer(hdata_window, window, "win_chat_y") + row
+    run_command("", "/cursor go {},{}".format(x, y))
+
+def run_ex_command(ex, wait=True):
+    """Run an ex command, translating our vi commands to WeeChat commands.
+
+    Args:
+        ex (ExCommand): the command.
+        wait (bool, optional): run other commands with ``/wait``, to avoid
+            crashing WeeChat on script reloads/unloads (see
+            <https://github.com/weechat/weechat/issues/1246>). Defaults to
+            True.
+    """
+    # A range alone goes to its last line (e.g. `:22`).
+    if ex.name is None and ex.range is not None:
+        current, last = get_current_lines()
+        cursor_to_line(resolve_address(ex.range[1] or ex.range[0], current,
+                                       last))
+    # s/foo/bar command. There's only one line, so any range will do.
+    elif ex.name == "s":
+        substitution = parse_substitute("s" + ex.args)
+        buf = get_current_buffer()
+        input_line = None
+        if substitution is not None:
+            input_line = substitution.apply(get_input(buf))
+        if input_line is None:
+            print_warning("Invalid substitution: :%s" % ex.text)
+        else:
+            set_input(buf, input_line)
+    elif ex.range is not None:
+        print_warning("No range allowed: :%s" % ex.text)
     # Shell command.
-    elif data.startswith("!"):
-        weechat.command("", "/exec -buffer shell %s" % data[1:])
-    # Commands like `:22`. This should start cursor mode (``/cursor``) and take
-    # us to the relevant line.
-    elif data.isdigit():
-        line_number = int(data)
-        hdata_window = weechat.hdata_get("window")
-        window = weechat.current_window()
-        x = weechat.hdata_integer(hdata_window, window, "win_chat_x")
-        y = (weechat.hdata_integer(hdata_window, window, "win_chat_y") +
-             (line_number - 1))
-        weechat.command("", "/cursor go {},{}".format(x, y))
-    # Check againt defined commands.
-    elif data:
-        raw_data = data
-        data = data.split(" ", 1)
-        cmd = data[0]
-        args = ""
-        if len(data) == 2:
-            args = data[1]
-        if cmd in VI_COMMANDS:
-            if isinstance(VI_COMMANDS[cmd], str):
-                weechat.command("", "%s %s" % (VI_COMMANDS[cmd], args))
-            else:
-                VI_COMMANDS[cmd](args)
+    elif ex.name == "!":
+        run_command("", "/exec -buffer shell %s" % ex.args)
+    elif ex.name in VI_COMMANDS:
+        args = " ".join(arg for arg in (ex.count, ex.args) if arg)
+        if isinstance(VI_COMMANDS[ex.name], str):
+            run_command("", "%s %s" % (VI_COMMANDS[ex.name], args))
         else:
-            # Check for commands not sepearated by space (e.g. "b2")
-            for i in range(1, len(raw_data)):
-                tmp_cmd = raw_data[:i]
-                tmp_args = raw_data[i:]
-                if tmp_cmd in VI_COMMANDS and tmp_args.isdigit():
-                    weechat.command("", "%s %s" % (VI_COMMANDS[tmp_cmd],
-                                                   tmp_args))
-                    return weechat.WEECHAT_RC_OK
-            # No vi commands found, run the command as WeeChat command
-            # We /wait to avoid crashing WeeChat on script reloads/unloads
-            # (see <https://github.com/weechat/weechat/issues/1246>)
-            weechat.command("", "/wait 1ms /{} {}".format(cmd, args))
+            VI_COMMANDS[ex.name](args)
+    # Other commands are WeeChat's.
+    elif ex.text.strip():
+        run_command("", "{}/{}".format("/wait 1ms " if wait else "",
+                                       ex.text.strip()))
+
+@edit_transaction
+def cb_exec_cmd(data, remaining_calls):
+    """Translate and execute our custom commands to WeeChat command."""
+    run_ex_command(parse_ex_command(data[1:]))
     return weechat.WEECHAT_RC_OK
 
+@edit_transaction
 def cb_vimode_go_to_normal(data, buf, args):
     set_mode("NORMAL")
     return weechat.WEECHAT_RC_OK
@@ -1894,15 +3362,52 @@ def cb_vimode_cmd(data, buf, args):
         if args == "bind_keys":
             weechat.prnt("", "Running commands:")
             for command in commands:
-                weechat.command("", command)
+                run_command("", command)
             weechat.prnt("", "Done.")
         elif args == "bind_keys --list":
             weechat.prnt("", "Listing commands we'll run:")
             for command in commands:
                 weechat.prnt("", "    %s" % command)
             weechat.prnt("", "Done.")
+    # ``/vimode stats [on|off|reset]``
+    elif args.split(" ", 1)[0] == "stats":
+        arg = args[len("stats"):].strip()
+        if arg in ["on", "off"]:
+            set_api_counting(arg == "on")
+        elif arg == "reset":
+            api_stats.update(events=0, total=0, max=0, last=0, last_event="")
+        print_stats()
     return weechat.WEECHAT_RC_OK
 
+def print_stats():
+    """Print debug statistics (see ``/vimode stats``)."""
+    weechat.prnt("", "[vimode.py] Deferred tasks: %s run, %s pending." %
+                 (scheduler.tasks_run, scheduler.pending()))
+    weechat.prnt("", "[vimode.py] Buffer states: %s, using about %.1f KiB"
+                     " (undo history: %s characters)." %
+                 (len(buffer_states),
+                  sum(state.get_size() for state in buffer_states.values()) /
+                  1024.0, undo_size))
+    if api_counter is None:
+        weechat.prnt("", "[vimode.py] API call counting is off (use"
+                         " \"/vimode stats on\" to start it).")
+        return
+    events = api_stats['events']
+    weechat.prnt("", "[vimode.py] WeeChat API calls per event: last: %s (%s),"
+                     " max: %s, average: %.1f over %s events." %
+                 (api_stats['last'], api_stats['last_event'] or "-",
+                  api_stats['max'],
+                  api_stats['total'] / float(max(events, 1)), events))
+
+def set_api_counting(enabled):
+    """Start or stop counting WeeChat API calls, see `APICounter`."""
+    global weechat, api_counter
+    if enabled and api_counter is None:
+        api_counter = weechat = APICounter(weechat)
+    elif not enabled and api_counter is not None:
+        weechat = api_counter.module
+        api_counter = None
+
 
 # Helpers.
 # ========
@@ -1912,36 +3417,51 @@ def cb_vimode_cmd(data, buf, args):
 def do_command(cmd, buf, input_line, cur, count):
     """Execute WeeChat Command"""
     for _ in range(max(count, 1)):
-        weechat.command("", cmd)
-        current_cur = weechat.buffer_get_integer(buf, "input_pos")
+        run_command("", cmd)
+        current_cur = get_cur(buf)
         set_cur(buf, input_line, current_cur)
 
-def do_motion(keys, buf, input_line, cur, count):
-    """Perform Vim-like Motion"""
-    if keys in SPECIAL_CHARS:
-        func = "motion_%s" % SPECIAL_CHARS[keys]
-    else:
-        func = "motion_%s" % keys
-    _, end, _, _ = globals()[func](input_line, cur, count)
+def do_ex_command(ex, buf, input_line, cur, count):
+    """Run an ex command `count` times, see `run_ex_command()`."""
+    for _ in range(max(count, 1)):
+        run_ex_command(ex, False)
+        current_cur = get_cur(buf)
+        set_cur(buf, input_line, current_cur)
+
+def do_motion(motion, buf, input_line, cur, count):
+    """Perform Vim-like Motion
+
+    `motion` is a `Motion`, see `register_motion()`.
+    """
+    _, end, _, _ = motion.func(input_line, cur, count)
     set_cur(buf, input_line, end)
 
-def do_operator(keys, buf, input_line, cur, count):
+def do_operator(operator, motion, buf, input_line, cur, count):
+    """Perform Vim-like Operator over a Motion
+
+    `operator` is an `Operator` and `motion` a `Motion`, see
+    `register_operator()` and `register_motion()`.
+    """
     add_undo_history(buf, input_line)
-    if keys[1:] in SPECIAL_CHARS:
-        func = "motion_%s" % SPECIAL_CHARS[keys[1:]]
-    else:
-        func = "motion_%s" % keys[1:]
-    pos1, pos2, overwrite, catching = globals()[func](input_line, cur, count)
-    # See vim's "Special case" in :help cw
-    is_keyword = vimode_settings['is_keyword']
-    if keys in ["cw", "cW"] and is_keyword.match(input_line[cur]):
-        pos2 -= 1
+    pos1, pos2, overwrite, catching = motion.func(input_line, cur, count)
+    # See vim's "Special case" in :help cw: in a word, "cw" and "cW" change up
+    # to the end of the word, like "ce" and "cE".
+    if (operator.key == "c" and motion.keys in ["w", "W"] and
+            cur < len(input_line) and
+            keyword_classes.get_class(input_line[cur]) != CLASS_BLANK):
+        if motion.keys == "w":
+            stops = STOPS_WORD_END
+        else:
+            stops = REGEX_MOTION_UPPERCASE_E
+        pos2 = get_line_index(input_line).next(stops, cur - 1, count)
+        overwrite = pos2 != -1
+        if not overwrite:
+            pos2 = len(input_line)
     # If it's a catching motion, we don't want to call the operator just
     # yet -- this code will run again when the motion is complete, at which
     # point we will.
     if not catching:
-        oper = "operator_%s" % keys[0]
-        globals()[oper](buf, input_line, pos1, pos2, overwrite)
+        operator.func(buf, input_line, pos1, pos2, overwrite)
 
 def get_pos(data, regex, cur, ignore_cur=False, count=0):
     """Return the position of `regex` match in `data`, starting at `cur`.
@@ -1956,25 +3476,236 @@ def get_pos(data, regex, cur, ignore_cur=False, count=0):
         count (int, optional): the index of the match to return. Defaults to 0.
 
     Returns:
-        int: position of the match. -1 if no matches are found.
-    """
-    # List of the *positions* of the found patterns.
-    matches = [m.start() for m in re.finditer(regex, data[cur:])]
-    pos = -1
-    if count:
-        if len(matches) > count - 1:
-            if ignore_cur and matches[0] == 0:
-                if len(matches) > count:
-                    pos = matches[count]
-            else:
-                pos = matches[count - 1]
-    elif matches:
-        if ignore_cur and matches[0] == 0:
-            if len(matches) > 1:
-                pos = matches[1]
+        int: position of the match, relative to `cur`. -1 if no matches are
+            found.
+    """
+    # Matches are only looked for until the one we need is found, without
+    # copying the rest of `data`.
+    count = max(count, 1)
+    for match in re.compile(regex).finditer(data, cur):
+        pos = match.start() - cur
+        if ignore_cur and pos == 0:
+            continue
+        count -= 1
+        if not count:
+            return pos
+    return -1
+
+class KeywordClasses(object):
+    """Classify characters as blanks, punctuation or keyword characters.
+
+    Word motions stop where the class of characters changes (see
+    `LineIndex.get_word_stops()`).
+
+    `is_keyword` is either in vim's 'iskeyword' format (e.g.
+    "@,48-57,_,192-255", see :help 'iskeyword') or a regex character class
+    (e.g. "a-zA-Z0-9_À-ÿ"). Characters below 256 are looked up in a table
+    built once. Other characters are keyword characters if `is_keyword` lists
+    them or if they're letters or digits, as in vim; their classes are cached
+    as they're met.
+    """
+    __slots__ = ("table", "wide", "ranges", "regex")
+
+    def __init__(self, is_keyword):
+        # Classes of characters below 256.
+        self.table = bytearray(256)
+        # {code point: class} for other characters.
+        self.wide = {}
+        # (first, last, excluded) ranges of code points above 255 listed in
+        # vim's format, or the regex matching keyword characters.
+        self.ranges = []
+        self.regex = None
+        parts = [part for part in is_keyword.split(",") if part]
+        if all(REGEX_IS_KEYWORD_PART.match(part) for part in parts):
+            listed = self.load_vim_format(parts)
         else:
-            pos = matches[0]
-    return pos
+            self.regex = re.compile("[{}]".format(is_keyword))
+            listed = [self.regex.match(chr(code)) is not None
+                      for code in range(256)]
+        for code in range(256):
+            self.table[code] = self.classify(chr(code), listed[code])
+
+    def load_vim_format(self, parts):
+        """Parse `parts` of vim's 'iskeyword' format.
+
+        Returns:
+            bytearray: for each code point below 256, whether it's listed.
+        """
+        listed = bytearray(256)
+        for part in parts:
+            excluded, first, last = REGEX_IS_KEYWORD_PART.match(part).groups()
+            if first == "@" and last is None:
+                codes = [code for code in range(256) if chr(code).isalpha()]
+            else:
+                first = int(first) if first.isdigit() else ord(first[0])
+                if last is None:
+                    last = first
+                else:
+                    last = int(last) if last.isdigit() else ord(last)
+                codes = range(first, min(last, 255) + 1)
+                if last > 255:
+                    self.ranges.append((max(first, 256), last, bool(excluded)))
+            for code in codes:
+                listed[code] = not excluded
+        return listed
+
+    def is_listed(self, char):
+        """Return True if `is_keyword` lists `char` (above 255)."""
+        if self.regex is not None:
+            return self.regex.match(char) is not None
+        listed = False
+        code = ord(char)
+        for first, last, excluded in self.ranges:
+            if first <= code <= last:
+                listed = not excluded
+        return listed
+
+    @staticmethod
+    def classify(char, listed):
+        """Return the class of `char`, `listed` in `is_keyword` or not."""
+        if listed:
+            return CLASS_KEYWORD
+        if char.isspace():
+            return CLASS_BLANK
+        if ord(char) > 255 and char.isalnum():
+            return CLASS_KEYWORD
+        return CLASS_PUNCTUATION
+
+    def get_class(self, char):
+        """Return the class of `char`: `CLASS_BLANK`, `CLASS_PUNCTUATION` or
+        `CLASS_KEYWORD`."""
+        code = ord(char)
+        if code < 256:
+            return self.table[code]
+        char_class = self.wide.get(code)
+        if char_class is None:
+            char_class = self.classify(char, self.is_listed(char))
+            self.wide[code] = char_class
+        return char_class
+
+class LineIndex(object):
+    """Positions where motions stop in an input line, found once per line.
+
+    The stops of a motion (e.g. every word start for "w") or the occurrences
+    of a character (for "f", "t", ";", etc.) are listed the first time
+    they're needed. Repeating motions on the same line (e.g. holding "w") then
+    only bisects these lists. See `get_line_index()`.
+
+    Regexes must match single characters.
+    """
+    __slots__ = ("text", "positions")
+
+    def __init__(self, text):
+        self.text = text
+        # {STOPS_* constant, regex or text: sorted list of positions}.
+        self.positions = {}
+
+    def get_word_stops(self):
+        """List the stops of word motions (`STOPS_*`), in a single pass.
+
+        Words are runs of keyword characters or of punctuation (see
+        `KeywordClasses`). Word starts are also where "b" stops and word
+        ends where "ge" stops. "iw" selects blanks as well, so it also stops
+        at the start and end of runs of blanks, and at the line's ends.
+        """
+        text = self.text
+        get_class = keyword_classes.get_class
+        classes = [get_class(char) for char in text]
+        last = len(text) - 1
+        starts, ends, iw_starts, iw_ends = [], [], [], []
+        # Besides the line's ends, "iw" stops at the second character if the
+        # line starts with a newline, and before the last one if it ends
+        # with one.
+        iw_first, iw_last = 0, last
+        if text[:1] == "\n" and text[1:2] != "\n":
+            iw_first += 1
+        if text[-1:] == "\n" and text[-2:-1] != "\n":
+            iw_last -= 1
+        previous = None
+        for pos, char_class in enumerate(classes):
+            following = classes[pos + 1] if pos < last else None
+            if char_class == CLASS_BLANK:
+                start = previous != CLASS_BLANK
+                end = following != CLASS_BLANK
+            else:
+                start = (char_class != previous and
+                         (previous is not None or
+                          char_class == CLASS_PUNCTUATION))
+                end = (char_class != following and
+                       (following is not None or
+                        char_class == CLASS_PUNCTUATION))
+                if start:
+                    starts.append(pos)
+                if end:
+                    ends.append(pos)
+            if start or pos <= iw_first:
+                iw_starts.append(pos)
+            if end or pos >= iw_last:
+                iw_ends.append(pos)
+            previous = char_class
+        self.positions[STOPS_WORD_START] = starts
+        self.positions[STOPS_WORD_END] = ends
+        self.positions[STOPS_IW_START] = iw_starts
+        self.positions[STOPS_IW_END] = iw_ends
+
+    def get_positions(self, what):
+        """Return the positions of `what`, a `STOPS_*` constant, a regex or a
+        text."""
+        positions = self.positions.get(what)
+        if positions is None:
+            if isinstance(what, int):
+                self.get_word_stops()
+                return self.positions[what]
+            if isinstance(what, str):
+                positions = []
+                pos = self.text.find(what)
+                while pos != -1:
+                    positions.append(pos)
+                    pos = self.text.find(what, pos + 1)
+            else:
+                positions = [match.start() for match in
+                             what.finditer(self.text)]
+            self.positions[what] = positions
+        return positions
+
+    def next(self, what, cur, count=0):
+        """Return the `count`'th position of `what` after `cur`.
+
+        Args:
+            what (pattern or str): a regex or the text to look for.
+            cur (int): only positions after `cur` are considered.
+            count (int, optional): defaults to 0 (same as 1).
+
+        Returns:
+            int: the position, or -1 if there are not enough positions.
+        """
+        positions = self.get_positions(what)
+        index = bisect.bisect_right(positions, cur) + max(count, 1) - 1
+        if index < len(positions):
+            return positions[index]
+        return -1
+
+    def previous(self, what, cur, count=0):
+        """Return the `count`'th position of `what` before `cur`.
+
+        See Also:
+            `LineIndex.next()`.
+        """
+        positions = self.get_positions(what)
+        index = bisect.bisect_left(positions, cur) - max(count, 1)
+        if index >= 0:
+            return positions[index]
+        return -1
+
+def get_line_index(input_line):
+    """Return the `LineIndex` for `input_line`.
+
+    The index of the last line is kept, and replaced when the line changes.
+    """
+    global line_index
+    if line_index is None or line_index.text != input_line:
+        line_index = LineIndex(input_line)
+    return line_index
 
 def set_cur(buf, input_line, pos, cap=True):
     """Set the cursor's position.
@@ -1988,13 +3719,13 @@ def set_cur(buf, input_line, pos, cap=True):
     """
     if cap:
         pos = min(pos, len(input_line) - 1)
-    weechat.buffer_set(buf, "input_pos", str(pos))
+    set_pos(buf, pos)
 
 def start_catching_keys(amount, callback, input_line, cur, count, buf=None):
     """Start catching keys. Used for special commands (e.g. "f", "r").
 
     amount (int): amount of keys to catch.
-    callback (str): name of method to call once all keys are caught.
+    callback (callable): function to call once all keys are caught.
     input_line (str): input line's content.
     cur (int): cursor's position.
     count (int): count, e.g. "2" for "2fs".
@@ -2008,7 +3739,7 @@ def start_catching_keys(amount, callback, input_line, cur, count, buf=None):
     When catching keys is active, normal pressed keys (e.g. "a" but not arrows)
     will get added to `catching_keys_data` under the key "keys", and will not
     be handled any further.
-    Once all keys are caught, the method defined in the "callback" key is
+    Once all keys are caught, the function stored under the "callback" key is
     called, and can use the data in `catching_keys_data` to perform its action.
     """
     global catching_keys_data
@@ -2026,124 +3757,1672 @@ def start_catching_keys(amount, callback, input_line, cur, count, buf=None):
                            'buf': buf})
     return cur, cur, False, True
 
-def get_keys_and_count(combo):
-    """Check if `combo` is a valid combo and extract keys/counts if so.
 
-    Args:
-        combo (str): pressed keys combo.
+# Undo history.
+# -------------
 
-    Returns:
-        matched (bool): True if the combo has a (partial or full) match, False
-            otherwise.
-        combo (str): `combo` with the count removed. These are the actual keys
-            we should handle. User mappings are also expanded.
-        count (int): count for `combo`.
-    """
-    # Look for a potential match (e.g. "d" might become "dw" or "dd" so we
-    # accept it, but "d9" is invalid).
-    matched = False
-    # Digits are allowed at the beginning (counts or "0").
-    count = 0
-    if combo.isdigit():
-        matched = True
-    elif combo and combo[0].isdigit():
-        count = ""
-        for char in combo:
-            if char.isdigit():
-                count += char
-            else:
+class UndoState(object):
+    """A state of the input line in an `UndoTree`.
+
+    A state only stores how its parent's text was changed into its own:
+    `deleted` was replaced with `inserted` at `offset`.
+
+    Attributes:
+        parent (UndoState): None for the root of the tree.
+        children (list): the states changed from this one.
+        redo_child (UndoState): the child state "redo" goes to (the last one
+            created or undone).
+        seq (int): the change number in the buffer, see `UndoTree.seq_last`.
+    """
+    __slots__ = ("parent", "children", "redo_child", "seq", "offset",
+                 "deleted", "inserted")
+
+    def __init__(self, parent, seq, offset=0, deleted="", inserted=""):
+        self.parent = parent
+        self.children = []
+        self.redo_child = None
+        self.seq = seq
+        self.offset = offset
+        self.deleted = deleted
+        self.inserted = inserted
+
+    @property
+    def size(self):
+        """Characters stored for this state."""
+        return len(self.deleted) + len(self.inserted)
+
+    def undo(self, text):
+        """Return the parent's text, from this state's `text`."""
+        end = self.offset + len(self.inserted)
+        return text[:self.offset] + self.deleted + text[end:]
+
+    def redo(self, text):
+        """Return this state's text, from the parent's `text`."""
+        end = self.offset + len(self.deleted)
+        return text[:self.offset] + self.inserted + text[end:]
+
+
+class UndoTree(object):
+    """Undo history of an input line, as in vim (see :help undo-tree).
+
+    Only the text of the current state is kept, other states are reached by
+    undoing and redoing changes from it. Making a change after an undo starts
+    a new branch: "u"/Ctrl-R move along the current branch, while "g-"/"g+"
+    go through all the states in the order they were created.
+
+    Attributes:
+        root (UndoState): the oldest state remembered.
+        current (UndoState): the state of `text`.
+        text (str): the text of the current state.
+        states (dict): {seq: `UndoState`}.
+        seq_last (int): the number of the last change made.
+        size (int): characters stored for all the states.
+    """
+    __slots__ = ("root", "current", "text", "states", "seq_last", "size")
+
+    def __init__(self):
+        self.root = self.current = UndoState(None, 0)
+        self.text = ""
+        self.states = {0: self.root}
+        self.seq_last = 0
+        self.size = 0
+
+    def add(self, text):
+        """Record the change of the current text into `text`.
+
+        Returns:
+            int: the characters added to `size`.
+        """
+        old = self.text
+        if text == old:
+            return 0
+        # Only keep what changed, between the common prefix and suffix.
+        start = 0
+        limit = min(len(old), len(text))
+        while start < limit and old[start] == text[start]:
+            start += 1
+        end = 0
+        limit -= start
+        while end < limit and old[-1 - end] == text[-1 - end]:
+            end += 1
+        self.seq_last += 1
+        state = UndoState(self.current, self.seq_last, start,
+                          old[start:len(old) - end],
+                          text[start:len(text) - end])
+        self.current.children.append(state)
+        self.current.redo_child = state
+        self.states[state.seq] = state
+        self.current = state
+        self.text = text
+        self.size += state.size
+        return state.size
+
+    def get_undo_target(self, count):
+        """Return the state `count` changes up the current branch."""
+        state = self.current
+        for _ in range(max(count, 1)):
+            if state.parent is None:
                 break
-        combo = combo.replace(count, "", 1)
-        count = int(count)
-    # It's a WeeChat command.
-    if not matched and combo.startswith("/"):
-        matched = True
-    # Check against defined keys.
-    if not matched:
-        for key in VI_KEYS:
-            if key.startswith(combo):
-                matched = True
+            state = state.parent
+        return state
+
+    def get_redo_target(self, count):
+        """Return the state `count` changes down the current branch."""
+        state = self.current
+        for _ in range(max(count, 1)):
+            if state.redo_child is None:
                 break
-    # Check against defined motions.
-    if not matched:
-        for motion in VI_MOTIONS:
-            if motion.startswith(combo):
-                matched = True
+            state = state.redo_child
+        return state
+
+    def get_seq_target(self, offset):
+        """Return the state `offset` changes away in time (e.g. -1 for the
+        previous one)."""
+        seqs = sorted(self.states)
+        index = bisect.bisect_left(seqs, self.current.seq) + offset
+        return self.states[seqs[max(0, min(index, len(seqs) - 1))]]
+
+    def move_to(self, target):
+        """Make `target` the current state and return its text."""
+        ancestors = set()
+        state = target
+        while state is not None:
+            ancestors.add(state)
+            state = state.parent
+        # Undo up to the common ancestor, then redo down to the target.
+        text = self.text
+        state = self.current
+        while state not in ancestors:
+            text = state.undo(text)
+            state.parent.redo_child = state
+            state = state.parent
+        redos = []
+        while target is not state:
+            redos.append(target)
+            target = target.parent
+        for target in reversed(redos):
+            text = target.redo(text)
+            target.parent.redo_child = target
+        self.current = target
+        self.text = text
+        return text
+
+    def get_size(self):
+        """Return an estimate of the memory used by the tree, in bytes."""
+        size = sys.getsizeof(self) + sys.getsizeof(self.states)
+        for state in self.states.values():
+            size += (sys.getsizeof(state) + sys.getsizeof(state.children) +
+                     sys.getsizeof(state.deleted) +
+                     sys.getsizeof(state.inserted))
+        return size
+
+    def evict(self):
+        """Forget the oldest change.
+
+        Branches that don't lead to the current state are dropped first (the
+        oldest one first), then the root is dropped for its child.
+
+        Returns:
+            int: the characters removed from `size`, 0 if there's only the
+            current state left.
+        """
+        root = self.root
+        if not root.children:
+            return 0
+        # Child of the root leading to the current state.
+        state = self.current
+        while state.parent is not None and state.parent is not root:
+            state = state.parent
+        dead = [child for child in root.children if child is not state]
+        if dead:
+            oldest = min(dead, key=lambda child: child.seq)
+            root.children.remove(oldest)
+            if root.redo_child is oldest:
+                root.redo_child = state if state is not root else None
+            size = 0
+            branch = [oldest]
+            while branch:
+                child = branch.pop()
+                branch.extend(child.children)
+                del self.states[child.seq]
+                size += child.size
+        else:
+            del self.states[root.seq]
+            size = state.size
+            state.parent = None
+            state.deleted = state.inserted = ""
+            self.root = state
+        self.size -= size
+        return size
+
+
+def add_undo_history(buf, input_line):
+    """Record `input_line` in the undo tree of `buf` if it changed.
+
+    The oldest changes are forgotten if the undo history gets bigger than
+    the undo_max_size or undo_max_size_total options allow.
+
+    Returns:
+        UndoTree: the undo tree of `buf`.
+    """
+    global undo_size
+    tree = get_buffer_state(buf).undo
+    added = tree.add(input_line)
+    if not added:
+        return tree
+    undo_size += added
+    max_size = get_limit_option('undo_max_size')
+    while max_size and tree.size > max_size:
+        freed = tree.evict()
+        if not freed:
+            break
+        undo_size -= freed
+    # Trim the least recently used buffers first.
+    max_size = get_limit_option('undo_max_size_total')
+    trees = iter([state.undo for state in buffer_states.values()])
+    oldest = next(trees, None)
+    while max_size and undo_size > max_size and oldest is not None:
+        freed = oldest.evict()
+        if freed:
+            undo_size -= freed
+        else:
+            oldest = next(trees, None)
+    return tree
+
+def clear_undo_history(buf):
+    """Clear the undo history for a given buffer."""
+    global undo_size
+    state = get_buffer_state(buf)
+    undo_size -= state.undo.size
+    state.undo = UndoTree()
+
+def undo_to(buf, tree, state):
+    """Restore the input line of `buf` to `state` of its undo `tree`."""
+    if state is not tree.current:
+        set_input(buf, tree.move_to(state))
+
+
+# Clipboard.
+# ----------
+
+# Yanks and pastes never wait for the clipboard: depending on the clipboard
+# option, the text is handed to a process WeeChat runs in the background (see
+# `copy_process()`), to a helper process started once (see
+# `ClipboardHelper`), or written to the terminal as an OSC 52 escape sequence
+# (see `copy_osc52()`).
+
+# Run by `ClipboardHelper`, with copy_clipboard_cmd and paste_clipboard_cmd as
+# arguments. Requests are a "<copy|paste> <length>" line followed by `length`
+# bytes of text to copy. Pastes are answered with a "<return code> <length>"
+# line followed by the pasted text.
+CLIPBOARD_HELPER = r"""
+import subprocess, sys
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+while True:
+    request = stdin.readline().split()
+    if not request:
+        break
+    text = stdin.read(int(request[1]))
+    if request[0] == b"copy":
+        proc = subprocess.Popen(sys.argv[1], shell=True, stdin=subprocess.PIPE)
+        proc.communicate(text)
+    else:
+        proc = subprocess.Popen(sys.argv[2], shell=True,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        header = "%d %d\n" % (proc.returncode, len(output))
+        stdout.write(header.encode() + output)
+        stdout.flush()
+"""
+
+# Delay in ms given to a stopped helper to exit, before it's killed (see
+# `ClipboardHelper.stop()`).
+CLIPBOARD_HELPER_EXIT_DELAY = 1000
+# Stopped helpers that were still running, see `cb_reap_clipboard_helpers()`.
+stopped_clipboard_helpers = []
+
+class ClipboardHelper(object):
+    """Long-lived process running the clipboard commands for the script.
+
+    WeeChat is only forked once to start it, and talks to it over pipes
+    watched with `hook_fd`, so that neither yanks nor pastes ever block.
+
+    Attributes:
+        proc (subprocess.Popen): the helper process, None until needed.
+        hooks (list): the `hook_fd` hooks on its pipes.
+        pending_input (bytes): requests not written to the helper yet, when
+            its stdin is full.
+        output (bytes): what the helper wrote that isn't handled yet.
+        pastes (list): (buf, count, before) for the pastes waiting for the
+            clipboard's content, oldest first. See `put_register()`.
+    """
+    __slots__ = ("proc", "hooks", "pending_input", "output", "pastes")
+
+    def __init__(self):
+        self.proc = None
+        self.hooks = []
+        self.pending_input = b""
+        self.output = b""
+        self.pastes = []
+
+    def start(self):
+        """Start the helper if it isn't running."""
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        self.stop()
+        self.proc = subprocess.Popen(
+            [get_python(), "-c", CLIPBOARD_HELPER,
+             vimode_settings['copy_clipboard_cmd'],
+             vimode_settings['paste_clipboard_cmd']],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        set_nonblocking(self.proc.stdin.fileno())
+        set_nonblocking(self.proc.stdout.fileno())
+        self.hooks.append(weechat.hook_fd(self.proc.stdout.fileno(), 1, 0, 0,
+                                          "cb_clipboard_helper_output", ""))
+
+    def stop(self):
+        """Stop the helper (e.g. when the clipboard options change)."""
+        for hook in self.hooks:
+            weechat.unhook(hook)
+        self.hooks = []
+        if self.proc is not None:
+            # The helper exits once its stdin is closed. It's waited for
+            # later, rather than leaving a zombie process behind.
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                stopped_clipboard_helpers.append(self.proc)
+                scheduler.schedule(CLIPBOARD_HELPER_EXIT_DELAY,
+                                   "reap_clipboard_helpers",
+                                   cb_reap_clipboard_helpers)
+            self.proc = None
+        self.pending_input = self.output = b""
+        self.pastes = []
+
+    def copy(self, text):
+        """Copy `text` to the clipboard."""
+        self.send(b"copy", text.encode("utf-8"))
+
+    def paste(self, buf, count, before):
+        """Paste the clipboard's content into `buf` once it's received."""
+        self.send(b"paste", b"")
+        self.pastes.append((buf, count, before))
+
+    def send(self, request, data):
+        """Write a request to the helper, without waiting if it's busy."""
+        self.start()
+        self.pending_input += (request + b" " + str(len(data)).encode() +
+                               b"\n" + data)
+        self.write_input()
+
+    def write_input(self):
+        """Write as much of `pending_input` as the helper's stdin takes.
+
+        Returns:
+            bool: True if everything was written.
+        """
+        try:
+            written = os.write(self.proc.stdin.fileno(), self.pending_input)
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                print_warning("Clipboard helper: {}".format(error))
+                self.stop()
+                return True
+            written = 0
+        self.pending_input = self.pending_input[written:]
+        if self.pending_input and len(self.hooks) == 1:
+            self.hooks.append(weechat.hook_fd(self.proc.stdin.fileno(), 0, 1,
+                                              0, "cb_clipboard_helper_input",
+                                              ""))
+        return not self.pending_input
+
+    def read_output(self):
+        """Read what the helper wrote and paste the answers it completes."""
+        try:
+            data = os.read(self.proc.stdout.fileno(), 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return
+            data = b""
+        if not data:
+            # The helper is gone, it's started again when needed.
+            self.stop()
+            return
+        self.output += data
+        while b"\n" in self.output:
+            header, rest = self.output.split(b"\n", 1)
+            return_code, length = [int(field) for field in header.split()]
+            if len(rest) < length:
                 break
-    # Check against defined operators + motions.
-    if not matched:
-        for operator in VI_OPERATORS:
-            if combo.startswith(operator):
-                # Check for counts before the motion (but after the operator).
-                vi_keys_no_op = combo[len(operator):]
-                # There's no motion yet.
-                if vi_keys_no_op.isdigit():
-                    matched = True
-                    break
-                # Get the motion count, then multiply the operator count by
-                # it, similar to vim's behavior.
-                elif vi_keys_no_op and vi_keys_no_op[0].isdigit():
-                    motion_count = ""
-                    for char in vi_keys_no_op:
-                        if char.isdigit():
-                            motion_count += char
-                        else:
-                            break
-                    # Remove counts from `vi_keys_no_op`.
-                    combo = combo.replace(motion_count, "", 1)
-                    motion_count = int(motion_count)
-                    count = max(count, 1) * motion_count
-                # Check against defined motions.
-                for motion in VI_MOTIONS:
-                    if motion.startswith(combo[1:]):
-                        matched = True
-                        break
-    return matched, combo, count
+            self.output = rest[length:]
+            buf, count, before = self.pastes.pop(0)
+            if return_code == 0:
+                paste_clipboard_text(buf, rest[:length].decode("utf-8",
+                                                               "replace"),
+                                     count, before)
+
+clipboard_helper = ClipboardHelper()
+
+def cb_reap_clipboard_helpers(data, remaining_calls):
+    """Wait for the stopped helpers, killing the ones still running."""
+    while stopped_clipboard_helpers:
+        proc = stopped_clipboard_helpers.pop()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    return weechat.WEECHAT_RC_OK
+
+def cb_clipboard_helper_input(data, fd):
+    """The helper's stdin can take more requests."""
+    if clipboard_helper.write_input() and len(clipboard_helper.hooks) > 1:
+        weechat.unhook(clipboard_helper.hooks.pop())
+    return weechat.WEECHAT_RC_OK
+
+@edit_transaction
+def cb_clipboard_helper_output(data, fd):
+    """The helper answered (see `ClipboardHelper.read_output()`)."""
+    clipboard_helper.read_output()
+    return weechat.WEECHAT_RC_OK
+
+def copy_to_clipboard(text):
+    """Copy `text` to the clipboard, in the background."""
+    backend = vimode_settings['clipboard']
+    if backend == "osc52":
+        copy_osc52(text)
+    elif backend == "helper":
+        clipboard_helper.copy(text)
+    else:
+        copy_process(text)
+
+def paste_from_clipboard(buf, count, before):
+    """Paste the clipboard's content into `buf`, once it's been fetched.
+
+    See Also:
+        `put_register()`.
+    """
+    if vimode_settings['clipboard'] == "helper":
+        clipboard_helper.paste(buf, count, before)
+    else:
+        hook_shell_process(vimode_settings['paste_clipboard_cmd'], {},
+                           "cb_key_p", "{} {} {:d}".format(buf, count, before))
+
+def hook_shell_process(command, options, callback, data):
+    """Run a clipboard command in the background, with the shell.
+
+    `hook_process_hashtable` would split the command itself, so that pipes
+    or redirections (e.g. "tr -d '\\n' | xclip -sel c") wouldn't work.
+
+    Returns:
+        str: the hook.
+    """
+    options = dict(options, arg1="-c", arg2=command)
+    return weechat.hook_process_hashtable("sh", options, 10 * 1000, callback,
+                                          data)
+
+def copy_process(text):
+    """Run copy_clipboard_cmd in the background, feeding it `text`."""
+    command = vimode_settings['copy_clipboard_cmd']
+    hook = hook_shell_process(command, {'stdin': "1"}, "cb_copy_process",
+                              command)
+    weechat.hook_set(hook, "stdin", text)
+    weechat.hook_set(hook, "stdin_close", "")
+
+def cb_copy_process(data, command, return_code, output, err):
+    """Warn if copy_clipboard_cmd (`data`) failed."""
+    if return_code > 0 or return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR:
+        print_warning("Copying to the clipboard failed: {}".format(
+            err.strip() or data))
+    return weechat.WEECHAT_RC_OK
+
+def copy_osc52(text):
+    """Copy `text` with the OSC 52 escape sequence, written to the terminal.
+
+    Under tmux, the sequence is wrapped so that tmux passes it through.
+    """
+    encoded = base64.b64encode(text.encode("utf-8")).decode("ascii")
+    sequence = "\x1b]52;c;{}\x07".format(encoded)
+    if os.environ.get("TMUX"):
+        sequence = "\x1bPtmux;{}\x1b\\".format(sequence.replace("\x1b",
+                                                                "\x1b\x1b"))
+    sequence = sequence.encode("ascii")
+    try:
+        tty = os.open("/dev/tty", os.O_WRONLY | os.O_NOCTTY)
+        try:
+            while sequence:
+                sequence = sequence[os.write(tty, sequence):]
+        finally:
+            os.close(tty)
+    except OSError as error:
+        print_warning("Copying to the clipboard failed: {}".format(error))
+
+def set_nonblocking(fd):
+    """Make reads and writes on `fd` return instead of waiting."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def get_python():
+    """Return the Python interpreter to run helpers with.
+
+    `sys.executable` is WeeChat itself when the script runs in it.
+    """
+    if "python" in os.path.basename(sys.executable or ""):
+        return sys.executable
+    return "python3" if sys.version_info > (3,) else "python"
+
+
+# Registers.
+# ----------
+
+# Registers, as in vim (see :help registers): {name: text}, least recently
+# written first. "0 holds the last yank, "1 to "9 the last line deletes (dd,
+# cc, S) and "- the last smaller delete; "a to "z are written when given with
+# "x (and appended to with "A to "Z). "+ (or "*) is the clipboard: it's
+# copied to the system's clipboard in the background once it's written, see
+# `cb_sync_clipboard()`. The unnamed register ("") isn't stored, it's the
+# register written last.
+registers = OrderedDict()
+# Name of the register written last.
+unnamed_register = "0"
+# When "+ was last written, see the clipboard_cache_time option.
+clipboard_write_time = 0
+# Delay in ms before "+ is copied to the clipboard, so that quick successive
+# writes (e.g. pressing "x" repeatedly) only copy the last one.
+CLIPBOARD_SYNC_DELAY = 200
+
+def get_register():
+    """Return the register given with "x for the running action, or None."""
+    return get_key_parser().done_register
+
+def use_unnamed_clipboard(yank=False):
+    """Return True if the unnamed register is the clipboard, see the
+    unnamed_clipboard option.
+
+    Args:
+        yank (bool, optional): return True if yanks without a register are
+            copied to the clipboard instead. Defaults to False.
+    """
+    value = vimode_settings['unnamed_clipboard']
+    if yank and value == "yank":
+        return True
+    return weechat.config_string_to_boolean(value)
+
+def write_register(name, text, deleted=False, linewise=False):
+    """Store yanked or deleted `text`, the way vim does.
+
+    Args:
+        name (str): the register given with "x, None if none.
+        text (str): the yanked or deleted text.
+        deleted (bool, optional): True if the text was deleted.
+        linewise (bool, optional): True if the whole line was yanked or
+            deleted.
+    """
+    global unnamed_register
+    load_viminfo()
+    if name == "_":
+        return
+    if name is None or name == '"':
+        if deleted and linewise:
+            shift_numbered_registers()
+            name = "1"
+        else:
+            name = "-" if deleted else "0"
+        if use_unnamed_clipboard(yank=not deleted):
+            set_register(name, text)
+            name = "+"
+    elif name == "*":
+        name = "+"
+    elif name.isupper():
+        name = name.lower()
+        text = registers.get(name, "") + text
+    set_register(name, text)
+    unnamed_register = name
+
+def shift_numbered_registers(save=True):
+    """Shift the numbered registers "1" to "8" to "2" to "9", making room
+    for a new "1".
+
+    The registers keep their place in the write order (see
+    `trim_registers()`).
+
+    Args:
+        save (bool, optional): record the shift in the viminfo file, as one
+            ["shift"] record. Defaults to True.
+    """
+    items = []
+    for name, text in registers.items():
+        if len(name) == 1 and "1" <= name <= "9":
+            if name == "9":
+                continue
+            name = str(int(name) + 1)
+        items.append((name, text))
+    registers.clear()
+    registers.update(items)
+    if save:
+        viminfo.append(["shift"])
+
+def set_register(name, text, copy=True):
+    """Set register `name` to `text`.
+
+    The least recently written registers are forgotten if they're bigger than
+    the registers_max_size option allows.
+
+    Args:
+        copy (bool, optional): for "+, whether to copy the text to the
+            clipboard. Defaults to True.
+    """
+    global clipboard_write_time
+    load_viminfo()
+    registers.pop(name, None)
+    registers[name] = text
+    if name == "+" and copy:
+        clipboard_write_time = time.time()
+        scheduler.schedule(CLIPBOARD_SYNC_DELAY, "clipboard_sync",
+                           cb_sync_clipboard)
+    elif name != "+":
+        viminfo.append(['"', name, text])
+    trim_registers()
+
+def trim_registers():
+    """Forget the least recently written registers, if they're bigger than
+    the registers_max_size option allows."""
+    max_size = get_limit_option('registers_max_size')
+    if max_size:
+        size = sum(len(value) for value in registers.values())
+        while size > max_size and len(registers) > 1:
+            size -= len(registers.popitem(last=False)[1])
+
+def cb_sync_clipboard(data, remaining_calls):
+    """Copy "+ to the clipboard."""
+    text = registers.get("+")
+    if text is not None:
+        copy_to_clipboard(text)
+    return weechat.WEECHAT_RC_OK
+
+def put_register(buf, name, count, before):
+    """Put the text of register `name` `count` times around the cursor.
+
+    "+ is pasted from memory if it was written less than
+    clipboard_cache_time seconds ago, and fetched from the clipboard
+    otherwise (see `paste_from_clipboard()`).
+
+    Args:
+        name (str): the register given with "x, None if none.
+        before (bool): put the text before the cursor instead of after it.
+    """
+    load_viminfo()
+    if name is None or name == '"':
+        name = "+" if use_unnamed_clipboard() else unnamed_register
+    name = "+" if name == "*" else name.lower()
+    if name == "+":
+        cache_time = get_limit_option('clipboard_cache_time')
+        if ("+" not in registers or
+                time.time() - clipboard_write_time >= cache_time):
+            paste_from_clipboard(buf, count, before)
+            return
+    text = registers.get(name)
+    if text:
+        put_text(buf, text, count, before)
+
+def paste_clipboard_text(buf, output, count, before):
+    """Put the clipboard's content, `output` of paste_clipboard_cmd."""
+    text = output.strip()
+    set_register("+", text, False)
+    if text:
+        put_text(buf, text, count, before)
+
+def put_text(buf, text, count, before):
+    """Put `text` `count` times before or after the cursor, in one write."""
+    input_line = get_input(buf)
+    cur = get_cur(buf)
+    pos = cur if before else min(cur + 1, len(input_line))
+    text *= max(count, 1)
+    input_line = input_line[:pos] + text + input_line[pos:]
+    set_input(buf, input_line)
+    # The cursor ends on the last character put, as in vim.
+    set_cur(buf, input_line, pos + len(text) - 1, False)
+
+def delete_text(buf, input_line, start, end, linewise=False):
+    """Delete the text from `start` to `end`, into the given register."""
+    if start >= end:
+        return
+    write_register(get_register(), input_line[start:end], True, linewise)
+    set_input(buf, input_line[:start] + input_line[end:])
+
+
+# Command-line history.
+# ---------------------
+
+class History(object):
+    """History of the command line, or of searches.
+
+    As in vim, entries are unique (an entry used again becomes the most
+    recent) and the oldest ones are forgotten past the history_size option.
+    They're also kept sorted, so that the entries starting with what's been
+    typed are found by bisection when recalling them with Up.
+
+    Attributes:
+        entries (OrderedDict): {entry: sequence number}, oldest first.
+        index (list[str]): the entries, sorted.
+        seq (int): sequence number of the latest entry.
+    """
+    __slots__ = ("entries", "index", "seq")
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.index = []
+        self.seq = 0
+
+    def add(self, entry):
+        """Add `entry` as the most recent entry."""
+        if self.entries.pop(entry, None) is None:
+            bisect.insort(self.index, entry)
+        self.seq += 1
+        self.entries[entry] = self.seq
+        max_size = get_limit_option('history_size')
+        while max_size and len(self.entries) > max_size:
+            oldest = self.entries.popitem(last=False)[0]
+            del self.index[bisect.bisect_left(self.index, oldest)]
+
+    def recall(self, prefix):
+        """Return the entries starting with `prefix`, most recent first."""
+        start = bisect.bisect_left(self.index, prefix)
+        try:
+            end = bisect.bisect_left(
+                self.index, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        except (IndexError, ValueError):
+            end = len(self.index)
+        entries = self.entries
+        return sorted(self.index[start:end], key=entries.get, reverse=True)
+
+# Histories of the command line (":") and of searches ("/").
+histories = {':': History(), '/': History()}
+
+def get_history(kind):
+    """Return the ":" or "/" `History`."""
+    load_viminfo()
+    return histories[kind]
+
+
+# Viminfo.
+# --------
+
+# Delay in ms before changes are written to the viminfo file, so that a burst
+# of changes is written at once.
+VIMINFO_WRITE_DELAY = 1000
+
+class Viminfo(object):
+    """The file keeping the histories and registers (except "+) across
+    restarts, like vim's viminfo.
+
+    Each line of the file is a JSON list: [":", entry] or ["/", entry] for
+    the histories, ['"', name, text] for the registers (text being null for
+    an emptied register) and ["shift"] for a shift of the numbered registers
+    (see `shift_numbered_registers()`). Changes are appended, a little while
+    after they're made, and the file is read again from the start: later
+    lines win, and the histories' size limit applies.
+    Once the file holds too many outdated lines, it's written again with only
+    the current state.
+
+    The file is read when the histories or registers are first used, rather
+    than when the script starts.
+
+    Attributes:
+        loaded (bool): whether the file was read.
+        lines (int): number of lines in the file.
+        pending (list[str]): lines yet to be appended.
+    """
+    __slots__ = ("loaded", "lines", "pending")
+
+    def __init__(self):
+        self.loaded = False
+        self.lines = 0
+        self.pending = []
+
+    def get_path(self):
+        """Return the path of the file, "" if it's disabled."""
+        path = vimode_settings['viminfo_path']
+        if not path:
+            return ""
+        return weechat.string_eval_path_home(path, {}, {}, {})
+
+    def load(self):
+        """Read the file, and apply its records."""
+        global unnamed_register
+        self.loaded = True
+        path = self.get_path()
+        if not path:
+            return
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                print_warning("Can't read %s: %s" % (path, e.strerror))
+            return
+        self.lines = len(lines)
+        for line in lines:
+            try:
+                record = json.loads(line)
+                if record[0] in histories:
+                    histories[record[0]].add(record[1])
+                elif record[0] == "shift":
+                    shift_numbered_registers(save=False)
+                elif record[0] == '"' and record[1] != "+":
+                    registers.pop(record[1], None)
+                    if record[2] is not None:
+                        registers[record[1]] = record[2]
+                        unnamed_register = record[1]
+            except (ValueError, IndexError, TypeError):
+                continue
+        trim_registers()
+
+    def append(self, record):
+        """Append `record` to the file, in a little while."""
+        if not self.get_path():
+            return
+        self.pending.append(json.dumps(record))
+        scheduler.schedule(VIMINFO_WRITE_DELAY, "viminfo", cb_write_viminfo)
+
+    def flush(self):
+        """Write the pending lines, or the whole state if the file has grown
+        too big."""
+        if not self.pending:
+            return
+        path = self.get_path()
+        size = len(registers) + sum(len(history.entries)
+                                    for history in histories.values())
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            if self.lines + len(self.pending) > 2 * max(size, 100):
+                self.write(path)
+            else:
+                with open_private(path, os.O_APPEND) as f:
+                    f.write("\n".join(self.pending) + "\n")
+                self.lines += len(self.pending)
+        except (IOError, OSError) as e:
+            print_warning("Can't write %s: %s" % (path, e.strerror))
+        self.pending = []
+
+    def write(self, path):
+        """Write the current state to the file, replacing it."""
+        records = []
+        for kind, history in sorted(histories.items()):
+            records.extend([kind, entry] for entry in history.entries)
+        records.extend(['"', name, text] for name, text in registers.items()
+                       if name != "+")
+        replace_private(path, (json.dumps(record) + "\n"
+                               for record in records))
+        self.lines = len(records)
+
+viminfo = Viminfo()
+
+def open_private(path, flags):
+    """Open `path` for writing, creating it readable by the user only: the
+    viminfo and vimrc cache files hold commands, mappings and deleted text,
+    passwords included.
+
+    Args:
+        flags (int): os.O_APPEND or os.O_TRUNC.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600)
+    return os.fdopen(fd, "a" if flags & os.O_APPEND else "w")
+
+# Python 2 has no os.replace(), os.rename() replaces files too on POSIX.
+replace_file = getattr(os, "replace", os.rename)
+
+def replace_private(path, lines):
+    """Replace the file at `path` with `lines`, readable by the user only
+    (see `open_private()`).
+
+    The lines are written to a temporary file first, named after the process
+    so that WeeChat instances sharing the directory don't write to the same
+    one, then moved over `path`.
+    """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    # A file left over by an interrupted write may have other permissions.
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with open_private(tmp, os.O_TRUNC) as f:
+        f.writelines(lines)
+    replace_file(tmp, path)
+
+def load_viminfo():
+    """Read the viminfo file, if it wasn't yet."""
+    if not viminfo.loaded:
+        viminfo.load()
+
+def cb_write_viminfo(data, remaining_calls):
+    """Write the pending changes to the viminfo file."""
+    viminfo.flush()
+    return weechat.WEECHAT_RC_OK
+
+
+# Vimrc.
+# ------
+
+# File caching the compiled vimrc files, see `source_vimrc()`.
+VIMRC_CACHE_PATH = "%h/vimode/vimrc_cache"
+# Mappings set by the sourced vimrc files, {lhs: (option, rhs, path)}. They
+# aren't written to the user_mappings* options, so that the file stays their
+# only source: a line removed from it unmaps its keys when it's sourced again.
+vimrc_mappings = {}
+
+def source_vimrc(path, missing_ok=False):
+    """Apply the mappings and options set by a vimrc file.
+
+    The file is compiled into option changes (see `compile_vimrc()`), which
+    are applied as one transaction. The changes are cached along with the
+    file's mtime and size, so that an unchanged file isn't read again.
+
+    Mappings are kept apart from the user_mappings* options (see
+    `vimrc_mappings`): the ones the file no longer sets are removed.
+
+    Args:
+        path (str): path of the file, "%h" being WeeChat's home.
+        missing_ok (bool, optional): don't warn if the file doesn't exist.
+            Defaults to False.
+    """
+    path = weechat.string_eval_path_home(path, {}, {}, {})
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT or not missing_ok:
+            print_warning("Can't read %s: %s" % (path, e.strerror))
+        return
+    cache = read_vimrc_cache()
+    entry = cache.get(path)
+    if (entry and entry.get("mtime") == stat.st_mtime and
+            entry.get("size") == stat.st_size):
+        changes = entry["changes"]
+    else:
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError) as e:
+            print_warning("Can't read %s: %s" % (path, e.strerror))
+            return
+        changes, errors = compile_vimrc(path, lines)
+        # Files with errors aren't cached, so that they're reported again.
+        if errors:
+            cache.pop(path, None)
+        else:
+            cache[path] = {"mtime": stat.st_mtime, "size": stat.st_size,
+                           "changes": changes}
+        write_vimrc_cache(cache)
+    mappings = {}
+    options = []
+    for option, lhs, value in changes:
+        if lhs is None:
+            options.append((option, lhs, value))
+        else:
+            mappings[lhs] = (option, value, path)
+    stale = set()
+    for lhs, mapping in list(vimrc_mappings.items()):
+        if mapping[2] == path and lhs not in mappings:
+            del vimrc_mappings[lhs]
+            stale.add(lhs)
+    for lhs, mapping in mappings.items():
+        if vimrc_mappings.get(lhs) != mapping:
+            vimrc_mappings[lhs] = mapping
+            stale.add(lhs)
+    for lhs in stale:
+        update_user_mapping(lhs)
+    apply_option_changes(options)
+
+def compile_vimrc(path, lines):
+    """Compile the lines of a vimrc file into option changes.
+
+    Supported lines are ``nmap``/``nnoremap {lhs} {rhs}``, ``imap {lhs}
+    <Esc>`` (sets the imap_esc option) and ``set {option}={value}``,
+    ``set {option}`` or ``set no{option}`` for boolean options. Empty lines
+    and comments (starting with ``"``) are skipped; other lines are reported.
+
+    Returns:
+        tuple: (changes, number of lines reported), see
+            `apply_option_changes()` for the changes.
+    """
+    changes = []
+    errors = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip().lstrip(":")
+        if not line or line.startswith('"'):
+            continue
+        name, _, args = line.partition(" ")
+        change = compile_vimrc_command(name, args.strip())
+        if change is None:
+            print_warning("%s:%d: unsupported line: %s" % (path, number,
+                                                           line))
+            errors += 1
+        else:
+            changes.append(change)
+    return changes, errors
+
+def compile_vimrc_command(name, args):
+    """Return the (option, lhs, value) change made by a vimrc command, None
+    if it's not supported."""
+    if name in ("nm", "nmap", "nn", "nnoremap") and " " in args:
+        which = Mapping.RECURSIVE if name in ("nm", "nmap") else \
+            Mapping.NON_RECURSIVE
+        key, mapping = parse_mapping(args)
+        return (which.value, key, mapping)
+    if name in ("im", "imap"):
+        # Leaving Insert mode is the only Insert mode mapping we have.
+        key, _, mapping = args.partition(" ")
+        if key and mapping.strip().lower() == "<esc>":
+            return ("imap_esc", None, key)
+        return None
+    if name in ("se", "set"):
+        option, sep, value = args.partition("=")
+        option = option.strip()
+        if not sep:
+            value = "on"
+            if option not in vimode_settings and option.startswith("no"):
+                option, value = option[2:], "off"
+        if (option not in vimode_settings or
+                option.startswith("user_mappings")):
+            return None
+        return (option, None, value)
+    return None
+
+def read_vimrc_cache():
+    """Return the compiled vimrc files, {path: {mtime, size, changes}}."""
+    path = weechat.string_eval_path_home(VIMRC_CACHE_PATH, {}, {}, {})
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def write_vimrc_cache(cache):
+    """Write the compiled vimrc files, see `read_vimrc_cache()`."""
+    path = weechat.string_eval_path_home(VIMRC_CACHE_PATH, {}, {}, {})
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        replace_private(path, [json.dumps(cache)])
+    except (IOError, OSError) as e:
+        print_warning("Can't write %s: %s" % (path, e.strerror))
+
+
+# Line numbers.
+# -------------
+
+# {buffer: ScrollbackIndex}, see `get_scrollback_index()`.
+scrollback_indexes = {}
+# Hook refreshing the line numbers on prints, while line_numbers_mode isn't
+# "screen".
+line_numbers_print_hook = None
+
+class ScrollbackIndex(object):
+    """Index of a buffer's lines, both ways: the line with a given index, and
+    the index of a line, are found in O(1).
+
+    The index of a line is the number of lines before it (filtered ones
+    included). The pointers to the lines are listed in order, and kept up to
+    date at each lookup (see `sync()`) with the lines added since, found by
+    walking forward from the last known line, and the lines removed from the
+    start of the buffer (see ``weechat.history.max_buffer_lines_number``).
+    The whole scrollback is only walked the first time, or if lines were
+    inserted elsewhere (e.g. when buffers are merged).
+
+    Attributes:
+        lines (str): pointer to the buffer's lines (hdata "lines"), they're
+            shared by merged buffers.
+        pointers (list[str]): the lines, oldest first; the `start` first ones
+            were removed from the buffer.
+        start (int): number of removed lines at the start of `pointers`.
+        offset (int): number of removed lines dropped from `pointers`.
+        positions (dict): {line: position in `pointers`, plus `offset`}.
+        count (int): number of lines, at the last lookup.
+    """
+    __slots__ = ("lines", "pointers", "start", "offset", "positions",
+                 "count")
+
+    # Removed lines are dropped from `pointers` once there are that many.
+    COMPACT_SIZE = 1024
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.pointers = []
+        self.start = 0
+        self.offset = 0
+        self.positions = {}
+        self.count = 0
+
+    def sync(self):
+        """Bring the index up to date with the buffer's lines."""
+        hdata_lines = weechat.hdata_get("lines")
+        first = weechat.hdata_pointer(hdata_lines, self.lines, "first_line")
+        last = weechat.hdata_pointer(hdata_lines, self.lines, "last_line")
+        count = weechat.hdata_integer(hdata_lines, self.lines, "lines_count")
+        pointers = self.pointers
+        if (self.count == count and pointers and pointers[-1] == last and
+                pointers[self.start] == first):
+            return
+        while self.start < len(pointers) and pointers[self.start] != first:
+            del self.positions[pointers[self.start]]
+            self.start += 1
+        if self.start == len(pointers):
+            self.rebuild(first)
+        else:
+            self.extend(pointers[-1])
+            if len(pointers) - self.start != count:
+                self.rebuild(first)
+        if self.start >= self.COMPACT_SIZE:
+            del self.pointers[:self.start]
+            self.offset += self.start
+            self.start = 0
+        self.count = len(self.pointers) - self.start
+
+    def rebuild(self, first):
+        """Index the lines again, from `first`."""
+        self.offset += len(self.pointers)
+        self.pointers = []
+        self.start = 0
+        self.positions = {}
+        if first:
+            self.pointers.append(first)
+            self.positions[first] = self.offset
+            self.extend(first)
+
+    def extend(self, line):
+        """Add the lines following `line`, the last line indexed."""
+        hdata_line = weechat.hdata_get("line")
+        pointers = self.pointers
+        positions = self.positions
+        line = weechat.hdata_pointer(hdata_line, line, "next_line")
+        while line:
+            positions[line] = self.offset + len(pointers)
+            pointers.append(line)
+            line = weechat.hdata_pointer(hdata_line, line, "next_line")
+
+    def get_index(self, line):
+        """Return the index of `line`, 0 for the first line of the buffer,
+        None if it isn't indexed."""
+        position = self.positions.get(line)
+        if position is None:
+            return None
+        return position - self.offset - self.start
+
+    def get_line(self, index):
+        """Return the pointer to the line at `index`."""
+        return self.pointers[self.start + index]
+
+def get_scrollback_index(buf):
+    """Return the `ScrollbackIndex` of a buffer, up to date."""
+    lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buf, "lines")
+    index = scrollback_indexes.get(buf)
+    # The lines change when buffers are merged or unmerged.
+    if index is None or index.lines != lines:
+        index = scrollback_indexes[buf] = ScrollbackIndex(lines)
+    index.sync()
+    return index
+
+def get_line_numbers_mode():
+    """Return the line_numbers_mode option, "screen" if it's invalid."""
+    mode = vimode_settings['line_numbers_mode']
+    if mode in ("absolute", "relative"):
+        return mode
+    return "screen"
+
+def get_window_lines(window):
+    """Return the lines displayed in a window, row by row.
+
+    Returns:
+        list: a (line, index) tuple for each row of the chat area, where
+            `line` is the pointer to the line and `index` its index in the
+            buffer. None for empty rows, and rows continuing the line above.
+            None for buffers with free content.
+    """
+    buf = weechat.hdata_pointer(weechat.hdata_get("window"), window, "buffer")
+    if weechat.hdata_integer(weechat.hdata_get("buffer"), buf, "type") != 0:
+        return None
+    index = get_scrollback_index(buf)
+    rows = []
+    for line in get_window_rows(window, buf, index):
+        position = index.get_index(line) if line else None
+        rows.append((line, position) if position is not None else None)
+    return rows
+
+# {window: (key, rows)}, see `get_window_rows()`.
+window_rows = {}
+
+def get_window_rows(window, buf, index):
+    """Return the line displayed on each row of a window, "" for empty rows
+    and rows continuing the line above.
+
+    The rows are read with WeeChat's focus info, so that lines wrapped on
+    several rows are accounted for. That's one call per row, so they're
+    cached along with what they depend on: the window's size, the line at
+    its top (or its buffer's last line, if it isn't scrolled) and its
+    buffer. Toggling filters forgets them (see `cb_filters_changed()`).
+
+    Args:
+        index (ScrollbackIndex): the index of the buffer's lines, up to date.
+    """
+    hdata_window = weechat.hdata_get("window")
+    hdata_scroll = weechat.hdata_get("window_scroll")
+    scroll = weechat.hdata_pointer(hdata_window, window, "scroll")
+    start = weechat.hdata_pointer(hdata_scroll, scroll, "start_line")
+    height = weechat.hdata_integer(hdata_window, window, "win_chat_height")
+    key = (buf, height,
+           weechat.hdata_integer(hdata_window, window, "win_chat_width"),
+           start, weechat.hdata_integer(hdata_scroll, scroll,
+                                        "start_line_pos"),
+           "" if start or not index.count else index.pointers[-1])
+    cached = window_rows.get(window)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    x = weechat.hdata_integer(hdata_window, window, "win_chat_x")
+    y = weechat.hdata_integer(hdata_window, window, "win_chat_y")
+    rows = []
+    previous = ""
+    for row in range(height):
+        info = weechat.info_get_hashtable("focus_info",
+                                          {'x': str(x), 'y': str(y + row)})
+        line = (info or {}).get("_chat_line", "")
+        if line == "0x0":
+            line = ""
+        rows.append(line if line != previous else "")
+        previous = line
+    window_rows[window] = (key, rows)
+    return rows
+
+def render_line_numbers(window, relative):
+    """Return the content of the line numbers bar item, with the numbers of
+    the lines displayed in `window` (see `get_window_lines()`).
+
+    Args:
+        window (str): pointer to the window.
+        relative (bool): number the lines from the bottom of the window
+            instead of the start of the buffer.
+
+    Returns:
+        str: the content, None for buffers with free content.
+    """
+    rows = get_window_lines(window)
+    if rows is None:
+        return None
+    indexes = [row[1] for row in rows if row is not None]
+    if not indexes:
+        return ""
+    if relative:
+        numbers = [indexes[-1] - row[1] if row is not None else None
+                   for row in rows]
+    else:
+        numbers = [row[1] + 1 if row is not None else None for row in rows]
+    largest = max(number for number in numbers if number is not None)
+    width = max(2, len(str(largest)))
+    prefix = vimode_settings['line_number_prefix']
+    suffix = vimode_settings['line_number_suffix']
+    return "".join("{}{:>{}}{}\n".format(prefix,
+                                         "" if number is None else number,
+                                         width, suffix)
+                   for number in numbers)
+
+def go_to_line(number):
+    """Scroll the current window so that line `number` (the first line of
+    the buffer being 1) is displayed, if it isn't already.
+
+    WeeChat scrolls by displayed lines, so the filtered lines between the
+    line and the closest known one (the first line of the buffer, or the top
+    or bottom row of the window) have to be counted, unless the buffer has
+    none (see `count_displayed_lines()`).
+
+    Returns:
+        int: the row of the chat area where the line is displayed.
+    """
+    rows = get_window_lines(weechat.current_window()) or []
+    target = number - 1
+    for i, row in enumerate(rows):
+        if row is not None and row[1] == target:
+            return i
+    visible = [row for row in rows if row is not None]
+    if not visible:
+        return 0
+    index = get_scrollback_index(get_current_buffer())
+    if target >= index.count - 1:
+        run_command("", "/window scroll_bottom")
+        return len(rows) - 1
+    top_index, bottom_index = visible[0][1], visible[-1][1]
+    if top_index < target < bottom_index:
+        # A filtered line: go to the row of the line displayed before it.
+        return max(i for i, row in enumerate(rows)
+                   if row is not None and row[1] < target)
+    if target > bottom_index:
+        # The rows hold the displayed lines from the top to the bottom row.
+        scroll = len(visible) - 1 + count_displayed_lines(
+            index, bottom_index, target) - 1
+    elif target < top_index - target:
+        run_command("", "/window scroll_top")
+        scroll = count_displayed_lines(index, 0, target) - 1
+    else:
+        scroll = 1 - count_displayed_lines(index, target, top_index)
+    if scroll:
+        run_command("", "/window scroll %+d" % scroll)
+    return 0
+
+def count_displayed_lines(index, first, last):
+    """Return how many of the lines from index `first` to `last` (included)
+    are displayed, i.e. not filtered.
+
+    Args:
+        index (ScrollbackIndex): the index of the buffer's lines.
+    """
+    hdata_lines = weechat.hdata_get("lines")
+    if not weechat.hdata_integer(hdata_lines, index.lines, "lines_hidden"):
+        return last - first + 1
+    hdata_line = weechat.hdata_get("line")
+    hdata_line_data = weechat.hdata_get("line_data")
+    displayed = 0
+    for position in range(first, last + 1):
+        data = weechat.hdata_pointer(hdata_line, index.get_line(position),
+                                     "data")
+        if weechat.hdata_char(hdata_line_data, data, "displayed"):
+            displayed += 1
+    return displayed
+
+# {buffer: windows displaying its lines}, None once windows or buffers
+# change. See `get_line_numbers_buffers()`.
+line_numbers_buffers = None
+
+def get_line_numbers_buffers():
+    """Return the buffers whose lines are displayed, {buffer: [window]}.
+
+    Merged buffers share their lines, so a print in any of them is displayed
+    by the windows showing the one in front.
+    """
+    global line_numbers_buffers
+    if line_numbers_buffers is not None:
+        return line_numbers_buffers
+    hdata_window = weechat.hdata_get("window")
+    hdata_buffer = weechat.hdata_get("buffer")
+    windows = {}
+    window = weechat.hdata_get_list(hdata_window, "gui_windows")
+    while window:
+        buf = weechat.hdata_pointer(hdata_window, window, "buffer")
+        lines = weechat.hdata_pointer(hdata_buffer, buf, "lines")
+        windows.setdefault(lines, []).append(window)
+        window = weechat.hdata_move(hdata_window, window, 1)
+    line_numbers_buffers = {}
+    buf = weechat.hdata_get_list(hdata_buffer, "gui_buffers")
+    while buf:
+        lines = weechat.hdata_pointer(hdata_buffer, buf, "lines")
+        if lines in windows:
+            line_numbers_buffers[buf] = windows[lines]
+        buf = weechat.hdata_move(hdata_buffer, buf, 1)
+    return line_numbers_buffers
+
+def forget_line_numbers_buffers():
+    """Find the buffers displayed again, on the next print."""
+    global line_numbers_buffers
+    line_numbers_buffers = None
+
+def hook_line_numbers_print():
+    """Refresh the line numbers on prints while they number the buffer's
+    lines, see `cb_line_numbers_print()`."""
+    global line_numbers_print_hook
+    if get_line_numbers_mode() == "screen":
+        if line_numbers_print_hook is not None:
+            weechat.unhook(line_numbers_print_hook)
+            line_numbers_print_hook = None
+        # They're built again when needed.
+        scrollback_indexes.clear()
+        window_rows.clear()
+    elif line_numbers_print_hook is None:
+        line_numbers_print_hook = weechat.hook_print("", "", "", 0,
+                                                     "cb_line_numbers_print",
+                                                     "")
+
+
+# Substitution.
+# -------------
+
+# Compiled :s patterns, least recently used first: {(pattern, flags): regex}.
+# None for invalid patterns.
+substitute_regexes = OrderedDict()
+# Maximum number of patterns in `substitute_regexes`.
+SUBSTITUTE_CACHE_SIZE = 32
+# The :s command parsed last and its `Substitution`, see `parse_substitute()`.
+last_substitution = (None, None)
+
+class Substitution(object):
+    """A parsed :s command.
+
+    Attributes:
+        regex (re.RegexObject): the compiled pattern.
+        template (str): the replacement, in Python's syntax (see
+            `re.Match.expand()`). None if it wasn't typed yet.
+        count (int): maximum number of substitutions (0: no limit).
+    """
+    __slots__ = ("regex", "template", "count")
+
+    def __init__(self, regex, template, count):
+        self.regex = regex
+        self.template = template
+        self.count = count
+
+    def apply(self, text, highlight=False):
+        """Return `text` with the substitutions made, None if the replacement
+        is invalid (e.g. it refers to a missing group).
+
+        Args:
+            highlight (bool, optional): show the replacements in bold (or the
+                matches, while the replacement isn't typed), for previews.
+                Defaults to False.
+        """
+        template = self.template
+        if template is None:
+            template = "\\g<0>" if highlight else ""
+        if highlight:
+            bold = weechat.color("bold")
+            unbold = weechat.color("-bold")
+        else:
+            bold = unbold = ""
+
+        def expand(match):
+            return bold + match.expand(template) + unbold
+        try:
+            return self.regex.sub(expand, text, self.count)
+        except (re.error, IndexError):
+            return None
+
+def get_substitute_regex(pattern, flags):
+    """Return `pattern` compiled with `flags`, None if it's invalid.
+
+    The patterns are kept in a cache, the least recently used ones are
+    forgotten past `SUBSTITUTE_CACHE_SIZE` patterns.
+    """
+    key = (pattern, flags)
+    if key in substitute_regexes:
+        regex = substitute_regexes.pop(key)
+    else:
+        try:
+            regex = re.compile(pattern, flags)
+        except re.error:
+            regex = None
+        while len(substitute_regexes) >= SUBSTITUTE_CACHE_SIZE:
+            substitute_regexes.popitem(last=False)
+    substitute_regexes[key] = regex
+    return regex
+
+def convert_replacement(repl):
+    """Convert a replacement from vim's syntax to Python's (see
+    `re.Match.expand()`): & is the match, and \\1 to \\9 its groups."""
+    def convert(match):
+        if match.group(0) == "&":
+            return "\\g<0>"
+        char = match.group(1)
+        if char.isdigit():
+            return "\\g<%s>" % char
+        return "\\\\" if char == "\\" else char
+    return REGEX_SUBSTITUTE_REPL.sub(convert, repl)
+
+def parse_substitute(cmd):
+    """Parse a :s command (without its ":"):
+    s/pattern/replacement/[flags] [count].
+
+    The flags are "g" (replace all the matches), "i" (ignore case) and "I"
+    (don't). As there's only one line, [count] limits the number of
+    substitutions instead of the lines.
+
+    The command parsed last is remembered and the patterns are cached (see
+    `get_substitute_regex()`), so that previews only parse the command once
+    per key, and compile the pattern when it changes.
+
+    Returns:
+        Substitution: None if the command or its pattern is invalid, or if
+            the pattern is empty.
+    """
+    global last_substitution
+    if last_substitution[0] == cmd:
+        return last_substitution[1]
+    substitution = None
+    match = REGEX_SUBSTITUTE.match(cmd)
+    if match and match.group(1):
+        pattern, repl, flags, count = match.groups()
+        flags = flags or ""
+        case = [flag for flag in flags if flag in "iI"]
+        regex = get_substitute_regex(
+            pattern, re.IGNORECASE if case[-1:] == ["i"] else 0)
+        if regex is not None:
+            if count:
+                count = int(count)
+            else:
+                count = 0 if "g" in flags else 1
+            template = convert_replacement(repl) if repl is not None else None
+            substitution = Substitution(regex, template, count)
+    last_substitution = (cmd, substitution)
+    return substitution
+
+def preview_substitute(buf, cmd):
+    """Return the input line (as it was before Command mode) with the :s
+    command `cmd` applied, "" if it's invalid."""
+    substitution = parse_substitute(cmd)
+    if substitution is None:
+        return ""
+    input_line = get_buffer_state(buf).cmd_backup[0]
+    return substitution.apply(input_line, True) or ""
+
+
+# Command-line completion.
+# ------------------------
+
+# Commands whose argument is completed with option names.
+OPTION_COMMANDS = ("set", "unset", "fset")
+
+class CompletionIndex(object):
+    """Sorted words, to find those starting with a prefix by bisection.
+
+    The words are listed by calling `load` the first time they're needed, and
+    again after `invalidate()`.
+    """
+    __slots__ = ("load", "words")
+
+    def __init__(self, load):
+        self.load = load
+        self.words = None
+
+    def invalidate(self):
+        """List the words again the next time they're needed."""
+        self.words = None
+
+    def complete(self, prefix):
+        """Return the words starting with `prefix`, sorted."""
+        if self.words is None:
+            self.words = sorted(set(self.load()))
+        words = self.words
+        start = bisect.bisect_left(words, prefix)
+        # The words starting with `prefix` sort before the first word greater
+        # than `prefix`, with its last character incremented.
+        try:
+            end = bisect.bisect_left(
+                words, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        except (IndexError, ValueError):
+            end = len(words)
+        return words[start:end]
+
+class Completion(object):
+    """Candidates for the command line, cycled through with Tab.
+
+    The candidates are joined once, and each Tab press only moves the bold
+    markers in the cmd_completion bar item.
+
+    Attributes:
+        head (str): the text before the completed word.
+        matches (list[str]): the candidates for the completed word.
+        pos (int): index of the next candidate.
+        text (str): the candidates, comma-separated.
+        offsets (list[int]): where each candidate starts in `text`.
+    """
+    __slots__ = ("head", "matches", "pos", "text", "offsets")
+
+    def __init__(self, head, matches):
+        self.head = head
+        self.matches = matches
+        self.pos = 0
+        self.text = ", ".join(matches)
+        self.offsets = []
+        offset = 0
+        for match in matches:
+            self.offsets.append(offset)
+            offset += len(match) + 2
+
+    def next(self):
+        """Return the command line completed with the next candidate, and the
+        bar item's content, where the candidate is in bold."""
+        match = self.matches[self.pos]
+        start = self.offsets[self.pos]
+        end = start + len(match)
+        text = "{}{}{}{}{}".format(self.text[:start], weechat.color("bold"),
+                                   match, weechat.color("-bold"),
+                                   self.text[end:])
+        self.pos = (self.pos + 1) % len(self.matches)
+        return self.head + match, text
+
+def list_commands():
+    """Return our vi commands and WeeChat's commands, for `command_index`."""
+    commands = list(VI_COMMANDS)
+    infolist = weechat.infolist_get("hook", "", "command")
+    while weechat.infolist_next(infolist):
+        commands.append(weechat.infolist_string(infolist, "command"))
+    weechat.infolist_free(infolist)
+    return commands
+
+def list_options():
+    """Return the names of WeeChat's options, for `option_index`."""
+    options = []
+    infolist = weechat.infolist_get("option", "", "")
+    while weechat.infolist_next(infolist):
+        options.append(weechat.infolist_string(infolist, "full_name"))
+    weechat.infolist_free(infolist)
+    return options
+
+command_index = CompletionIndex(list_commands)
+option_index = CompletionIndex(list_options)
+
+def complete_command_line(text):
+    """Return the `Completion` of the command line `text` (without its ":"):
+    command names, or option names for `OPTION_COMMANDS`."""
+    if " " not in text:
+        return Completion("", command_index.complete(text))
+    cmd, arg = text.split(" ", 1)
+    if cmd in OPTION_COMMANDS and " " not in arg:
+        return Completion(cmd + " ", option_index.complete(arg))
+    return Completion(text, [])
+
+def cb_completion_changed(data, signal, signal_data):
+    """A script or plugin was loaded or unloaded, which may add or remove
+    commands and options."""
+    command_index.invalidate()
+    option_index.invalidate()
+    return weechat.WEECHAT_RC_OK
 
 
 # Other helpers.
 # --------------
 def set_mode(arg):
-    """Set the current mode and update the bar mode indicator."""
-    global mode
-    buf = weechat.current_buffer()
-    input_line = weechat.buffer_get_string(buf, "input")
-    if mode == "INSERT" and arg == "NORMAL":
+    """Set the current buffer's mode and update the bar mode indicator."""
+    buf = get_current_buffer()
+    state = get_buffer_state(buf)
+    input_line = get_input(buf)
+    if state.mode == "INSERT" and arg == "NORMAL":
         add_undo_history(buf, input_line)
-    mode = arg
+    if state.mode != arg:
+        update_bar_item("mode_indicator")
+    state.mode = arg
     # If we're going to Normal mode, the cursor must move one character to the
     # left.
-    if mode == "NORMAL":
-        cur = weechat.buffer_get_integer(buf, "input_pos")
+    if arg == "NORMAL":
+        cur = get_cur(buf)
         set_cur(buf, input_line, cur - 1, False)
-    weechat.bar_item_update("mode_indicator")
 
+@edit_transaction
 def cb_check_cmd_mode(data, remaining_calls):
-    """Exit command mode if user erases the leading ':' character."""
-    buf = weechat.current_buffer()
-    cmd_text = weechat.buffer_get_string(buf, "input")
+    """Exit command mode if user erases the leading ':' character, and
+    preview :s commands in the cmd_completion bar item."""
+    global cmd_compl_text
+    buf = get_current_buffer()
+    cmd_text = get_input(buf)
     if not cmd_text:
         set_mode("NORMAL")
+    elif cmd_text.startswith(":") and get_mode() == "COMMAND":
+        ex = parse_ex_command(cmd_text[1:])
+        if ex.name == "s":
+            preview = preview_substitute(buf, "s" + ex.args)
+            if preview != cmd_compl_text:
+                cmd_compl_text = preview
+                update_bar_item("cmd_completion")
     return weechat.WEECHAT_RC_OK
 
-def add_undo_history(buf, input_line):
-    """Add an item to the per-buffer undo history."""
-    if buf in undo_history:
-        if not undo_history[buf] or undo_history[buf][-1] != input_line:
-            undo_history[buf].append(input_line)
-            undo_history_index[buf] = -1
-    else:
-        undo_history[buf] = ['', input_line]
-        undo_history_index[buf] = -1
-
-def clear_undo_history(buf):
-    """Clear the undo history for a given buffer."""
-    undo_history[buf] = ['']
-    undo_history_index[buf] = -1
-
 def print_warning(text):
     """Print warning, in red, to the current buffer."""
-    buf = weechat.current_buffer()
+    buf = get_current_buffer()
     weechat.prnt(buf, ("%s[vimode.py] %s" % (weechat.color("red"), text)))
 
 def check_warnings():
@@ -2185,12 +5464,204 @@ def check_warnings():
                       " plugins.var.python.vimode.no_warn to 'on'")
 
 
+# Dispatch table.
+# ===============
+
+class Motion(object):
+    """A registered motion.
+
+    Attributes:
+        keys (str): the motion's keys (e.g. "w").
+        func (callable): the motion function, see `motion_base()`.
+        catching (bool): True if the motion catches keys (e.g. "f").
+        callback (callable): for catching motions, the function called once
+            all keys are caught. See `start_catching_keys()`.
+    """
+    __slots__ = ("keys", "func", "catching", "callback")
+
+    def __init__(self, keys, func, callback=None):
+        self.keys = keys
+        self.func = func
+        self.catching = callback is not None
+        self.callback = callback
+
+
+class Operator(object):
+    """A registered operator.
+
+    Attributes:
+        key (str): the operator's key (e.g. "d").
+        func (callable): the operator function, see `operator_base()`.
+        linewise (bool): True if the operator always acts on whole lines.
+        mode (str): the mode the operator switches to, if any.
+    """
+    __slots__ = ("key", "func", "linewise", "mode")
+
+    def __init__(self, key, func, linewise=False, mode=None):
+        self.key = key
+        self.func = func
+        self.linewise = linewise
+        self.mode = mode
+
+
+class Action(object):
+    """Ready-to-call handler for a key sequence, with its metadata.
+
+    Called as action(buf, input_line, cur, count), see `key_base()`.
+
+    Attributes:
+        keys (str): the key sequence (e.g. "dw").
+        kind (str): "key", "motion" or "operator".
+        func (callable): the handler.
+        catching (bool): True if the action catches keys.
+        linewise (bool): True if the action works on the whole line.
+        mode (str): the mode the action switches to, if any.
+    """
+    __slots__ = ("keys", "kind", "func", "catching", "linewise", "mode")
+
+    def __init__(self, keys, kind, func, catching=False, linewise=False,
+                 mode=None):
+        self.keys = keys
+        self.kind = kind
+        self.func = func
+        self.catching = catching
+        self.linewise = linewise
+        self.mode = mode
+
+    def __call__(self, buf, input_line, cur, count):
+        return self.func(buf, input_line, cur, count)
+
+
+# Modes the operators switch to.
+VI_OPERATOR_MODES = {'c': "INSERT"}
+
+# Metadata for key handlers, keyed by function (or WeeChat command).
+VI_KEYS_METADATA = {key_r: {'catching': True},
+                    key_alt_j: {'catching': True},
+                    key_cc: {'linewise': True, 'mode': "INSERT"},
+                    key_yy: {'linewise': True},
+                    key_C: {'mode': "INSERT"},
+                    key_i: {'mode': "INSERT"},
+                    key_a: {'mode': "INSERT"},
+                    key_A: {'mode': "INSERT"},
+                    key_I: {'mode': "INSERT"},
+                    key_R: {'mode': "REPLACE"},
+                    key_dd: {'linewise': True}}
+
+def get_key_metadata(command):
+    """Return the `VI_KEYS_METADATA` of a key handler, {} if it has none."""
+    try:
+        return VI_KEYS_METADATA.get(command, {})
+    except TypeError:  # Unhashable callable.
+        return {}
+
+# Registered motions and operators, keyed by their keys.
+VI_MOTION_ACTIONS = {}
+VI_OPERATOR_ACTIONS = {}
+
+# Every key sequence we handle in Normal mode (without counts), mapped to its
+# `Action`. Keys (`VI_KEYS`) take precedence over motions, which take
+# precedence over operator + motion combos.
+VI_DISPATCH = {}
+
+def refresh_dispatch(keys):
+    """Rebuild the `VI_DISPATCH` entry for `keys`."""
+    if keys in VI_KEYS:
+        command = VI_KEYS[keys]
+        if isinstance(command, str):
+            func = functools.partial(do_command, command)
+        else:
+            func = command
+        VI_DISPATCH[keys] = Action(keys, "key", func,
+                                   **get_key_metadata(command))
+    elif keys in VI_MOTION_ACTIONS:
+        motion = VI_MOTION_ACTIONS[keys]
+        VI_DISPATCH[keys] = Action(keys, "motion",
+                                   functools.partial(do_motion, motion),
+                                   motion.catching)
+    elif keys[:1] in VI_OPERATOR_ACTIONS and keys[1:] in VI_MOTION_ACTIONS:
+        operator = VI_OPERATOR_ACTIONS[keys[:1]]
+        motion = VI_MOTION_ACTIONS[keys[1:]]
+        func = functools.partial(do_operator, operator, motion)
+        VI_DISPATCH[keys] = Action(keys, "operator", func, motion.catching,
+                                   operator.linewise,
+                                   None if motion.catching else operator.mode)
+    else:
+        VI_DISPATCH.pop(keys, None)
+
+def register_motion(keys, func, callback=None):
+    """Register a motion, usable on its own and after every operator.
+
+    Args:
+        keys (str): the motion's keys.
+        func (callable): the motion function, see `motion_base()`; whether
+            the motion is inclusive is part of what it returns.
+        callback (callable, optional): for catching motions, the function to
+            call once all keys are caught. Defaults to None.
+
+    Returns:
+        Motion: the registered motion.
+    """
+    motion = Motion(keys, func, callback)
+    VI_MOTION_ACTIONS[keys] = motion
+    if keys not in VI_MOTIONS:
+        VI_MOTIONS.append(keys)
+    VI_MOTIONS_TRIE[keys] = keys
+    refresh_dispatch(keys)
+    for operator in VI_OPERATOR_ACTIONS:
+        refresh_dispatch(operator + keys)
+    return motion
+
+def register_operator(key, func, linewise=False, mode=None):
+    """Register an operator, usable with every motion.
+
+    Args:
+        key (str): the operator's key.
+        func (callable): the operator function, see `operator_base()`.
+        linewise (bool, optional): True if the operator always acts on whole
+            lines. Defaults to False.
+        mode (str, optional): the mode the operator switches to, if any.
+            Defaults to None.
+
+    Returns:
+        Operator: the registered operator.
+    """
+    operator = Operator(key, func, linewise, mode)
+    VI_OPERATOR_ACTIONS[key] = operator
+    if key not in VI_OPERATORS:
+        VI_OPERATORS.append(key)
+    for motion in VI_MOTION_ACTIONS:
+        refresh_dispatch(key + motion)
+    return operator
+
+def keymap_changed(keys):
+    """Called when the user mapping for `keys` is added or removed."""
+    refresh_dispatch(keys)
+    invalidate_user_mappings(keys)
+
+def register_builtins():
+    """Register our operators, motions and keys, see `VI_DISPATCH`."""
+    functions = globals()
+    for key in list(VI_OPERATORS):
+        register_operator(key, functions["operator_%s" % key],
+                          mode=VI_OPERATOR_MODES.get(key))
+    for keys in list(VI_MOTIONS):
+        name = SPECIAL_CHARS.get(keys, keys)
+        register_motion(keys, functions["motion_%s" % name],
+                        functions.get("cb_motion_%s" % name))
+    for keys in list(VI_KEYS):
+        refresh_dispatch(keys)
+    VI_KEYS.on_change = keymap_changed
+
+register_builtins()
+
+
 # Main script.
 # ============
 
 if __name__ == "__main__":
     weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION,
-                     SCRIPT_LICENSE, SCRIPT_DESC, "", "")
+                     SCRIPT_LICENSE, SCRIPT_DESC, "cb_unload", "")
     # Warn the user if he's using an unsupported WeeChat version.
     VERSION = weechat.info_get("version_number", "")
     if int(VERSION) < 0x01000000:
@@ -2207,13 +5678,16 @@ if __name__ == "__main__":
                                        "%s (default: \"%s\")" % (value[1],
                                                                  value[0]))
     load_user_mappings()
-    load_mode_colors()
-    load_is_keyword_regexes()
+    load_mode_indicators()
+    load_is_keyword()
+    hook_line_numbers_print()
+    if vimode_settings['vimrc_path']:
+        source_vimrc(vimode_settings['vimrc_path'], missing_ok=True)
     # Warn the user about possible problems if necessary.
     if not weechat.config_string_to_boolean(vimode_settings['no_warn']):
         check_warnings()
     # Create bar items and setup hooks.
-    weechat.bar_item_new("mode_indicator", "cb_mode_indicator", "")
+    weechat.bar_item_new("(extra)mode_indicator", "cb_mode_indicator", "")
     weechat.bar_item_new("cmd_completion", "cb_cmd_completion", "")
     weechat.bar_item_new("vi_buffer", "cb_vi_buffer", "")
     weechat.bar_item_new("line_numbers", "cb_line_numbers", "")
@@ -2231,12 +5705,32 @@ if __name__ == "__main__":
     weechat.hook_signal("key_combo_default", "cb_key_combo_default", "")
     weechat.hook_signal("key_combo_search", "cb_key_combo_search", "")
     weechat.hook_signal("buffer_switch", "cb_update_line_numbers", "")
-    weechat.hook_command("vimode", SCRIPT_DESC, "[help | bind_keys [--list]]",
+    weechat.hook_signal("window_resized", "cb_windows_changed", "")
+    weechat.hook_signal("window_opened", "cb_windows_changed", "")
+    weechat.hook_signal("window_closed", "cb_window_closed", "")
+    weechat.hook_signal("window_scrolled", "cb_window_scrolled", "")
+    weechat.hook_signal("buffer_merged", "cb_windows_changed", "")
+    weechat.hook_signal("buffer_unmerged", "cb_windows_changed", "")
+    weechat.hook_signal("filter*", "cb_filters_changed", "")
+    for signal in ("*_script_loaded", "*_script_unloaded", "plugin_loaded",
+                   "plugin_unloaded"):
+        weechat.hook_signal(signal, "cb_completion_changed", "")
+    weechat.hook_signal("buffer_switch", "cb_buffer_switch", "")
+    weechat.hook_signal("window_switch", "cb_buffer_switch", "")
+    weechat.hook_signal("buffer_closed", "cb_buffer_closed", "")
+    weechat.hook_signal("input_text_changed", "cb_input_changed", "")
+    weechat.hook_signal("input_text_cursor_moved", "cb_input_changed", "")
+    weechat.hook_command("vimode", SCRIPT_DESC,
+                         "[help | bind_keys [--list] | stats [on|off|reset]]",
                          "     help: show help\n"
                          "bind_keys: unbind problematic keys, and bind"
                          " recommended keys to use in WeeChat\n"
-                         "          --list: only list changes",
-                         "help || bind_keys |--list",
+                         "          --list: only list changes\n"
+                         "    stats: show debug statistics\n"
+                         "          on|off: start/stop counting WeeChat API"
+                         " calls\n"
+                         "          reset: reset the statistics",
+                         "help || bind_keys |--list || stats on|off|reset",
                          "cb_vimode_cmd", "")
     weechat.hook_command("vimode_go_to_normal",
                          ("This command can be used for key bindings to go to "